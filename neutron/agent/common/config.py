@@ -64,6 +64,15 @@ IPTABLES_OPTS = [
                        "generated iptables rules that describe each rule's "
                        "purpose. System must support the iptables comments "
                        "module for addition of comments.")),
+    cfg.IntOpt('iptables_resync_interval', default=0,
+               help=_("Seconds during which iptables rules are applied "
+                      "against the state last applied by the agent, "
+                      "instead of against the output of iptables-save. "
+                      "The state is read again with iptables-save after "
+                      "that interval, and after a failure to apply rules. "
+                      "Only set it when the agent is the only writer of "
+                      "the tables it manages. 0 reads the state before "
+                      "every apply.")),
 ]
 
 PROCESS_MONITOR_OPTS = [
@@ -14,6 +14,7 @@
 import copy
 
 import netaddr
+from oslo_utils import excutils
 
 from neutron.agent.linux import utils as linux_utils
 from neutron.common import utils
@@ -29,12 +30,20 @@ class IpsetManager(object):
 
        Keeps track of ip addresses per set, using bulk
        or single ip add/remove for smaller changes.
+       The changes of sets are applied with a single ipset restore,
+       which batches all the changes made while applying is deferred.
     """
 
     def __init__(self, execute=None, namespace=None):
         self.execute = execute or linux_utils.execute
         self.namespace = namespace
         self.ipset_sets = {}
+        # Names of the sets which may exist on the system: those found
+        # when the manager is first used, and those created since
+        self._system_set_names = None
+        self._defer_apply = False
+        self._pending_input = []
+        self._pending_set_names = set()
 
     def _sanitize_addresses(self, addresses):
         """This method converts any address to ipset format.
@@ -87,16 +96,19 @@ class IpsetManager(object):
     @utils.synchronized('ipset', external=True)
     def set_members_mutate(self, set_name, ethertype, member_ips):
         if not self.set_name_exists(set_name):
-            # The initial creation is handled with create/refresh to
-            # avoid any downtime for existing sets (i.e. avoiding
-            # a flush/restore), as the restore operation of ipset is
-            # additive to the existing set.
-            self._create_set(set_name, ethertype)
-            self._refresh_set(set_name, member_ips, ethertype)
-            # TODO(majopela,shihanzhang,haleyb): Optimize this by
-            # gathering the system ipsets at start. So we can determine
-            # if a normal restore is enough for initial creation.
-            # That should speed up agent boot up time.
+            if set_name in self._get_system_set_names():
+                # Refreshing the existing set avoids any downtime for it
+                # (i.e. avoiding a flush/restore), as the restore
+                # operation of ipset is additive to the existing set.
+                self._create_set(set_name, ethertype)
+                self._refresh_set(set_name, member_ips, ethertype)
+            else:
+                # A set not found on the system is created with its
+                # members at once
+                self._create_set(set_name, ethertype)
+                self._add_pending(set_name, ['add %s %s' % (set_name, ip)
+                                             for ip in member_ips])
+                self.ipset_sets[set_name] = copy.copy(member_ips)
         else:
             add_ips = self._get_new_set_ips(set_name, member_ips)
             del_ips = self._get_deleted_set_ips(set_name, member_ips)
@@ -105,15 +117,25 @@ class IpsetManager(object):
                 self._del_members_from_set(set_name, del_ips)
             else:
                 self._refresh_set(set_name, member_ips, ethertype)
+        if not self._defer_apply:
+            self._apply_pending()
+
+    def defer_apply_on(self):
+        self._defer_apply = True
+
+    @utils.synchronized('ipset', external=True)
+    def defer_apply_off(self):
+        self._defer_apply = False
+        self._apply_pending()
 
     @utils.synchronized('ipset', external=True)
     def destroy(self, id, ethertype, forced=False):
         set_name = self.get_name(id, ethertype)
+        self._apply_pending()
         self._destroy(set_name, forced)
 
     def _add_member_to_set(self, set_name, member_ip):
-        cmd = ['ipset', 'add', '-exist', set_name, member_ip]
-        self._apply(cmd)
+        self._add_pending(set_name, ['add %s %s' % (set_name, member_ip)])
         self.ipset_sets[set_name].append(member_ip)
 
     def _refresh_set(self, set_name, member_ips, ethertype):
@@ -123,31 +145,68 @@ class IpsetManager(object):
                                                           set_type)]
         for ip in member_ips:
             process_input.append("add %s %s" % (new_set_name, ip))
+        process_input.append("swap %s %s" % (new_set_name, set_name))
+        process_input.append("destroy %s" % new_set_name)
 
-        self._restore_sets(process_input)
-        self._swap_sets(new_set_name, set_name)
-        self._destroy(new_set_name, True)
+        self._add_pending(set_name, process_input)
         self.ipset_sets[set_name] = copy.copy(member_ips)
 
     def _del_member_from_set(self, set_name, member_ip):
-        cmd = ['ipset', 'del', set_name, member_ip]
-        self._apply(cmd, fail_on_errors=False)
+        # A member is already gone from a set missing on the system, whose
+        # deletion would fail the whole restore
+        if set_name in self._get_system_set_names():
+            self._add_pending(set_name,
+                              ['del %s %s' % (set_name, member_ip)])
         self.ipset_sets[set_name].remove(member_ip)
 
     def _create_set(self, set_name, ethertype):
-        cmd = ['ipset', 'create', '-exist', set_name, 'hash:net', 'family',
-               self._get_ipset_set_type(ethertype)]
-        self._apply(cmd)
+        self._add_pending(set_name, [
+            'create %s hash:net family %s' % (
+                set_name, self._get_ipset_set_type(ethertype))])
+        self._get_system_set_names().add(set_name)
         self.ipset_sets[set_name] = []
 
+    def _get_system_set_names(self):
+        """Return the names of the sets which may exist on the system.
+
+        The sets are listed once, when the manager is first used, so that
+        the sets not found are created with their members at once.
+        """
+        if self._system_set_names is None:
+            output = self._apply(['ipset', 'list', '-name'])
+            self._system_set_names = set(output.split())
+        return self._system_set_names
+
+    def _add_pending(self, set_name, process_input):
+        self._pending_input.extend(process_input)
+        self._pending_set_names.add(set_name)
+
+    def _apply_pending(self):
+        if not self._pending_input:
+            return
+        process_input = self._pending_input
+        set_names = self._pending_set_names
+        self._pending_input = []
+        self._pending_set_names = set()
+        try:
+            self._restore_sets(process_input)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                # The sets may have been changed in part, or be missing on
+                # the system; they are listed again, and refreshed when
+                # their members are set again
+                self._system_set_names = None
+                for set_name in set_names:
+                    self.ipset_sets.pop(set_name, None)
+
     def _apply(self, cmd, input=None, fail_on_errors=True):
         input = '\n'.join(input) if input else None
         cmd_ns = []
         if self.namespace:
             cmd_ns.extend(['ip', 'netns', 'exec', self.namespace])
         cmd_ns.extend(cmd)
-        self.execute(cmd_ns, run_as_root=True, process_input=input,
-                     check_exit_code=fail_on_errors)
+        return self.execute(cmd_ns, run_as_root=True, process_input=input,
+                            check_exit_code=fail_on_errors)
 
     def _get_new_set_ips(self, set_name, expected_ips):
         new_member_ips = (set(expected_ips) -
@@ -176,12 +235,10 @@ class IpsetManager(object):
         cmd = ['ipset', 'restore', '-exist']
         self._apply(cmd, process_input)
 
-    def _swap_sets(self, src_set, dest_set):
-        cmd = ['ipset', 'swap', src_set, dest_set]
-        self._apply(cmd)
-
     def _destroy(self, set_name, forced=False):
         if set_name in self.ipset_sets or forced:
             cmd = ['ipset', 'destroy', set_name]
             self._apply(cmd, fail_on_errors=False)
             self.ipset_sets.pop(set_name, None)
+            if self._system_set_names is not None:
+                self._system_set_names.discard(set_name)
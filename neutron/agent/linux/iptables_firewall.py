@@ -653,6 +653,7 @@ class IptablesFirewallDriver(firewall.FirewallDriver):
     def filter_defer_apply_on(self):
         if not self._defer_apply:
             self.iptables.defer_apply_on()
+            self.ipset.defer_apply_on()
             self._pre_defer_filtered_ports = dict(self.filtered_ports)
             self._pre_defer_unfiltered_ports = dict(self.unfiltered_ports)
             self.pre_sg_members = dict(self.sg_members)
@@ -812,15 +813,22 @@ class IptablesFirewallDriver(firewall.FirewallDriver):
     def filter_defer_apply_off(self):
         if self._defer_apply:
             self._defer_apply = False
-            self._remove_chains_apply(self._pre_defer_filtered_ports,
-                                      self._pre_defer_unfiltered_ports)
-            self._setup_chains_apply(self.filtered_ports,
-                                     self.unfiltered_ports)
-            self.iptables.defer_apply_off()
-            self._remove_conntrack_entries_from_sg_updates()
-            self._remove_unused_security_group_info()
-            self._pre_defer_filtered_ports = None
-            self._pre_defer_unfiltered_ports = None
+            try:
+                self._remove_chains_apply(self._pre_defer_filtered_ports,
+                                          self._pre_defer_unfiltered_ports)
+                self._setup_chains_apply(self.filtered_ports,
+                                         self.unfiltered_ports)
+                try:
+                    # the sets must be in place before the rules matching
+                    # them
+                    self.ipset.defer_apply_off()
+                finally:
+                    self.iptables.defer_apply_off()
+                self._remove_conntrack_entries_from_sg_updates()
+                self._remove_unused_security_group_info()
+            finally:
+                self._pre_defer_filtered_ports = None
+                self._pre_defer_unfiltered_ports = None
 
     def _populate_initial_zone_map(self):
         """Setup the map between devices and zones based on current rules."""
@@ -18,12 +18,13 @@
 
 """Implements iptables rules using linux utilities."""
 
+import bisect
 import collections
 import contextlib
-import difflib
 import os
 import re
 import sys
+import time
 
 from oslo_concurrency import lockutils
 from oslo_config import cfg
@@ -262,16 +263,14 @@ class IptablesTable(object):
 
     def empty_chain(self, chain, wrap=True):
         """Remove all rules from a chain."""
-        chained_rules = self._get_chain_rules(chain, wrap)
-        for rule in chained_rules:
-            self.rules.remove(rule)
+        chain = get_chain_name(chain, wrap)
+        self.rules = [rule for rule in self.rules
+                      if rule.chain != chain or rule.wrap != wrap]
 
     def clear_rules_by_tag(self, tag):
         if not tag:
             return
-        rules = [rule for rule in self.rules if rule.tag == tag]
-        for rule in rules:
-            self.rules.remove(rule)
+        self.rules = [rule for rule in self.rules if rule.tag != tag]
 
 
 class IptablesManager(object):
@@ -307,6 +306,15 @@ class IptablesManager(object):
         self.use_ipv6 = use_ipv6
         self.namespace = namespace
         self.iptables_apply_deferred = False
+        # The tables last applied, and when they were last read with
+        # iptables-save, by command
+        self._applied_tables = {}
+        self._saved_time = {}
+        # Numbers of the applies requested and done. The applies requested
+        # while another waits for the lock are all done by the first to
+        # get it, as the tables hold the changes of all of them
+        self._apply_requests = 0
+        self._applied_requests = 0
         self.wrap_name = binary_name[:16]
 
         self.ipv4 = {'filter': IptablesTable(binary_name=self.wrap_name)}
@@ -427,8 +435,29 @@ class IptablesManager(object):
         if self.namespace:
             lock_name += '-' + self.namespace
 
+        self._apply_requests += 1
+        request = self._apply_requests
         with lockutils.lock(lock_name, utils.SYNCHRONIZED_PREFIX, True):
-            return self._apply_synchronized()
+            if self._applied_requests >= request:
+                LOG.debug("Changes to iptables rules already applied")
+                return []
+            applied_requests = self._applied_requests
+            # Changes made from now on will need another apply
+            self._applied_requests = self._apply_requests
+            try:
+                return self._apply_synchronized()
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    self._applied_requests = applied_requests
+
+    def _is_owned_chain(self, table, chain):
+        """Return whether the rules of chain are all added by this manager.
+
+        Other chains, as the builtin ones, may also have rules added by
+        other binaries, which are left alone.
+        """
+        return (chain.startswith('%s-' % self.wrap_name) or
+                chain in table.unwrapped_chains)
 
     def get_rules_for_table(self, table):
         """Runs iptables-save on a table and returns the results."""
@@ -451,23 +480,21 @@ class IptablesManager(object):
             s += [('ip6tables', self.ipv6)]
         all_commands = []  # variable to keep track all commands for return val
         for cmd, tables in s:
-            args = ['%s-save' % (cmd,)]
-            if self.namespace:
-                args = ['ip', 'netns', 'exec', self.namespace] + args
-            save_output = self.execute(args, run_as_root=True)
-            all_lines = save_output.split('\n')
+            saved_tables = self._get_saved_tables(cmd, tables)
+            applied_tables = {}
             commands = []
             # Traverse tables in sorted order for predictable dump output
             for table_name in sorted(tables):
                 table = tables[table_name]
-                # isolate the lines of the table we are modifying
-                start, end = self._find_table(all_lines, table_name)
-                old_rules = all_lines[start:end]
+                old_rules = saved_tables[table_name]
                 # generate the new table state we want
                 new_rules = self._modify_rules(old_rules, table, table_name)
+                applied_tables[table_name] = new_rules
                 # generate the iptables commands to get between the old state
                 # and the new state
-                changes = _generate_path_between_rules(old_rules, new_rules)
+                changes = _generate_path_between_rules(
+                    old_rules, new_rules,
+                    lambda chain: self._is_owned_chain(table, chain))
                 if changes:
                     # if there are changes to the table, we put on the header
                     # and footer that iptables-save needs
@@ -475,6 +502,7 @@ class IptablesManager(object):
                                  ['*%s' % table_name] + changes +
                                  ['COMMIT', '# Completed by iptables_manager'])
             if not commands:
+                self._set_applied_tables(cmd, applied_tables)
                 continue
             all_commands += commands
             args = ['%s-restore' % (cmd,), '-n']
@@ -485,8 +513,11 @@ class IptablesManager(object):
                 commands.append('')
                 self.execute(args, process_input='\n'.join(commands),
                              run_as_root=True)
+                self._set_applied_tables(cmd, applied_tables)
             except RuntimeError as r_error:
                 with excutils.save_and_reraise_exception():
+                    # the tables may have been applied in part
+                    self._applied_tables.pop(cmd, None)
                     try:
                         line_no = int(re.search(
                             'iptables-restore: line ([0-9]+?) failed',
@@ -510,6 +541,30 @@ class IptablesManager(object):
                   "commands were issued", len(all_commands))
         return all_commands
 
+    def _get_saved_tables(self, cmd, tables):
+        """Return the lines of the tables, as last applied or saved."""
+        applied_tables = self._applied_tables.get(cmd)
+        if (applied_tables is not None and
+                time.time() - self._saved_time[cmd] <
+                cfg.CONF.AGENT.iptables_resync_interval):
+            return applied_tables
+        args = ['%s-save' % (cmd,)]
+        if self.namespace:
+            args = ['ip', 'netns', 'exec', self.namespace] + args
+        save_output = self.execute(args, run_as_root=True)
+        all_lines = save_output.split('\n')
+        self._saved_time[cmd] = time.time()
+        saved_tables = {}
+        for table_name in tables:
+            # isolate the lines of the table we are modifying
+            start, end = self._find_table(all_lines, table_name)
+            saved_tables[table_name] = all_lines[start:end]
+        return saved_tables
+
+    def _set_applied_tables(self, cmd, applied_tables):
+        if cfg.CONF.AGENT.iptables_resync_interval > 0:
+            self._applied_tables[cmd] = applied_tables
+
     def _find_table(self, lines, table_name):
         if len(lines) < 3:
             # length only <2 when fake iptables
@@ -556,25 +611,29 @@ class IptablesManager(object):
         # the unwrapped chains (e.g. neutron-filter-top) may already exist in
         # the new_filter since they aren't marked by the wrap_name so we only
         # want to add them if they arent' already there
+        existing_chains = set(line[1:].split(' ', 1)[0]
+                              for line in new_filter if line.startswith(':'))
         our_chains += [':%s' % name for name in unwrapped_chains
-                       if not any(':%s' % name in s for s in new_filter)]
+                       if name not in existing_chains]
 
         our_top_rules = []
         our_bottom_rules = []
         for rule in table.rules:
             rule_str = str(rule)
-            # similar to the unwrapped chains, there are some rules that belong
-            # to us but they don't have the wrap name. we want to remove them
-            # from the new_filter and then add them in the right location in
-            # case our new rules changed the order.
-            # (e.g. '-A FORWARD -j neutron-filter-top')
-            new_filter = [s for s in new_filter if rule_str not in s]
-
             if rule.top:
                 # rule.top == True means we want this rule to be at the top.
-                our_top_rules += [rule_str]
+                our_top_rules.append(rule_str)
             else:
-                our_bottom_rules += [rule_str]
+                our_bottom_rules.append(rule_str)
+
+        # similar to the unwrapped chains, there are some rules that belong
+        # to us but they don't have the wrap name. we want to remove them
+        # from the new_filter and then add them in the right location in
+        # case our new rules changed the order.
+        # (e.g. '-A FORWARD -j neutron-filter-top')
+        our_rules = set(our_top_rules)
+        our_rules.update(our_bottom_rules)
+        new_filter = [line for line in new_filter if line not in our_rules]
 
         our_chains_and_rules = our_chains + our_top_rules + our_bottom_rules
 
@@ -583,6 +642,9 @@ class IptablesManager(object):
         rules_index = self._find_rules_index(new_filter)
         new_filter[rules_index:rules_index] = our_chains_and_rules
 
+        # each rule slated for removal removes one occurrence of it
+        remove_rules = collections.Counter(table.remove_rules)
+
         def _weed_out_removes(line):
             # remove any rules or chains from the filter that were slated
             # for removal
@@ -592,8 +654,8 @@ class IptablesManager(object):
                     table.remove_chains.remove(chain)
                     return False
             else:
-                if line in table.remove_rules:
-                    table.remove_rules.remove(line)
+                if remove_rules[line] > 0:
+                    remove_rules[line] -= 1
                     return False
             # Leave it alone
             return True
@@ -676,12 +738,15 @@ class IptablesManager(object):
         return acc
 
 
-def _generate_path_between_rules(old_rules, new_rules):
+def _generate_path_between_rules(old_rules, new_rules,
+                                 is_owned_chain=lambda chain: False):
     """Generates iptables commands to get from old_rules to new_rules.
 
     This function diffs the two rule sets and then calculates the iptables
     commands necessary to get from the old rules to the new rules using
-    insert and delete commands.
+    insert, replace and delete commands, or by flushing the chains which
+    changed the most and adding their rules again. Only the chains for
+    which is_owned_chain is true are flushed.
     """
     old_by_chain = _get_rules_by_chain(old_rules)
     new_by_chain = _get_rules_by_chain(new_rules)
@@ -701,7 +766,8 @@ def _generate_path_between_rules(old_rules, new_rules):
 
     for chain in other_chains + sg_chains:
         statements += _generate_chain_diff_iptables_commands(
-            chain, old_by_chain[chain], new_by_chain[chain])
+            chain, old_by_chain[chain], new_by_chain[chain],
+            is_owned_chain(chain))
     # unreferenced chains get the axe
     for chain in sorted(old_chains - new_chains):
         statements += ['-X %s' % chain]
@@ -724,25 +790,117 @@ def _get_rules_by_chain(rules):
     return by_chain
 
 
+def _longest_increasing_pairs(pairs):
+    """Return the longest run of pairs increasing in their second item.
+
+    The pairs are sorted by their first item. This is the patience sorting
+    step of the patience diff, in O(n log n).
+    """
+    tails = []
+    tail_indexes = []
+    previous = []
+    for index, (old_index, new_index) in enumerate(pairs):
+        pile = bisect.bisect_left(tails, new_index)
+        if pile == len(tails):
+            tails.append(new_index)
+            tail_indexes.append(index)
+        else:
+            tails[pile] = new_index
+            tail_indexes[pile] = index
+        previous.append(tail_indexes[pile - 1] if pile else None)
+    result = []
+    index = tail_indexes[-1] if tail_indexes else None
+    while index is not None:
+        result.append(pairs[index])
+        index = previous[index]
+    result.reverse()
+    return result
+
+
+def _get_matching_lines(old_lines, new_lines):
+    """Return the (old index, new index) pairs of the lines left in place.
+
+    This is a patience diff: the lines occurring once in both the old and
+    the new lines anchor the match, and the lines between the anchors are
+    matched the same way. The lines of a table are unique once generated,
+    so nearly all of them are anchors.
+    """
+    matches = []
+    regions = [(0, len(old_lines), 0, len(new_lines))]
+    while regions:
+        old_start, old_end, new_start, new_end = regions.pop()
+        # lines unchanged at the start and end of the region
+        while (old_start < old_end and new_start < new_end and
+               old_lines[old_start] == new_lines[new_start]):
+            matches.append((old_start, new_start))
+            old_start += 1
+            new_start += 1
+        while (old_start < old_end and new_start < new_end and
+               old_lines[old_end - 1] == new_lines[new_end - 1]):
+            matches.append((old_end - 1, new_end - 1))
+            old_end -= 1
+            new_end -= 1
+        if old_start == old_end or new_start == new_end:
+            continue
+        old_counts = collections.Counter(old_lines[old_start:old_end])
+        new_positions = {}
+        for new_index in range(new_start, new_end):
+            line = new_lines[new_index]
+            if old_counts[line] == 1:
+                new_positions[line] = (
+                    None if line in new_positions else new_index)
+        unique_pairs = [(old_index, new_positions[old_lines[old_index]])
+                        for old_index in range(old_start, old_end)
+                        if new_positions.get(old_lines[old_index]) is not None]
+        anchors = _longest_increasing_pairs(unique_pairs)
+        # lines between the anchors are matched in their own regions
+        for old_index, new_index in anchors:
+            matches.append((old_index, new_index))
+            regions.append((old_start, old_index, new_start, new_index))
+            old_start, new_start = old_index + 1, new_index + 1
+        if anchors:
+            regions.append((old_start, old_end, new_start, new_end))
+    matches.sort()
+    return matches
+
+
 def _generate_chain_diff_iptables_commands(chain, old_chain_rules,
-                                          new_chain_rules):
-    # keep track of the old index because we have to insert rules
-    # in the right position
-    old_index = 1
+                                          new_chain_rules, can_flush=False):
+    if can_flush:
+        old_lines = set(old_chain_rules)
+        changed = (max(len(old_chain_rules), len(new_chain_rules)) -
+                   sum(1 for line in new_chain_rules if line in old_lines))
+        if len(new_chain_rules) < changed:
+            # there would be more commands to edit the chain than to flush
+            # it and add all of its rules again
+            return ['-F %s' % chain] + list(new_chain_rules)
+
+    # keep track of the index in the chain being edited because we have
+    # to insert, replace and delete rules in the right position
+    index = 1
     statements = []
-    for line in difflib.ndiff(old_chain_rules, new_chain_rules):
-        if line.startswith('?'):
-            # skip ? because that's a guide string for intraline differences
-            continue
-        elif line.startswith('-'):  # line deleted
-            statements.append('-D %s %d' % (chain, old_index))
-            # since we are removing a line from the old rules, we
-            # backup the index by 1
-            old_index -= 1
-        elif line.startswith('+'):  # line added
-            # strip the chain name since we have to add it before the index
-            rule = line[5:].split(' ', 1)[-1]
-            # rule inserted at this position
-            statements.append('-I %s %d %s' % (chain, old_index, rule))
-        old_index += 1
+    old_index = new_index = 0
+    matches = _get_matching_lines(old_chain_rules, new_chain_rules)
+    for old_match, new_match in matches + [(len(old_chain_rules),
+                                            len(new_chain_rules))]:
+        replaced = min(old_match - old_index, new_match - new_index)
+        for line in new_chain_rules[new_index:new_index + replaced]:
+            statements.append('-R %s %d %s' % (chain, index,
+                                               _get_rule(line)))
+            index += 1
+        # the indexes of the rules after a deleted rule move back by 1
+        statements += ['-D %s %d' % (chain, index)] * (
+            old_match - old_index - replaced)
+        for line in new_chain_rules[new_index + replaced:new_match]:
+            statements.append('-I %s %d %s' % (chain, index,
+                                               _get_rule(line)))
+            index += 1
+        old_index, new_index = old_match + 1, new_match + 1
+        index += 1
     return statements
+
+
+def _get_rule(line):
+    # strip '-A' and the chain name since we have to add the chain before
+    # the index
+    return line.split(' ', 2)[2]
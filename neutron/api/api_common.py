@@ -24,6 +24,7 @@ from webob import exc
 from neutron._i18n import _, _LW
 from neutron.common import constants
 from neutron.common import exceptions
+from neutron.db import sqlalchemyutils
 
 
 LOG = logging.getLogger(__name__)
@@ -238,6 +239,36 @@ class PaginationNativeHelper(PaginationEmulatedHelper):
         return items
 
 
+class PaginationKeysetHelper(PaginationNativeHelper):
+    """Native pagination with markers holding the sort keys of items.
+
+    The plugin resumes the listing after such a marker without fetching
+    the item it was made from. Markers set to the id of an item are still
+    accepted.
+    """
+
+    def update_args(self, args):
+        super(PaginationKeysetHelper, self).update_args(args)
+        self.sorts = args['sorts']
+
+    def update_fields(self, original_fields, fields_to_add):
+        super(PaginationKeysetHelper, self).update_fields(original_fields,
+                                                          fields_to_add)
+        if not original_fields:
+            return
+        for key, _direction in self.sorts:
+            if key not in original_fields:
+                original_fields.append(key)
+                fields_to_add.append(key)
+
+    def get_links(self, items):
+        markers = [{self.primary_key: sqlalchemyutils.encode_marker(
+            item, self.sorts)} for item in items]
+        return get_pagination_links(
+            self.request, markers, self.limit, self.marker,
+            self.page_reverse, self.primary_key)
+
+
 class NoPaginationHelper(PaginationHelper):
     pass
 
@@ -72,6 +72,8 @@ class Controller(object):
         self._allow_sorting = allow_sorting
         self._native_bulk = self._is_native_bulk_supported()
         self._native_pagination = self._is_native_pagination_supported()
+        self._native_keyset_pagination = (
+            self._is_native_keyset_pagination_supported())
         self._native_sorting = self._is_native_sorting_supported()
         self._policy_attrs = [name for (name, info) in self._attr_info.items()
                               if info.get('required_by_policy')]
@@ -128,6 +130,13 @@ class Controller(object):
                                        % self._plugin.__class__.__name__)
         return getattr(self._plugin, native_pagination_attr_name, False)
 
+    def _is_native_keyset_pagination_supported(self):
+        native_keyset_pagination_attr_name = (
+            "_%s__native_keyset_pagination_support"
+            % self._plugin.__class__.__name__)
+        return getattr(self._plugin, native_keyset_pagination_attr_name,
+                       False)
+
     def _is_native_sorting_supported(self):
         native_sorting_attr_name = ("_%s__native_sorting_support"
                                     % self._plugin.__class__.__name__)
@@ -228,7 +237,11 @@ class Controller(object):
             raise AttributeError()
 
     def _get_pagination_helper(self, request):
-        if self._allow_pagination and self._native_pagination:
+        if (self._allow_pagination and self._native_pagination and
+                self._native_keyset_pagination):
+            return api_common.PaginationKeysetHelper(request,
+                                                     self._primary_key)
+        elif self._allow_pagination and self._native_pagination:
             return api_common.PaginationNativeHelper(request,
                                                      self._primary_key)
         elif self._allow_pagination:
@@ -0,0 +1,45 @@
+# Copyright 2016 GoDaddy.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Rebuild the per subnet IP usage counters from the ipallocations table.
+
+"""
+
+import sys
+
+from oslo_log import log as logging
+
+from neutron._i18n import _LI
+from neutron.common import config
+from neutron import context
+from neutron.db import ip_usage_db
+
+
+LOG = logging.getLogger(__name__)
+
+
+def main():
+    """Main method for synchronizing the IP usage counters.
+
+    The counters are maintained by the IPAM code paths; this utility is meant
+    to be run once after upgrading and whenever the counters are suspected to
+    have drifted.
+    """
+    config.init(sys.argv[1:])
+    config.setup_logging()
+
+    cxt = context.get_admin_context()
+    repaired = ip_usage_db.sync_subnet_ip_usages(cxt)
+    LOG.info(_LI("IP usage sync completed, %d subnets updated"), repaired)
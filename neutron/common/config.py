@@ -162,7 +162,54 @@ core_opts = [
                       "If ipam_driver is not set (default behavior), no IPAM "
                       "driver is used. In order to use the reference "
                       "implementation of Neutron IPAM driver, "
-                      "use 'internal'.")),
+                      "use 'internal'. The 'internal_bitmap' variant tracks "
+                      "the addresses of IPv4 and small IPv6 pools in "
+                      "allocation bitmaps, which scales better with "
+                      "concurrent allocations on large subnets.")),
+    cfg.IntOpt('ipam_lease_size', default=0, min=0,
+               help=_("Number of addresses of a subnet leased at once by "
+                      "each server process with the 'internal' IPAM driver. "
+                      "Leased addresses are handed out by that process "
+                      "without updating the availability ranges, which "
+                      "reduces contention when many ports are created at "
+                      "once. 0 disables the leases.")),
+    cfg.IntOpt('ipam_lease_ttl', default=60, min=1,
+               help=_("Seconds after which the unused addresses of an IPAM "
+                      "lease are given back to the subnet.")),
+    cfg.IntOpt('subnetpool_quota_sync_interval', default=0, min=0,
+               help=_("Seconds between two verifications of the subnet "
+                      "pool quota usage counters against the subnets they "
+                      "count, repairing any drift. 0 disables the "
+                      "verification.")),
+    cfg.StrOpt('collection_load_strategy', default='joined',
+               choices=['joined', 'batched'],
+               help=_("How the collections of the resources returned by "
+                      "list operations, such as the fixed IPs of ports, are "
+                      "loaded. 'joined' loads them all in the query of the "
+                      "resources, whose number of rows is the product of "
+                      "the sizes of the collections. 'batched' loads each "
+                      "collection with a separate query for all the "
+                      "resources at once.")),
+    cfg.StrOpt('resource_count_mode', default='exact',
+               choices=['exact', 'counters', 'estimate'],
+               help=_("How networks, subnets and ports are counted, as for "
+                      "quota checks. 'exact' counts the resources matching "
+                      "the filters, and does not maintain the counters. "
+                      "'counters' reads the number of resources of given "
+                      "tenants, or of subnets of given networks, from "
+                      "counters kept in step with the resources, and counts "
+                      "other resources exactly. Each creation or deletion "
+                      "then locks the counter of its tenant until its "
+                      "transaction ends. 'estimate' also answers "
+                      "unfiltered counts of admin requests from the table "
+                      "statistics of the database, which are approximate. "
+                      "After running in 'exact' mode, the counters must be "
+                      "repaired, see resource_count_sync_interval.")),
+    cfg.IntOpt('resource_count_sync_interval', default=600, min=0,
+               help=_("Seconds between two verifications of the resource "
+                      "counters against the resources they count, "
+                      "repairing any drift. It may not be 0 unless "
+                      "resource_count_mode is 'exact'.")),
     cfg.BoolOpt('vlan_transparent', default=False,
                 help=_('If True, then allow plugins that support it to '
                        'create VLAN transparent networks.')),
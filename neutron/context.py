@@ -21,6 +21,7 @@ import datetime
 from oslo_context import context as oslo_context
 
 from neutron.db import api as db_api
+from neutron.db import lookup_cache
 from neutron import policy
 
 
@@ -114,6 +115,7 @@ class Context(ContextBase):
     def __init__(self, *args, **kwargs):
         super(Context, self).__init__(*args, **kwargs)
         self._session = None
+        self._lookup_cache = None
 
     @property
     def session(self):
@@ -121,6 +123,13 @@ class Context(ContextBase):
             self._session = db_api.get_session()
         return self._session
 
+    @property
+    def lookup_cache(self):
+        """Cache of the lookups made in the transaction of the session."""
+        if self._lookup_cache is None:
+            self._lookup_cache = lookup_cache.LookupCache(self.session)
+        return self._lookup_cache
+
 
 def get_admin_context():
     return Context(user_id=None,
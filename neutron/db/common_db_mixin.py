@@ -15,6 +15,7 @@
 
 import weakref
 
+from oslo_config import cfg
 import six
 from sqlalchemy import and_
 from sqlalchemy import or_
@@ -58,6 +59,11 @@ class CommonDbMixin(object):
     # TODO(salvatore-orlando): Avoid using class-level variables
     _dict_extend_functions = {}
 
+    # Attributes of the resources of each model which their dict function
+    # copies as is from a column of the same name. List operations asking
+    # for these attributes only read them straight from the columns.
+    _column_fields = {}
+
     @classmethod
     def register_model_query_hook(cls, model, name, query_hook, filter_hook,
                                   result_filters=None):
@@ -267,10 +273,53 @@ class CommonDbMixin(object):
                                                   context)
         if limit and page_reverse and sorts:
             sorts = [(s[0], not s[1]) for s in sorts]
-        collection = sqlalchemyutils.paginate_query(collection, model, limit,
-                                                    sorts,
-                                                    marker_obj=marker_obj)
-        return collection
+        if isinstance(model, UnionModel):
+            return sqlalchemyutils.paginate_query(collection, model, limit,
+                                                  sorts,
+                                                  marker_obj=marker_obj)
+        return sqlalchemyutils.paginate_instances_query(collection, model,
+                                                        limit, sorts,
+                                                        marker_obj=marker_obj)
+
+    def _load_collection(self, context, model, query):
+        """Return the instances of a collection query.
+
+        With the 'batched' collection_load_strategy, the collections of the
+        instances are loaded by a separate query each, rather than joined
+        in the query of the instances.
+        """
+        if (cfg.CONF.collection_load_strategy != 'batched' or
+                isinstance(model, UnionModel)):
+            return query
+        query = sqlalchemyutils.lazy_load_collections(query, model)
+        instances = query.all()
+        sqlalchemyutils.batch_load_collections(context.session, model,
+                                               instances)
+        return instances
+
+    def _can_project_fields(self, model, fields):
+        """Return whether fields can be read straight from model's columns."""
+        return bool(fields and
+                    self._column_fields.get(model, frozenset()).issuperset(
+                        fields))
+
+    def _get_projected_collection(self, query, model, fields):
+        """Return the resources of a collection query as dicts of fields.
+
+        Only the columns of fields are selected, which leaves out the
+        relationships of model and the functions extending its resources.
+        """
+        fields = list(set(fields))
+        query = query.with_entities(
+            model.id, *[getattr(model, field) for field in fields])
+        items = []
+        seen = set()
+        for row in query:
+            # Joins of the query may return the same resource several times
+            if row[0] not in seen:
+                seen.add(row[0])
+                items.append(dict(zip(fields, row[1:])))
+        return items
 
     def _get_collection(self, context, model, dict_func, filters=None,
                         fields=None, sorts=None, limit=None, marker_obj=None,
@@ -280,7 +329,11 @@ class CommonDbMixin(object):
                                            limit=limit,
                                            marker_obj=marker_obj,
                                            page_reverse=page_reverse)
-        items = [dict_func(c, fields) for c in query]
+        if self._can_project_fields(model, fields):
+            items = self._get_projected_collection(query, model, fields)
+        else:
+            items = [dict_func(c, fields)
+                     for c in self._load_collection(context, model, query)]
         if limit and page_reverse:
             items.reverse()
         return items
@@ -290,7 +343,9 @@ class CommonDbMixin(object):
 
     def _get_marker_obj(self, context, resource, limit, marker):
         if limit and marker:
-            return getattr(self, '_get_%s' % resource)(context, marker)
+            # Markers encoding the sort keys of an item spare its lookup
+            return (sqlalchemyutils.decode_marker(marker) or
+                    getattr(self, '_get_%s' % resource)(context, marker))
         return None
 
     def _filter_non_model_columns(self, data, model):
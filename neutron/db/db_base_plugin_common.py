@@ -23,8 +23,11 @@ from neutron.api.v2 import attributes
 from neutron.common import constants
 from neutron.common import exceptions as n_exc
 from neutron.common import utils
+from neutron import context as n_context
 from neutron.db import common_db_mixin
+from neutron.db import ip_usage_db
 from neutron.db import models_v2
+from neutron.db import rbac_db_models
 
 LOG = logging.getLogger(__name__)
 
@@ -73,6 +76,22 @@ class DbBasePluginCommon(common_db_mixin.CommonDbMixin):
     backends.
     """
 
+    _column_fields = {
+        models_v2.Network: frozenset(['id', 'name', 'tenant_id',
+                                      'admin_state_up', 'status']),
+        models_v2.Port: frozenset(['id', 'name', 'network_id', 'tenant_id',
+                                   'mac_address', 'admin_state_up', 'status',
+                                   'device_id', 'device_owner']),
+        models_v2.Subnet: frozenset(['id', 'name', 'tenant_id', 'network_id',
+                                     'ip_version', 'cidr', 'subnetpool_id',
+                                     'gateway_ip', 'enable_dhcp',
+                                     'ipv6_ra_mode', 'ipv6_address_mode']),
+        models_v2.SubnetPool: frozenset(['id', 'name', 'tenant_id',
+                                         'is_default', 'shared',
+                                         'ip_version', 'default_quota',
+                                         'address_scope_id']),
+    }
+
     @staticmethod
     def _generate_mac():
         return utils.get_random_mac(cfg.CONF.base_mac.split(':'))
@@ -86,10 +105,11 @@ class DbBasePluginCommon(common_db_mixin.CommonDbMixin):
                   {'ip_address': ip_address,
                    'network_id': network_id,
                    'subnet_id': subnet_id})
-        context.session.query(models_v2.IPAllocation).filter_by(
+        deleted = context.session.query(models_v2.IPAllocation).filter_by(
             network_id=network_id,
             ip_address=ip_address,
             subnet_id=subnet_id).delete()
+        ip_usage_db.adjust_subnet_used_ips(context, subnet_id, -deleted)
 
     @staticmethod
     def _store_ip_allocation(context, ip_address, network_id, subnet_id,
@@ -107,6 +127,7 @@ class DbBasePluginCommon(common_db_mixin.CommonDbMixin):
             subnet_id=subnet_id
         )
         context.session.add(allocated)
+        ip_usage_db.adjust_subnet_used_ips(context, subnet_id, 1)
 
     def _make_subnet_dict(self, subnet, fields=None, context=None):
         res = {'id': subnet['id'],
@@ -181,16 +202,31 @@ class DbBasePluginCommon(common_db_mixin.CommonDbMixin):
                 attributes.PORTS, res, port)
         return self._fields(res, fields)
 
+    def _get_cached(self, context, key, tags, func):
+        """Return func(), looked up once in the transaction of context."""
+        if not isinstance(context, n_context.Context):
+            return func()
+        return context.lookup_cache.lookup(key, tags, func)
+
+    def _get_by_id_cached(self, context, model, id):
+        tag = (model.__tablename__, 'id', id)
+        # Tenants may not see all the rows admin contexts see
+        scope = (context.tenant_id
+                 if self.model_query_scope(context, model) else None)
+        return self._get_cached(
+            context, tag + (scope,), [tag],
+            lambda: self._get_by_id(context, model, id))
+
     def _get_network(self, context, id):
         try:
-            network = self._get_by_id(context, models_v2.Network, id)
+            network = self._get_by_id_cached(context, models_v2.Network, id)
         except exc.NoResultFound:
             raise n_exc.NetworkNotFound(net_id=id)
         return network
 
     def _get_subnet(self, context, id):
         try:
-            subnet = self._get_by_id(context, models_v2.Subnet, id)
+            subnet = self._get_by_id_cached(context, models_v2.Subnet, id)
         except exc.NoResultFound:
             raise n_exc.SubnetNotFound(subnet_id=id)
         return subnet
@@ -233,8 +269,13 @@ class DbBasePluginCommon(common_db_mixin.CommonDbMixin):
                 device_owner=constants.DEVICE_OWNER_ROUTER_GW).all()
 
     def _get_subnets_by_network(self, context, network_id):
-        subnet_qry = context.session.query(models_v2.Subnet)
-        return subnet_qry.filter_by(network_id=network_id).all()
+        def get_subnets():
+            subnet_qry = context.session.query(models_v2.Subnet)
+            return subnet_qry.filter_by(network_id=network_id).all()
+        tags = [(models_v2.Subnet.__tablename__, 'network_id', network_id),
+                (models_v2.Network.__tablename__, 'id', network_id)]
+        return list(self._get_cached(
+            context, ('subnets_by_network', network_id), tags, get_subnets))
 
     def _get_subnets_by_subnetpool(self, context, subnetpool_id):
         subnet_qry = context.session.query(models_v2.Subnet)
@@ -280,11 +321,18 @@ class DbBasePluginCommon(common_db_mixin.CommonDbMixin):
         # The shared attribute for a network now reflects if the network
         # is shared to the calling tenant via an RBAC entry.
         matches = ('*',) + ((context.tenant_id,) if context else ())
-        for entry in network.rbac_entries:
-            if (entry.action == 'access_as_shared' and
-                    entry.target_tenant in matches):
-                return True
-        return False
+
+        def is_shared():
+            for entry in network.rbac_entries:
+                if (entry.action == 'access_as_shared' and
+                        entry.target_tenant in matches):
+                    return True
+            return False
+        tags = [(rbac_db_models.NetworkRBAC.__tablename__, 'object_id',
+                 network.id),
+                (models_v2.Network.__tablename__, 'id', network.id)]
+        return self._get_cached(
+            context, ('network_shared', network.id, matches), tags, is_shared)
 
     def _make_subnet_args(self, detail, subnet, subnetpool_id):
         gateway_ip = str(detail.gateway_ip) if detail.gateway_ip else None
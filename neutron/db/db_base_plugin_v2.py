@@ -13,6 +13,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 import functools
 
 import netaddr
@@ -21,6 +22,7 @@ from oslo_db import exception as db_exc
 from oslo_log import log as logging
 from oslo_utils import excutils
 from oslo_utils import uuidutils
+import six
 from sqlalchemy import and_
 from sqlalchemy import event
 
@@ -40,9 +42,11 @@ from neutron.db import api as db_api
 from neutron.db import db_base_plugin_common
 from neutron.db import ipam_non_pluggable_backend
 from neutron.db import ipam_pluggable_backend
+from neutron.db import mac_allocator
 from neutron.db import models_v2
 from neutron.db import rbac_db_mixin as rbac_mixin
 from neutron.db import rbac_db_models as rbac_db
+from neutron.db import resource_count_db
 from neutron.db import sqlalchemyutils
 from neutron.extensions import l3
 from neutron import ipam
@@ -51,6 +55,7 @@ from neutron import manager
 from neutron import neutron_plugin_base_v2
 from neutron.notifiers import nova as nova_notifier
 from neutron.plugins.common import constants as service_constants
+from neutron import worker as neutron_worker
 
 
 LOG = logging.getLogger(__name__)
@@ -89,14 +94,22 @@ class NeutronDbPluginV2(db_base_plugin_common.DbBasePluginCommon,
     """
 
     # This attribute specifies whether the plugin supports or not
-    # bulk/pagination/sorting operations. Name mangling is used in
-    # order to ensure it is qualified by class
+    # bulk/pagination/keyset pagination/sorting operations. Name mangling
+    # is used in order to ensure it is qualified by class
     __native_bulk_support = True
     __native_pagination_support = True
+    __native_keyset_pagination_support = True
     __native_sorting_support = True
 
     def __init__(self):
         self.set_ipam_backend()
+        if cfg.CONF.resource_count_mode != resource_count_db.EXACT_MODE:
+            # Counters read by quota checks must not drift unrepaired
+            if not cfg.CONF.resource_count_sync_interval:
+                raise n_exc.InvalidConfigurationOption(
+                    opt_name='resource_count_sync_interval',
+                    opt_value=cfg.CONF.resource_count_sync_interval)
+            resource_count_db.start_counting()
         if cfg.CONF.notify_nova_on_port_status_changes:
             # NOTE(arosen) These event listeners are here to hook into when
             # port status changes and notify nova about their change.
@@ -363,10 +376,12 @@ class NeutronDbPluginV2(db_base_plugin_common.DbBasePluginCommon,
         with context.session.begin(subtransactions=True):
             network = self._get_network(context, id)
 
-            context.session.query(models_v2.Port).filter_by(
-                network_id=id).filter(
-                models_v2.Port.device_owner.
-                in_(AUTO_DELETE_PORT_OWNERS)).delete(synchronize_session=False)
+            auto_delete_ports = context.session.query(
+                models_v2.Port).filter_by(network_id=id).filter(
+                models_v2.Port.device_owner.in_(AUTO_DELETE_PORT_OWNERS))
+            resource_count_db.count_bulk_deleted(context, models_v2.Port,
+                                                 auto_delete_ports)
+            auto_delete_ports.delete(synchronize_session=False)
 
             port_in_use = context.session.query(models_v2.Port).filter_by(
                 network_id=id).first()
@@ -400,8 +415,12 @@ class NeutronDbPluginV2(db_base_plugin_common.DbBasePluginCommon,
                                     page_reverse=page_reverse)
 
     def get_networks_count(self, context, filters=None):
-        return self._get_collection_count(context, models_v2.Network,
-                                          filters=filters)
+        count = resource_count_db.get_count(context, models_v2.Network,
+                                            filters)
+        if count is None:
+            count = self._get_collection_count(context, models_v2.Network,
+                                               filters=filters)
+        return count
 
     def create_subnet_bulk(self, context, subnets):
         return self._create_bulk('subnet', context, subnets)
@@ -861,8 +880,12 @@ class NeutronDbPluginV2(db_base_plugin_common.DbBasePluginCommon,
                                  marker, page_reverse)
 
     def get_subnets_count(self, context, filters=None):
-        return self._get_collection_count(context, models_v2.Subnet,
-                                          filters=filters)
+        count = resource_count_db.get_count(context, models_v2.Subnet,
+                                            filters)
+        if count is None:
+            count = self._get_collection_count(context, models_v2.Subnet,
+                                               filters=filters)
+        return count
 
     def get_subnets_by_network(self, context, network_id):
         return [self._make_subnet_dict(subnet_db) for subnet_db in
@@ -982,6 +1005,12 @@ class NeutronDbPluginV2(db_base_plugin_common.DbBasePluginCommon,
         with context.session.begin(subtransactions=True):
             context.session.query(models_v2.SubnetPoolPrefix).filter_by(
                 subnetpool_id=id).delete()
+            # The free prefix index is rebuilt with the new prefixes by the
+            # next allocation from the pool
+            context.session.query(models_v2.SubnetPoolFreePrefix).filter_by(
+                subnetpool_id=id).delete()
+            context.session.query(models_v2.SubnetPool).filter_by(
+                id=id).update({'free_prefixes_indexed': False})
             for prefix in prefix_list:
                 model_prefix = models_v2.SubnetPoolPrefix(cidr=prefix,
                                                       subnetpool_id=id)
@@ -1084,6 +1113,20 @@ class NeutronDbPluginV2(db_base_plugin_common.DbBasePluginCommon,
                 raise n_exc.SubnetPoolDeleteError(reason=reason)
             context.session.delete(subnetpool)
 
+    def get_workers(self):
+        # Counters are verified by dedicated workers rather than by every
+        # API worker
+        workers = []
+        interval = cfg.CONF.subnetpool_quota_sync_interval
+        if interval:
+            workers.append(neutron_worker.PeriodicWorker(
+                subnet_alloc.verify_subnetpool_quota_usages, interval))
+        if cfg.CONF.resource_count_mode != resource_count_db.EXACT_MODE:
+            workers.append(neutron_worker.PeriodicWorker(
+                resource_count_db.sync_resource_counts,
+                cfg.CONF.resource_count_sync_interval))
+        return workers
+
     def _check_mac_addr_update(self, context, port, new_mac, device_owner):
         if (device_owner and
             device_owner.startswith(constants.DEVICE_OWNER_NETWORK_PREFIX)):
@@ -1092,7 +1135,18 @@ class NeutronDbPluginV2(db_base_plugin_common.DbBasePluginCommon,
                 device_owner=device_owner)
 
     def create_port_bulk(self, context, ports):
-        return self._create_bulk('port', context, ports)
+        if (getattr(self.create_port, '__func__', None) is not
+                six.get_unbound_function(NeutronDbPluginV2.create_port)):
+            # Ports created one at a time go through the create_port of the
+            # subclass, which the batched path would bypass
+            return self._create_bulk('port', context, ports)
+        items = ports['ports']
+        try:
+            return self._create_ports_db(context, items)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                LOG.error(_LE("An exception occurred while creating "
+                              "the ports:%s"), items)
 
     def _get_dns_domain(self):
         if not cfg.CONF.dns_domain:
@@ -1146,7 +1200,10 @@ class NeutronDbPluginV2(db_base_plugin_common.DbBasePluginCommon,
     def _create_port(self, context, network_id, port_data):
         max_retries = cfg.CONF.mac_generation_retries
         for i in range(max_retries):
-            mac = self._generate_mac()
+            macs = mac_allocator.generate_macs(context, network_id)
+            if not macs:
+                break
+            mac = macs[0]
             try:
                 return self._create_port_with_mac(
                     context, network_id, port_data, mac)
@@ -1154,11 +1211,140 @@ class NeutronDbPluginV2(db_base_plugin_common.DbBasePluginCommon,
                 LOG.debug('Generated mac %(mac_address)s exists on '
                           'network %(network_id)s',
                           {'mac_address': mac, 'network_id': network_id})
+                mac_allocator.mark_in_use(network_id, [mac], generated=True)
+
+        LOG.error(_LE("Unable to generate mac address after %s attempts"),
+                  max_retries)
+        raise n_exc.MacAddressGenerationFailure(net_id=network_id)
+
+    def _generate_macs(self, context, network_id, count):
+        """Generate count MAC addresses not in use on a network.
+
+        The candidates of each attempt are checked against the ports of the
+        network with a single query.
+        """
+        max_retries = cfg.CONF.mac_generation_retries
+        macs = set()
+        for i in range(max_retries):
+            candidates = set(mac_allocator.generate_macs(
+                context, network_id, count - len(macs)))
+            if not candidates:
+                break
+            in_use = set(mac for mac, in context.session.query(
+                models_v2.Port.mac_address).filter(
+                    models_v2.Port.network_id == network_id,
+                    models_v2.Port.mac_address.in_(candidates)))
+            macs.update(candidates - in_use)
+            if len(macs) == count:
+                return list(macs)
+            LOG.debug('Generated macs %(mac_addresses)s exist on '
+                      'network %(network_id)s',
+                      {'mac_addresses': sorted(in_use),
+                       'network_id': network_id})
+            mac_allocator.mark_in_use(network_id, in_use, generated=True)
 
         LOG.error(_LE("Unable to generate mac address after %s attempts"),
                   max_retries)
         raise n_exc.MacAddressGenerationFailure(net_id=network_id)
 
+    def _check_macs_unused(self, context, network_id, macs):
+        """Check that requested MAC addresses are not in use on a network."""
+        for mac, count in collections.Counter(macs).items():
+            if count > 1:
+                raise n_exc.MacAddressInUse(net_id=network_id, mac=mac)
+        in_use = context.session.query(models_v2.Port.mac_address).filter(
+            models_v2.Port.network_id == network_id,
+            models_v2.Port.mac_address.in_(macs)).first()
+        if in_use:
+            raise n_exc.MacAddressInUse(net_id=network_id, mac=in_use[0])
+
+    def _create_ports_db(self, context, ports):
+        """Create several ports in a single transaction.
+
+        This is the batched counterpart of create_port: each network is
+        fetched once, the MAC addresses of the ports of a network are
+        generated or checked together, the ports are inserted with a single
+        flush, and the IPAM backend allocates the IPs of all ports at once.
+
+        :param ports: list of port create request bodies.
+        :returns: the list of created port dicts, in request order.
+        """
+        port_datas = []
+        for port in ports:
+            p = port['port']
+            # NOTE(jkoelker) Get the tenant_id outside of the session to avoid
+            #                unneeded db action if the operation raises
+            tenant_id = self._get_tenant_id_for_create(context, p)
+            if p.get('device_owner'):
+                self._enforce_device_owner_not_router_intf_or_device_id(
+                    context, p.get('device_owner'), p.get('device_id'),
+                    tenant_id)
+            port_data = dict(tenant_id=tenant_id,
+                             name=p['name'],
+                             id=p.get('id') or uuidutils.generate_uuid(),
+                             network_id=p['network_id'],
+                             admin_state_up=p['admin_state_up'],
+                             status=p.get('status',
+                                          constants.PORT_STATUS_ACTIVE),
+                             device_id=p['device_id'],
+                             device_owner=p['device_owner'],
+                             mac_address=p['mac_address'])
+            if 'dns_name' in p:
+                port_data['dns_name'] = self._get_request_dns_name(p)
+            port_datas.append(port_data)
+
+        with context.session.begin(subtransactions=True):
+            requested_macs = collections.defaultdict(list)
+            generated_counts = collections.Counter()
+            for port_data in port_datas:
+                network_id = port_data['network_id']
+                if port_data['mac_address'] is attributes.ATTR_NOT_SPECIFIED:
+                    generated_counts[network_id] += 1
+                else:
+                    requested_macs[network_id].append(
+                        port_data['mac_address'])
+            for network_id in set(port_data['network_id']
+                                  for port_data in port_datas):
+                # Ensure that the network exists.
+                self._get_network(context, network_id)
+            for network_id, macs in requested_macs.items():
+                self._check_macs_unused(context, network_id, macs)
+                mac_allocator.mark_in_use(network_id, macs)
+            generated_macs = dict(
+                (network_id, self._generate_macs(context, network_id, count))
+                for network_id, count in generated_counts.items())
+
+            db_ports = []
+            for port, port_data in zip(ports, port_datas):
+                if port_data['mac_address'] is attributes.ATTR_NOT_SPECIFIED:
+                    port_data = dict(port_data, mac_address=generated_macs[
+                        port_data['network_id']].pop())
+                    # The IPAM backends build EUI-64 addresses from it
+                    port['port']['mac_address'] = port_data['mac_address']
+                db_ports.append(models_v2.Port(**port_data))
+            context.session.add_all(db_ports)
+            try:
+                context.session.flush()
+            except db_exc.DBDuplicateEntry as e:
+                if 'mac_address' not in e.columns:
+                    raise
+                # A MAC address was taken concurrently
+                raise db_exc.RetryRequest(e)
+
+            all_ips = self.ipam.allocate_ips_for_ports_and_store(
+                context, [(port, db_port.id)
+                          for port, db_port in zip(ports, db_ports)])
+            for port, db_port, ips in zip(ports, db_ports, all_ips):
+                if 'dns_name' in port['port']:
+                    db_port['dns_assignment'] = []
+                    if ips:
+                        db_port['dns_assignment'] = (
+                            self._get_dns_names_for_port(
+                                context, ips, db_port['dns_name']))
+
+        return [self._make_port_dict(db_port, process_extensions=False)
+                for db_port in db_ports]
+
     def create_port(self, context, port):
         p = port['port']
         port_id = p.get('id') or uuidutils.generate_uuid()
@@ -1193,6 +1379,7 @@ class NeutronDbPluginV2(db_base_plugin_common.DbBasePluginCommon,
             else:
                 db_port = self._create_port_with_mac(
                     context, network_id, port_data, p['mac_address'])
+                mac_allocator.mark_in_use(network_id, [p['mac_address']])
 
             ips = self.ipam.allocate_ips_for_port_and_store(context, port,
                                                             port_id)
@@ -1321,8 +1508,8 @@ class NeutronDbPluginV2(db_base_plugin_common.DbBasePluginCommon,
         query = self._apply_filters_to_query(query, Port, filters, context)
         if limit and page_reverse and sorts:
             sorts = [(s[0], not s[1]) for s in sorts]
-        query = sqlalchemyutils.paginate_query(query, Port, limit,
-                                               sorts, marker_obj)
+        query = sqlalchemyutils.paginate_instances_query(query, Port, limit,
+                                                         sorts, marker_obj)
         return query
 
     def get_ports(self, context, filters=None, fields=None,
@@ -1333,8 +1520,14 @@ class NeutronDbPluginV2(db_base_plugin_common.DbBasePluginCommon,
                                       sorts=sorts, limit=limit,
                                       marker_obj=marker_obj,
                                       page_reverse=page_reverse)
+        if self._can_project_fields(models_v2.Port, fields):
+            items = self._get_projected_collection(query, models_v2.Port,
+                                                   fields)
+            if limit and page_reverse:
+                items.reverse()
+            return items
         items = []
-        for c in query:
+        for c in self._load_collection(context, models_v2.Port, query):
             if (('dns-integration' in self.supported_extension_aliases and
                  'dns_name' in c)):
                 c['dns_assignment'] = self._get_dns_name_for_port_get(context,
@@ -1345,7 +1538,10 @@ class NeutronDbPluginV2(db_base_plugin_common.DbBasePluginCommon,
         return items
 
     def get_ports_count(self, context, filters=None):
-        return self._get_ports_query(context, filters).count()
+        count = resource_count_db.get_count(context, models_v2.Port, filters)
+        if count is None:
+            count = self._get_ports_query(context, filters).count()
+        return count
 
     def _enforce_device_owner_not_router_intf_or_device_id(self, context,
                                                            device_owner,
@@ -13,141 +13,620 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
-import netaddr
+import collections
+
+from oslo_config import cfg
 import six
+from six import moves
+import sqlalchemy as sa
 from sqlalchemy import func
+from sqlalchemy import orm
 
+from neutron._i18n import _, _LI
+import neutron.api.v2.attributes as attributes
+import neutron.common.exceptions as n_exc
+import neutron.db.model_base as model_base
 import neutron.db.models_v2 as mod
+import neutron.db.rbac_db_models as rbac_db_models
+import neutron.db.sqlalchemyutils as sqlalchemyutils
+import neutron.extensions.external_net as external_net
+import neutron.ipam.utils as ipam_utils
 import oslo_log.log as logging
 
 
 LOG = logging.getLogger(__name__)
 
+IP_USAGE_ENGINES = (COUNTERS_ENGINE, LIVE_ENGINE) = ('counters', 'live')
+
+IP_USAGE_OPTS = [
+    cfg.StrOpt('ip_usage_engine',
+               default=COUNTERS_ENGINE,
+               choices=IP_USAGE_ENGINES,
+               help=_("How IP usage is computed. 'counters' reads the usage "
+                      "counters maintained for each subnet, 'live' "
+                      "aggregates IP allocations and allocation pools on "
+                      "every request.")),
+    cfg.IntOpt('ip_usage_total_ips_cap',
+               default=0,
+               min=0,
+               help=_("Maximum total IPs reported for a single subnet, 0 "
+                      "meaning no limit. IPv6 subnets hold up to 2^64 "
+                      "addresses or more, so that network totals become "
+                      "huge numbers dominated by the IPv6 subnets. Capping "
+                      "them keeps the totals readable and cheap to sum. "
+                      "Utilizations, thresholds and ordering are still "
+                      "evaluated on the exact totals.")),
+]
+cfg.CONF.register_opts(IP_USAGE_OPTS)
+
+
+class SubnetIPUsage(model_base.BASEV2):
+    """Represents the precomputed IP usage counters of a subnet.
+
+    used_ips is kept in step with the ipallocations table and total_ips with
+    the allocation pools of the subnet, so that usage can be reported without
+    aggregating the IPAM tables on every request.
+    """
+
+    subnet_id = sa.Column(sa.String(36),
+                          sa.ForeignKey('subnets.id', ondelete="CASCADE"),
+                          primary_key=True)
+    used_ips = sa.Column(sa.BigInteger, nullable=False, server_default='0')
+    # NOTE: IPv6 totals do not fit a 64 bit integer column, so the exact
+    # value is stored in its decimal representation.
+    total_ips = sa.Column(sa.String(40), nullable=False)
+    subnet = orm.relationship(mod.Subnet)
+
 
 SUPPORTED_FILTERS = {
     'network_id': mod.Network.id,
     'network_name': mod.Network.name,
     'ip_version': mod.Subnet.ip_version,
+    'tenant_id': mod.Network.tenant_id,
+    'subnet_id': mod.Subnet.id,
 }
 SUPPORTED_FILTER_KEYS = six.viewkeys(SUPPORTED_FILTERS)
 
+# NOTE: external_net_db depends on the core plugin, which depends on this
+# module, so its table is referred to by name
+EXTERNAL_NETWORKS = sa.table('externalnetworks', sa.column('network_id'))
+BOOLEAN_FILTER_KEYS = frozenset(['shared', external_net.EXTERNAL])
+
+# Filters and sort keys evaluated on the usage counters
+THRESHOLD_FILTER_KEYS = frozenset(['min_utilization', 'max_free_ips'])
+USAGE_SORT_KEYS = frozenset(['used_ips', 'total_ips', 'utilization'])
+
+
+# Totals computed by subnet_total_ips, keyed by CIDR and pool bounds
+_TOTAL_IPS_CACHE = {}
+_TOTAL_IPS_CACHE_SIZE = 4096
+
+
+def _cidr_size(cidr):
+    address, _sep, prefixlen = cidr.partition('/')
+    bits = 128 if ':' in address else 32
+    return 1 << (bits - int(prefixlen or bits))
+
+
+def _pool_bounds(pool):
+    # Allocation pools come either as netaddr.IPRange from the API, or as
+    # (first_ip, last_ip) strings from the allocation pools table
+    if isinstance(pool, tuple):
+        return pool
+    return pool.first, pool.last
+
+
+def subnet_total_ips(cidr, pools):
+    """Return the number of addresses available for allocation on a subnet.
+
+    Sizes are computed from the integer values of the pool bounds, without
+    building netaddr objects, and are cached per CIDR and pools.
+
+    :param cidr: the CIDR of the subnet.
+    :param pools: the allocation pools of the subnet, as netaddr.IPRange or
+                  (first_ip, last_ip) tuples. When no pool is given the
+                  whole CIDR is accounted for.
+    """
+    key = (cidr, tuple(sorted(_pool_bounds(pool) for pool in pools or [])))
+    total_ips = _TOTAL_IPS_CACHE.get(key)
+    if total_ips is None:
+        if not pools:
+            total_ips = _cidr_size(cidr)
+        else:
+            total_ips = 0
+            for first_ip, last_ip in key[1]:
+                if isinstance(first_ip, six.string_types):
+                    first_ip = ipam_utils.ip_to_int(first_ip)
+                    last_ip = ipam_utils.ip_to_int(last_ip)
+                total_ips += last_ip - first_ip + 1
+        if len(_TOTAL_IPS_CACHE) >= _TOTAL_IPS_CACHE_SIZE:
+            _TOTAL_IPS_CACHE.clear()
+        _TOTAL_IPS_CACHE[key] = total_ips
+    return total_ips
+
+
+def reported_total_ips(total_ips):
+    """Apply the configured cap to the total IPs of a subnet."""
+    cap = cfg.CONF.ip_usage_total_ips_cap
+    if cap and total_ips > cap:
+        return cap
+    return total_ips
+
+
+def utilization(used_ips, total_ips):
+    """Return the percentage of total_ips which are used."""
+    if not total_ips:
+        return 0.0
+    return round(100.0 * used_ips / total_ips, 2)
+
+
+def create_subnet_ip_usage(context, subnet, pools):
+    """Create the usage counters for a newly created subnet."""
+    usage = SubnetIPUsage(subnet=subnet, used_ips=0,
+                          total_ips=str(subnet_total_ips(subnet['cidr'],
+                                                         pools)))
+    context.session.add(usage)
+
+
+def update_subnet_total_ips(context, subnet_id, cidr, pools):
+    """Refresh the total counter of a subnet after its pools changed."""
+    total_ips = str(subnet_total_ips(cidr, pools))
+    context.session.query(SubnetIPUsage).filter_by(
+        subnet_id=subnet_id).update({'total_ips': total_ips},
+                                    synchronize_session=False)
+
+
+def adjust_subnet_used_ips(context, subnet_id, delta):
+    """Add delta to the used counter of a subnet.
+
+    The counter is updated in place so that concurrent allocations on the
+    same subnet do not overwrite each other. Subnets without counters are
+    left alone; they are counted on the fly until the next sync.
+    """
+    context.session.query(SubnetIPUsage).filter_by(
+        subnet_id=subnet_id).update(
+            {'used_ips': SubnetIPUsage.used_ips + delta},
+            synchronize_session=False)
+
+
+def count_used_ips(context, subnet_ids=None):
+    """Count the IP allocations of each subnet.
+
+    :param subnet_ids: optional list or subquery restricting the subnets.
+    Returns a dict mapping subnet ids to their number of allocations.
+    """
+    query = context.session.query(
+        mod.IPAllocation.subnet_id,
+        func.count(mod.IPAllocation.ip_address)).group_by(
+            mod.IPAllocation.subnet_id)
+    if subnet_ids is not None:
+        query = query.filter(mod.IPAllocation.subnet_id.in_(subnet_ids))
+    return dict(query.all())
+
+
+def get_pool_ranges(context, subnet_ids=None):
+    """Return the allocation pools of each subnet as (first_ip, last_ip).
+
+    :param subnet_ids: optional list or subquery restricting the subnets.
+    """
+    query = context.session.query(mod.IPAllocationPool.subnet_id,
+                                  mod.IPAllocationPool.first_ip,
+                                  mod.IPAllocationPool.last_ip)
+    if subnet_ids is not None:
+        query = query.filter(mod.IPAllocationPool.subnet_id.in_(subnet_ids))
+    pools = collections.defaultdict(list)
+    for subnet_id, first_ip, last_ip in query:
+        pools[subnet_id].append((first_ip, last_ip))
+    return pools
+
+
+def count_subnet_ip_usages(context, subnet_ids=None):
+    """Count used and total IPs per subnet from the IPAM tables.
+
+    Allocations and pools are aggregated by separate queries, so that
+    neither multiplies the rows of the other.
+
+    :param subnet_ids: optional list or subquery restricting the subnets.
+    Returns a dict mapping subnet ids to (used_ips, total_ips) tuples.
+    """
+    query = context.session.query(mod.Subnet.id, mod.Subnet.cidr)
+    if subnet_ids is not None:
+        query = query.filter(mod.Subnet.id.in_(subnet_ids))
+    used = count_used_ips(context, subnet_ids)
+    pools = get_pool_ranges(context, subnet_ids)
+    return {subnet_id: (used.get(subnet_id, 0),
+                        subnet_total_ips(cidr, pools.get(subnet_id)))
+            for subnet_id, cidr in query}
+
+
+def sync_subnet_ip_usages(context):
+    """Rebuild the IP usage counters of every subnet from the IPAM tables.
+
+    Returns the number of subnets whose counters were created or repaired.
+    """
+    repaired = 0
+    with context.session.begin(subtransactions=True):
+        # Lock the counters before counting, so that allocations committed
+        # while the sync runs are not lost
+        stored = {usage.subnet_id: usage for usage in
+                  context.session.query(SubnetIPUsage).with_lockmode(
+                      'update')}
+        actual = count_subnet_ip_usages(context)
+        for subnet_id, (used_ips, total_ips) in six.iteritems(actual):
+            total_ips = str(total_ips)
+            usage = stored.get(subnet_id)
+            if usage is None:
+                context.session.add(SubnetIPUsage(subnet_id=subnet_id,
+                                                  used_ips=used_ips,
+                                                  total_ips=total_ips))
+            elif (usage.used_ips, usage.total_ips) != (used_ips, total_ips):
+                LOG.info(_LI("Repairing IP usage of subnet %(subnet_id)s: "
+                             "used %(old_used)s -> %(used)s, total "
+                             "%(old_total)s -> %(total)s"),
+                         {'subnet_id': subnet_id,
+                          'old_used': usage.used_ips, 'used': used_ips,
+                          'old_total': usage.total_ips, 'total': total_ips})
+                usage.used_ips = used_ips
+                usage.total_ips = total_ips
+            else:
+                continue
+            repaired += 1
+    return repaired
+
 
 class IpUsageMixin(object):
     """Mixin class to query for IP usage."""
 
-    data_columns = [
+    key_columns = [
         mod.Network.id.label('network_id'),
-        mod.Network.name.label('network_name'),
-        mod.Subnet.id.label('subnet_id'),
+        mod.Subnet.id.label('subnet_id')]
+
+    network_columns = [
+        mod.Network.name.label('network_name')]
+
+    subnet_columns = [
         mod.Subnet.name.label('subnet_name'),
         mod.Subnet.ip_version,
-        mod.Subnet.cidr,
-        mod.IPAllocationPool.first_ip.label('first_ip'),
-        mod.IPAllocationPool.last_ip.label('last_ip')]
+        mod.Subnet.cidr]
 
-    computed_columns = [
-        func.count(mod.IPAllocation.subnet_id).label('used_ips')]
+    counter_columns = [
+        SubnetIPUsage.used_ips,
+        SubnetIPUsage.total_ips]
 
     @classmethod
-    def get_network_ip_allocations(cls, context, filters=None):
+    def get_network_ip_allocations(cls, context, filters=None, fields=None,
+                                   sorts=None, limit=None, marker_obj=None,
+                                   page_reverse=False):
         """Get IP usage stats on a per subnet basis.
 
         Returns a list of network summaries which internally contains a list
         of subnet summaries. The used_ip and total_ip counts are returned at
         both levels.
+
+        Sorting and pagination apply to networks. Only the columns needed
+        for the requested fields are selected.
         """
-        query = cls._build_query(context, filters)
+        cls._validate_usage_query(filters, sorts)
+        usage_sorts = [s for s in sorts or [] if s[0] in USAGE_SORT_KEYS]
+        if fields and sorts:
+            # Sort keys are needed to sort, even if not requested
+            fields = list(fields) + [s[0] for s in sorts]
+
+        query = cls._build_query(context, filters, fields)
+        network_ids = None
+        if limit:
+            network_ids = cls._get_network_page(context, filters, sorts,
+                                                limit, marker_obj,
+                                                page_reverse)
+            if not network_ids:
+                return []
+            query = query.filter(mod.Network.id.in_(network_ids))
+        elif sorts and not usage_sorts:
+            query = sqlalchemyutils.paginate_query(query, mod.Network, None,
+                                                   sorts)
         LOG.debug('Usage query generated: %s', query)
+        rows = query.all()
+        usages = cls._get_subnet_usages(context, filters, rows)
 
         # Assemble result
-        result_dict = {}
-        for row in query.all():
-            cls._add_result(result_dict, row)
+        result_dict = collections.OrderedDict()
+        for row in rows:
+            cls._add_result(result_dict, row, usages, fields)
+        # Utilizations are computed, and networks sorted, on the exact
+        # totals, as when filtered and sorted by the database
+        exact_total_ips = cls._get_exact_total_ips(rows, usages)
+        for network in six.viewvalues(result_dict):
+            network['utilization'] = utilization(
+                network['used_ips'], exact_total_ips[network['id']])
 
         # Convert result back into the list it expects
+        if network_ids is not None:
+            return [result_dict[network_id] for network_id in network_ids
+                    if network_id in result_dict]
         net_ip_usages = list(six.viewvalues(result_dict))
+        if usage_sorts:
+            # Without a page to fetch, usage sums are known at this point
+            # and the networks are sorted here
+            for key, direction in reversed(sorts):
+                net_ip_usages.sort(
+                    key=lambda n: (n[key] is not None,
+                                   exact_total_ips[n['id']]
+                                   if key == 'total_ips' else n[key]),
+                    reverse=not direction)
         return net_ip_usages
 
+    @staticmethod
+    def _get_exact_total_ips(rows, usages):
+        """Return the uncapped total IPs of each network, by network id."""
+        total_ips = collections.Counter()
+        for row in rows:
+            if row.subnet_id:
+                total_ips[row.network_id] += usages.get(row.subnet_id,
+                                                        (0, 0))[1]
+        return total_ips
+
+    @staticmethod
+    def _validate_usage_query(filters, sorts):
+        if cfg.CONF.ip_usage_engine == COUNTERS_ENGINE:
+            return
+        keys = set(six.viewkeys(filters or {}) & THRESHOLD_FILTER_KEYS)
+        keys.update(s[0] for s in sorts or [] if s[0] in USAGE_SORT_KEYS)
+        if keys:
+            msg = _("%(keys)s require the '%(engine)s' IP usage "
+                    "engine") % {'keys': ', '.join(sorted(keys)),
+                                 'engine': COUNTERS_ENGINE}
+            raise n_exc.BadRequest(resource='network_ip_usage', msg=msg)
+
+    @classmethod
+    def _get_network_page(cls, context, filters, sorts, limit, marker_obj,
+                          page_reverse):
+        # Paginate on networks rather than on the joined subnet rows, so
+        # that the limit is not consumed by the subnets of a network
+        query = context.session.query(mod.Network.id, mod.Network.name)\
+            .outerjoin(mod.Subnet, mod.Network.id == mod.Subnet.network_id)
+        if cfg.CONF.ip_usage_engine == COUNTERS_ENGINE:
+            query = query.outerjoin(SubnetIPUsage,
+                                    mod.Subnet.id == SubnetIPUsage.subnet_id)
+        query = cls._adjust_query_for_filters(query, filters, context)
+        if page_reverse and sorts:
+            sorts = [(s[0], not s[1]) for s in sorts]
+        if any(s[0] in USAGE_SORT_KEYS for s in sorts or []):
+            query = cls._paginate_by_usage(query, limit, sorts, marker_obj)
+        else:
+            query = sqlalchemyutils.paginate_query(query.distinct(),
+                                                   mod.Network, limit,
+                                                   sorts,
+                                                   marker_obj=marker_obj)
+        network_ids = [row.id for row in query]
+        if page_reverse:
+            network_ids.reverse()
+        return network_ids
+
+    @classmethod
+    def _get_sort_expressions(cls):
+        total_ips = sa.cast(SubnetIPUsage.total_ips, sa.Numeric(40, 0))
+        used_sum = func.coalesce(func.sum(SubnetIPUsage.used_ips), 0)
+        total_sum = func.coalesce(func.sum(total_ips), 0)
+        return {
+            'id': mod.Network.id,
+            'name': mod.Network.name,
+            'used_ips': used_sum,
+            'total_ips': total_sum,
+            'utilization': func.coalesce(
+                sa.literal(100.0, sa.Float) * used_sum /
+                func.nullif(total_sum, 0), 0),
+        }
+
     @classmethod
-    def _build_query(cls, context, filters):
+    def _paginate_by_usage(cls, query, limit, sorts, marker_obj):
+        """Sort and paginate networks on their summed usage counters.
+
+        This follows sqlalchemyutils.paginate_query, but the sort keys are
+        aggregates of the network subnets, so networks are grouped and the
+        marker criteria go to the HAVING clause. The sort values of the
+        marker network are read with the same query.
+        """
+        sort_exprs = cls._get_sort_expressions()
+        query = query.group_by(mod.Network.id, mod.Network.name)
+        if marker_obj:
+            marker_values = query.with_entities(
+                *[sort_exprs[key] for key, _dir in sorts]).filter(
+                    mod.Network.id == marker_obj.id).first()
+            if marker_values is None:
+                # The marker does not match the filters anymore
+                return []
+            criteria_list = []
+            for i, (key, direction) in enumerate(sorts):
+                crit_attrs = [sort_exprs[sorts[j][0]] == marker_values[j]
+                              for j in moves.range(i)]
+                if direction:
+                    crit_attrs.append(sort_exprs[key] > marker_values[i])
+                else:
+                    crit_attrs.append(sort_exprs[key] < marker_values[i])
+                criteria_list.append(sa.and_(*crit_attrs))
+            query = query.having(sa.or_(*criteria_list))
+        for key, direction in sorts:
+            sort_dir_func = sa.asc if direction else sa.desc
+            query = query.order_by(sort_dir_func(sort_exprs[key]))
+        return query.limit(limit)
+
+    @staticmethod
+    def _is_selected(field, fields):
+        return not fields or field in fields
+
+    @classmethod
+    def _build_query(cls, context, filters, fields=None):
         # Generate a query to gather all information.
         # Ensure query is tolerant of missing child table data (outerjoins)
         # Process these outerjoin columns assuming their values may be None
+        columns = list(cls.key_columns)
+        if cls._is_selected('name', fields):
+            columns.extend(cls.network_columns)
+        if cls._is_selected('subnet_ip_allocations', fields):
+            columns.extend(cls.subnet_columns)
+        elif cfg.CONF.ip_usage_engine == LIVE_ENGINE:
+            # Subnets without pools are accounted for by their CIDR
+            columns.append(mod.Subnet.cidr)
+
         query = context.session.query()\
-            .add_columns(*cls.data_columns)\
-            .add_columns(*cls.computed_columns)\
-            .outerjoin(mod.Subnet, mod.Network.id == mod.Subnet.network_id,)\
-            .outerjoin(mod.IPAllocation,
-                       mod.Subnet.id == mod.IPAllocation.subnet_id)\
-            .outerjoin(mod.IPAllocationPool,
-                       mod.Subnet.id == mod.IPAllocationPool.subnet_id)\
-            .group_by(*cls.data_columns)
+            .add_columns(*columns)\
+            .outerjoin(mod.Subnet, mod.Network.id == mod.Subnet.network_id,)
+        if cfg.CONF.ip_usage_engine == COUNTERS_ENGINE:
+            query = query.add_columns(*cls.counter_columns)\
+                .outerjoin(SubnetIPUsage,
+                           mod.Subnet.id == SubnetIPUsage.subnet_id)
 
         # Apply filters directly to query (if applicable)
-        return cls._adjust_query_for_filters(query, filters)
+        return cls._adjust_query_for_filters(query, filters, context)
+
+    @classmethod
+    def _get_subnet_usages(cls, context, filters, rows):
+        """Return (used_ips, total_ips) for each subnet of the result rows.
+
+        The totals are exact, the cap only applies to the reported ones.
+        """
+        if cfg.CONF.ip_usage_engine == LIVE_ENGINE:
+            # Aggregate allocations and pools of the matched subnets in two
+            # separate queries and merge them here. Joining both tables in
+            # one statement would multiply allocations by pools.
+            subnet_ids = cls._adjust_query_for_filters(
+                context.session.query(mod.Subnet.id).join(
+                    mod.Network, mod.Network.id == mod.Subnet.network_id),
+                filters, context).subquery()
+            used = count_used_ips(context, subnet_ids)
+            pools = get_pool_ranges(context, subnet_ids)
+            return {row.subnet_id: (
+                used.get(row.subnet_id, 0),
+                subnet_total_ips(row.cidr, pools.get(row.subnet_id)))
+                for row in rows if row.subnet_id}
+
+        usages = {row.subnet_id: (row.used_ips, int(row.total_ips))
+                  for row in rows if row.total_ips is not None}
+        # Subnets created before the counters existed have no usage row yet
+        missing = [row.subnet_id for row in rows
+                   if row.subnet_id and row.total_ips is None]
+        if missing:
+            LOG.debug('Counting IP usage of %d subnets without counters',
+                      len(missing))
+            usages.update(count_subnet_ip_usages(context, missing))
+        return usages
 
     @classmethod
-    def _adjust_query_for_filters(cls, query, filters):
+    def _adjust_query_for_filters(cls, query, filters, context=None):
+        filters = filters or {}
         # The intersect of sets gets us applicable filter keys
         common_keys = six.viewkeys(filters) & SUPPORTED_FILTER_KEYS
         for key in common_keys:
-            # TODO(wwriverrat) consider 'or' when we get more than one in list
-            # Example: (network_id='xxxx' or network_id='yyyy')
             filter_vals = filters[key]
-            single_val = None
-            if isinstance(filter_vals, list) and len(filter_vals) >= 1:
-                single_val = filter_vals[0]
-            elif isinstance(filter_vals, six.string_types):
-                single_val = filter_vals
-
-            if single_val:
+            if isinstance(filter_vals, six.string_types):
+                filter_vals = [filter_vals]
+            if filter_vals:
                 query = query.filter(
-                    SUPPORTED_FILTERS[key] == single_val)
+                    SUPPORTED_FILTERS[key].in_(filter_vals))
+
+        query = cls._adjust_query_for_thresholds(query, filters)
+
+        for key in six.viewkeys(filters) & BOOLEAN_FILTER_KEYS:
+            filter_vals = filters[key]
+            if not isinstance(filter_vals, list):
+                filter_vals = [filter_vals]
+            filter_vals = set(attributes.convert_to_boolean(val)
+                              for val in filter_vals)
+            # Asking for both True and False does not filter anything
+            if len(filter_vals) != 1:
+                continue
+            matching_ids = cls._get_boolean_filter_subquery(key, context)
+            if filter_vals.pop():
+                query = query.filter(mod.Network.id.in_(matching_ids))
+            else:
+                query = query.filter(~mod.Network.id.in_(matching_ids))
         return query
 
+    @staticmethod
+    def _get_threshold(filters, key, convert_to, select):
+        filter_vals = filters.get(key)
+        if not filter_vals:
+            return None
+        if not isinstance(filter_vals, list):
+            filter_vals = [filter_vals]
+        try:
+            # Several values of a threshold must all be satisfied
+            return select(convert_to(val) for val in filter_vals)
+        except (TypeError, ValueError):
+            msg = _("'%(value)s' is not a valid value for %(key)s") % {
+                'value': filter_vals, 'key': key}
+            raise n_exc.InvalidInput(error_message=msg)
+
     @classmethod
-    def _add_result(cls, result_dict, db_row):
+    def _adjust_query_for_thresholds(cls, query, filters):
+        # Thresholds apply to the subnets; they are evaluated on the usage
+        # counters, which the query must be joined with
+        total_ips = sa.cast(SubnetIPUsage.total_ips, sa.Numeric(40, 0))
+        min_utilization = cls._get_threshold(filters, 'min_utilization',
+                                             float, max)
+        if min_utilization is not None:
+            query = query.filter(SubnetIPUsage.used_ips * 100 >=
+                                 total_ips * min_utilization)
+        max_free_ips = cls._get_threshold(filters, 'max_free_ips', int, min)
+        if max_free_ips is not None:
+            query = query.filter(total_ips - SubnetIPUsage.used_ips <=
+                                 max_free_ips)
+        return query
+
+    @staticmethod
+    def _get_boolean_filter_subquery(key, context):
+        # Return the ids of the networks for which the filter key is true
+        if key == external_net.EXTERNAL:
+            return sa.select([EXTERNAL_NETWORKS.c.network_id])
+        rbac = rbac_db_models.NetworkRBAC
+        matches = [rbac.target_tenant == '*']
+        if context:
+            matches.append(rbac.target_tenant == context.tenant_id)
+        return sa.select([rbac.object_id]).where(
+            sa.and_(rbac.action == 'access_as_shared', sa.or_(*matches)))
+
+    @classmethod
+    def _add_result(cls, result_dict, db_row, usages, fields=None):
         # Find network in results. Create and add if missing
         if db_row.network_id in result_dict:
             network = result_dict[db_row.network_id]
         else:
-            network = {'id': db_row.network_id, 'name': db_row.network_name,
+            network = {'id': db_row.network_id,
                        'subnet_ip_allocations': [], 'used_ips': 0,
                        'total_ips': 0}
+            if cls._is_selected('name', fields):
+                network['name'] = db_row.network_name
             result_dict[db_row.network_id] = network
 
         # Skip rows without subnet data
         if not db_row.subnet_id:
             return
 
-        cls._add_subnet_data_to_net(db_row, network)
+        cls._add_subnet_data_to_net(db_row, network, usages, fields)
 
     @classmethod
-    def _add_subnet_data_to_net(cls, db_row, network):
-        # Note: This method must assume db_row may not have subnet or
-        # IPAllocationsPool information (i.e. value = None)
+    def _add_subnet_data_to_net(cls, db_row, network, usages, fields=None):
+        # Note: This method must assume db_row may not have subnet
+        # information (i.e. value = None)
 
         # Skip rows without subnet data
         if not db_row.subnet_id:
             return
 
-        subnet = {
-            'subnet_id': db_row.subnet_id,
-            'ip_version': db_row.ip_version,
-            'cidr': db_row.cidr,
-            'name': db_row.subnet_name,
-            'used_ips': db_row.used_ips if db_row.used_ips else 0
-        }
-        # Handle missing IPAllocationPool data
-        if db_row.last_ip:
-            total_ips = netaddr.IPRange(netaddr.IPAddress(db_row.first_ip),
-                                        netaddr.IPAddress(db_row.last_ip)).size
-        else:
-            total_ips = netaddr.IPNetwork(db_row.cidr,
-                                          version=db_row.ip_version).size
-        subnet['total_ips'] = total_ips
+        used_ips, exact_total_ips = usages.get(db_row.subnet_id, (0, 0))
+        total_ips = reported_total_ips(exact_total_ips)
 
         # Attach subnet result and Rollup subnet sums into the parent
-        network['subnet_ip_allocations'].append(subnet)
+        if cls._is_selected('subnet_ip_allocations', fields):
+            subnet = {
+                'subnet_id': db_row.subnet_id,
+                'ip_version': db_row.ip_version,
+                'cidr': db_row.cidr,
+                'name': db_row.subnet_name,
+                'used_ips': used_ips,
+                'total_ips': total_ips,
+                'utilization': utilization(used_ips, exact_total_ips)
+            }
+            network['subnet_ip_allocations'].append(subnet)
         network['total_ips'] += total_ips
-        network['used_ips'] += subnet['used_ips']
+        network['used_ips'] += used_ips
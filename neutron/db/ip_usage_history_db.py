@@ -0,0 +1,263 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import calendar
+import collections
+import datetime
+
+from oslo_config import cfg
+from oslo_db import exception as db_exc
+from oslo_log import log as logging
+from oslo_utils import timeutils
+import sqlalchemy as sa
+
+from neutron._i18n import _, _LI
+from neutron.db import ip_usage_db
+from neutron.db import model_base
+from neutron.db import models_v2
+
+LOG = logging.getLogger(__name__)
+
+RESOLUTIONS = (RAW, HOURLY, DAILY) = ('raw', 'hourly', 'daily')
+
+IP_USAGE_HISTORY_OPTS = [
+    cfg.IntOpt('ip_usage_snapshot_interval',
+               default=0,
+               min=0,
+               help=_("Seconds between two snapshots of the IP usage of "
+                      "every subnet, kept as usage history. 0 disables "
+                      "the snapshots.")),
+    cfg.IntOpt('ip_usage_history_raw_retention',
+               default=48,
+               min=1,
+               help=_("Hours during which every IP usage snapshot is kept. "
+                      "Older snapshots are downsampled to one per hour.")),
+    cfg.IntOpt('ip_usage_history_hourly_retention',
+               default=30,
+               min=1,
+               help=_("Days during which hourly IP usage samples are kept. "
+                      "Older samples are downsampled to one per day.")),
+    cfg.IntOpt('ip_usage_history_daily_retention',
+               default=365,
+               min=1,
+               help=_("Days during which daily IP usage samples are kept.")),
+]
+cfg.CONF.register_opts(IP_USAGE_HISTORY_OPTS)
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+
+class SubnetIPUsageSample(model_base.BASEV2):
+    """Represents the IP usage of a subnet at a point in time.
+
+    Samples are taken with the resolution of the snapshot interval, then
+    downsampled to hourly and daily samples as they age.
+    """
+
+    subnet_id = sa.Column(sa.String(36),
+                          sa.ForeignKey('subnets.id', ondelete="CASCADE"),
+                          primary_key=True)
+    resolution = sa.Column(sa.Enum(*RESOLUTIONS,
+                                   name='ipusage_sample_resolutions'),
+                           primary_key=True)
+    timestamp = sa.Column(sa.DateTime, primary_key=True)
+    used_ips = sa.Column(sa.BigInteger, nullable=False)
+    # NOTE: see SubnetIPUsage.total_ips
+    total_ips = sa.Column(sa.String(40), nullable=False)
+
+
+def _truncate(timestamp, seconds):
+    """Round timestamp down to a multiple of seconds since the epoch."""
+    epoch = calendar.timegm(timestamp.timetuple())
+    return datetime.datetime.utcfromtimestamp(epoch - epoch % seconds)
+
+
+def snapshot_subnet_ip_usages(context, now=None):
+    """Record a raw usage sample for every subnet.
+
+    The timestamp of the samples is rounded down to the snapshot interval,
+    so that servers racing to take the same snapshot store it only once.
+    Returns the number of samples recorded.
+    """
+    interval = cfg.CONF.ip_usage_snapshot_interval or HOUR
+    timestamp = _truncate(now or timeutils.utcnow(), interval)
+    session = context.session
+    with session.begin(subtransactions=True):
+        if session.query(SubnetIPUsageSample).filter_by(
+                resolution=RAW, timestamp=timestamp).first():
+            return 0
+        query = session.query(
+            models_v2.Subnet.id,
+            ip_usage_db.SubnetIPUsage.used_ips,
+            ip_usage_db.SubnetIPUsage.total_ips).outerjoin(
+                ip_usage_db.SubnetIPUsage)
+        usages = {}
+        missing = []
+        for subnet_id, used_ips, total_ips in query:
+            if total_ips is None:
+                missing.append(subnet_id)
+            else:
+                usages[subnet_id] = (used_ips, total_ips)
+        if missing:
+            usages.update(ip_usage_db.count_subnet_ip_usages(context,
+                                                             missing))
+        samples = [{'subnet_id': subnet_id, 'resolution': RAW,
+                    'timestamp': timestamp, 'used_ips': used_ips,
+                    'total_ips': str(total_ips)}
+                   for subnet_id, (used_ips, total_ips) in usages.items()]
+        if samples:
+            session.execute(SubnetIPUsageSample.__table__.insert(), samples)
+    return len(samples)
+
+
+def _downsample(context, resolution, target, bucket, cutoff):
+    """Replace samples older than cutoff by one sample per bucket.
+
+    The last sample of each bucket is kept, stamped with the start of the
+    bucket. The cutoff is rounded down to the bucket, so that a bucket is
+    only downsampled once all of its samples are old enough.
+    """
+    cutoff = _truncate(cutoff, bucket)
+    query = context.session.query(SubnetIPUsageSample).filter(
+        SubnetIPUsageSample.resolution == resolution,
+        SubnetIPUsageSample.timestamp < cutoff)
+    buckets = collections.OrderedDict()
+    for sample in query.order_by(SubnetIPUsageSample.timestamp):
+        key = (sample.subnet_id, _truncate(sample.timestamp, bucket))
+        buckets[key] = (sample.used_ips, sample.total_ips)
+    if not buckets:
+        return 0
+    context.session.execute(
+        SubnetIPUsageSample.__table__.insert(),
+        [{'subnet_id': subnet_id, 'resolution': target,
+          'timestamp': timestamp, 'used_ips': used_ips,
+          'total_ips': total_ips}
+         for (subnet_id, timestamp), (used_ips, total_ips)
+         in buckets.items()])
+    query.delete(synchronize_session=False)
+    return len(buckets)
+
+
+def downsample_subnet_ip_usages(context, now=None):
+    """Downsample aged usage samples and expire the oldest ones."""
+    now = now or timeutils.utcnow()
+    conf = cfg.CONF
+    with context.session.begin(subtransactions=True):
+        hourly = _downsample(
+            context, RAW, HOURLY, HOUR,
+            now - datetime.timedelta(
+                hours=conf.ip_usage_history_raw_retention))
+        daily = _downsample(
+            context, HOURLY, DAILY, DAY,
+            now - datetime.timedelta(
+                days=conf.ip_usage_history_hourly_retention))
+        expired = context.session.query(SubnetIPUsageSample).filter(
+            SubnetIPUsageSample.resolution == DAILY,
+            SubnetIPUsageSample.timestamp < now - datetime.timedelta(
+                days=conf.ip_usage_history_daily_retention)).delete(
+                    synchronize_session=False)
+    if hourly or daily or expired:
+        LOG.info(_LI("Downsampled IP usage history to %(hourly)d hourly "
+                     "and %(daily)d daily samples, expired %(expired)d "
+                     "samples"),
+                 {'hourly': hourly, 'daily': daily, 'expired': expired})
+
+
+def record_subnet_ip_usages(context, now=None):
+    """Take a usage snapshot and maintain the history retention."""
+    now = now or timeutils.utcnow()
+    try:
+        recorded = snapshot_subnet_ip_usages(context, now)
+    except db_exc.DBDuplicateEntry:
+        # Another server took this snapshot concurrently
+        recorded = 0
+    downsample_subnet_ip_usages(context, now)
+    return recorded
+
+
+def project_exhaustion(samples):
+    """Project when a subnet runs out of IPs, from its usage samples.
+
+    Used IPs are fitted to a line by least squares; the projection is where
+    the line reaches the latest total. None is returned when usage does not
+    grow.
+
+    :param samples: (timestamp, used_ips, total_ips) tuples, oldest first.
+    """
+    if len(samples) < 2:
+        return None
+    origin = samples[0][0]
+    points = [((timestamp - origin).total_seconds(), used_ips)
+              for timestamp, used_ips, _total in samples]
+    mean_x = sum(x for x, _y in points) / float(len(points))
+    mean_y = sum(y for _x, y in points) / float(len(points))
+    variance = sum((x - mean_x) ** 2 for x, _y in points)
+    if not variance:
+        return None
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+    if slope <= 0:
+        return None
+    total_ips = samples[-1][2]
+    seconds = mean_x + (total_ips - mean_y) / slope
+    try:
+        return origin + datetime.timedelta(seconds=int(round(seconds)))
+    except OverflowError:
+        # Not within any foreseeable future
+        return None
+
+
+class IpUsageHistoryMixin(object):
+    """Mixin class to query the IP usage history of networks."""
+
+    @staticmethod
+    def _make_history_dict(subnet_id, samples):
+        exhaustion_date = project_exhaustion(samples)
+        return {
+            'id': subnet_id,
+            'samples': [{'timestamp': timestamp.isoformat(),
+                         'used_ips': used_ips,
+                         'total_ips': total_ips}
+                        for timestamp, used_ips, total_ips in samples],
+            'exhaustion_date': (exhaustion_date and
+                                exhaustion_date.isoformat()),
+        }
+
+    def get_ip_usage_histories(self, context, network_id, subnet_id=None,
+                               filters=None):
+        """Return the usage samples of the subnets of a network.
+
+        Samples of all resolutions are merged in chronological order, unless
+        the 'resolution' filter restricts them.
+        """
+        query = context.session.query(
+            SubnetIPUsageSample.subnet_id,
+            SubnetIPUsageSample.timestamp,
+            SubnetIPUsageSample.used_ips,
+            SubnetIPUsageSample.total_ips).join(
+                models_v2.Subnet,
+                models_v2.Subnet.id == SubnetIPUsageSample.subnet_id).filter(
+                    models_v2.Subnet.network_id == network_id)
+        if subnet_id:
+            query = query.filter(models_v2.Subnet.id == subnet_id)
+        resolutions = (filters or {}).get('resolution')
+        if resolutions:
+            query = query.filter(
+                SubnetIPUsageSample.resolution.in_(resolutions))
+        histories = collections.OrderedDict()
+        for sample in query.order_by(SubnetIPUsageSample.subnet_id,
+                                     SubnetIPUsageSample.timestamp):
+            histories.setdefault(sample.subnet_id, []).append(
+                (sample.timestamp, sample.used_ips, int(sample.total_ips)))
+        return [self._make_history_dict(subnet_id, samples)
+                for subnet_id, samples in histories.items()]
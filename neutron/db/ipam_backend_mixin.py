@@ -20,6 +20,7 @@ import netaddr
 from oslo_config import cfg
 from oslo_db import exception as db_exc
 from oslo_log import log as logging
+from sqlalchemy import func
 from sqlalchemy.orm import exc as orm_exc
 
 from neutron._i18n import _, _LI
@@ -29,6 +30,7 @@ from neutron.common import exceptions as n_exc
 from neutron.common import ipv6_utils
 from neutron.common import utils as common_utils
 from neutron.db import db_base_plugin_common
+from neutron.db import ip_usage_db
 from neutron.db import models_v2
 from neutron.ipam import utils as ipam_utils
 
@@ -168,6 +170,8 @@ class IpamBackendMixin(db_base_plugin_common.DbBasePluginCommon):
                                                 subnet_id=subnet_id)
                      for p in pools]
         context.session.add_all(new_pools)
+        ip_usage_db.update_subnet_total_ips(context, subnet_id, s['cidr'],
+                                            s['allocation_pools'])
         # Call static method with self to redefine in child
         # (non-pluggable backend)
         if not ipv6_utils.is_ipv6_pd_enabled(s):
@@ -414,6 +418,16 @@ class IpamBackendMixin(db_base_plugin_common.DbBasePluginCommon):
                             original=prev_ips,
                             remove=remove_ips)
 
+    def allocate_ips_for_ports_and_store(self, context, ports):
+        """Allocate and store the IP addresses of several ports.
+
+        :param ports: list of (port, port_id) tuples, port being the body of
+            a port create request.
+        :returns: the list of IP addresses allocated to each port.
+        """
+        return [self.allocate_ips_for_port_and_store(context, port, port_id)
+                for port, port_id in ports]
+
     def delete_port(self, context, port_id):
         query = (context.session.query(models_v2.Port).
                  enable_eagerloads(False).filter_by(id=port_id))
@@ -422,8 +436,19 @@ class IpamBackendMixin(db_base_plugin_common.DbBasePluginCommon):
         # Use of the ORM mapper is needed for ensuring appropriate resource
         # tracking; otherwise SQL Alchemy events won't be triggered.
         # For more info check 'caveats' in doc/source/devref/quota.rst
+        port = query.first()
+        if port:
+            # The IP allocations of the port go away through the foreign key
+            # cascade, so release them from the usage counters explicitly
+            allocations = (context.session.query(
+                models_v2.IPAllocation.subnet_id,
+                func.count(models_v2.IPAllocation.ip_address)).
+                filter_by(port_id=port_id).
+                group_by(models_v2.IPAllocation.subnet_id))
+            for subnet_id, count in allocations:
+                ip_usage_db.adjust_subnet_used_ips(context, subnet_id, -count)
         try:
-            context.session.delete(query.first())
+            context.session.delete(port)
         except orm_exc.UnmappedInstanceError:
             LOG.debug("Port %s was not found and therefore no delete "
                       "operation was performed", port_id)
@@ -461,5 +486,7 @@ class IpamBackendMixin(db_base_plugin_common.DbBasePluginCommon):
 
         self.save_allocation_pools(context, subnet,
                                    subnet_request.allocation_pools)
+        ip_usage_db.create_subnet_ip_usage(context, subnet,
+                                           subnet_request.allocation_pools)
 
         return subnet
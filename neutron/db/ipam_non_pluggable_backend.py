@@ -25,10 +25,12 @@ from neutron.api.v2 import attributes
 from neutron.common import constants
 from neutron.common import exceptions as n_exc
 from neutron.common import ipv6_utils
+from neutron.db import ip_usage_db
 from neutron.db import ipam_backend_mixin
 from neutron.db import models_v2
 from neutron.ipam import requests as ipam_req
 from neutron.ipam import subnet_alloc
+from neutron.ipam import utils as ipam_utils
 
 LOG = logging.getLogger(__name__)
 
@@ -93,47 +95,42 @@ class IpamNonPluggableBackend(ipam_backend_mixin.IpamBackendMixin):
         which will result in deleting the IPAvailabilityRange too.
         """
         ip_qry = context.session.query(
-            models_v2.IPAllocation).with_lockmode('update')
+            models_v2.IPAllocation.ip_address).with_lockmode('update')
         # PostgreSQL does not support select...for update with an outer join.
         # No join is needed here.
         pool_qry = context.session.query(
             models_v2.IPAllocationPool).options(
                 orm.noload('available_ranges')).with_lockmode('update')
+        available_ranges = []
         for subnet in sorted(subnets):
             LOG.debug("Rebuilding availability ranges for subnet %s",
                       subnet)
 
-            # Create a set of all currently allocated addresses
-            ip_qry_results = ip_qry.filter_by(subnet_id=subnet['id'])
-            allocations = netaddr.IPSet([netaddr.IPAddress(i['ip_address'])
-                                        for i in ip_qry_results])
+            # Sorted integer values of the currently allocated addresses,
+            # fetched in batches
+            allocations = sorted(
+                ipam_utils.ip_to_int(ip_address) for ip_address, in
+                ip_qry.filter_by(subnet_id=subnet['id']).yield_per(
+                    ipam_utils.REBUILD_BATCH_SIZE))
 
             for pool in pool_qry.filter_by(subnet_id=subnet['id']):
-                # Create a set of all addresses in the pool
-                poolset = netaddr.IPSet(netaddr.IPRange(pool['first_ip'],
-                                                        pool['last_ip']))
-
-                # Use set difference to find free addresses in the pool
-                available = poolset - allocations
-
-                # Generator compacts an ip set into contiguous ranges
-                def ipset_to_ranges(ipset):
-                    first, last = None, None
-                    for cidr in ipset.iter_cidrs():
-                        if last and last + 1 != cidr.first:
-                            yield netaddr.IPRange(first, last)
-                            first = None
-                        first, last = first if first else cidr.first, cidr.last
-                    if first:
-                        yield netaddr.IPRange(first, last)
-
-                # Write the ranges to the db
-                for ip_range in ipset_to_ranges(available):
-                    available_range = models_v2.IPAvailabilityRange(
-                        allocation_pool_id=pool['id'],
-                        first_ip=str(netaddr.IPAddress(ip_range.first)),
-                        last_ip=str(netaddr.IPAddress(ip_range.last)))
-                    context.session.add(available_range)
+                # Walk the pool once to find the free ranges
+                for first, last in ipam_utils.iter_free_ranges(
+                        ipam_utils.ip_to_int(pool['first_ip']),
+                        ipam_utils.ip_to_int(pool['last_ip']),
+                        allocations):
+                    available_ranges.append({
+                        'allocation_pool_id': pool['id'],
+                        'first_ip': str(netaddr.IPAddress(
+                            first, subnet['ip_version'])),
+                        'last_ip': str(netaddr.IPAddress(
+                            last, subnet['ip_version']))})
+
+        # Write the ranges to the db at once
+        if available_ranges:
+            context.session.execute(
+                models_v2.IPAvailabilityRange.__table__.insert(),
+                available_ranges)
 
     @staticmethod
     def _allocate_specific_ip(context, subnet_id, ip_address):
@@ -419,6 +416,8 @@ class IpamNonPluggableBackend(ipam_backend_mixin.IpamBackendMixin):
                     # the corresponding port has been deleted.
                     with context.session.begin_nested():
                         context.session.add(allocated)
+                        ip_usage_db.adjust_subnet_used_ips(
+                            context, subnet['id'], 1)
                 except db_exc.DBReferenceError:
                     LOG.debug("Port %s was deleted while updating it with an "
                               "IPv6 auto-address. Ignoring.", port['id'])
@@ -13,6 +13,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+
 import netaddr
 from oslo_db import exception as db_exc
 from oslo_log import log as logging
@@ -24,6 +26,7 @@ from neutron.api.v2 import attributes
 from neutron.common import constants
 from neutron.common import exceptions as n_exc
 from neutron.common import ipv6_utils
+from neutron.db import ip_usage_db
 from neutron.db import ipam_backend_mixin
 from neutron.db import models_v2
 from neutron.ipam import driver
@@ -171,6 +174,105 @@ class IpamPluggableBackend(ipam_backend_mixin.IpamBackendMixin):
                                               port['port'], ips,
                                               revert_on_fail=False)
 
+    def _ipam_bulk_allocate_ips(self, context, ipam_driver, ports,
+                                ips_by_port):
+        """Allocate the IPs of several ports over IPAM.
+
+        The IPs requested on each subnet by all the ports are allocated with
+        a single bulk_allocate call on the IPAM subnet. IPs which may come
+        from any of several subnets are allocated one at a time. If any
+        allocation fails, all the allocated IPs are deallocated.
+
+        :param ports: list of port dicts.
+        :param ips_by_port: list of the IPs to allocate for each port, as
+            for _ipam_allocate_ips.
+        :returns: list of the IPs allocated to each port.
+        """
+        factory = ipam_driver.get_address_request_factory()
+        requests_by_subnet = collections.OrderedDict()
+        multi_subnet_ips = []
+        for index, (port, ips) in enumerate(zip(ports, ips_by_port)):
+            for ip in ips:
+                if isinstance(ip, list) and len(ip) == 1:
+                    ip = ip[0]
+                if isinstance(ip, dict):
+                    requests_by_subnet.setdefault(ip['subnet_id'], []).append(
+                        (index, factory.get_request(context, port, ip)))
+                else:
+                    multi_subnet_ips.append((index, ip))
+
+        allocated = [[] for port in ports]
+        try:
+            for subnet_id, requests in requests_by_subnet.items():
+                ipam_subnet = ipam_driver.get_subnet(subnet_id)
+                ip_addresses = ipam_subnet.bulk_allocate(
+                    [ip_request for index, ip_request in requests])
+                for (index, ip_request), ip_address in zip(requests,
+                                                           ip_addresses):
+                    allocated[index].append({'ip_address': ip_address,
+                                             'subnet_id': subnet_id})
+            for index, ip_list in multi_subnet_ips:
+                ip_address, ip_subnet = self._ipam_allocate_single_ip(
+                    context, ipam_driver, ports[index], ip_list)
+                allocated[index].append({'ip_address': ip_address,
+                                         'subnet_id': ip_subnet['subnet_id']})
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                LOG.debug("An exception occurred during IP allocation. "
+                          "Reverting allocation")
+                for port, ips in zip(ports, allocated):
+                    if ips:
+                        self._ipam_deallocate_ips(context, ipam_driver, port,
+                                                  ips, revert_on_fail=False)
+        return allocated
+
+    def allocate_ips_for_ports_and_store(self, context, ports):
+        """Allocate and store the IP addresses of several ports.
+
+        The subnets of each network are fetched once, the IPs of all ports
+        are allocated subnet by subnet, and the used IPs counter of each
+        subnet is adjusted once.
+        """
+        ipam_driver = driver.Pool.get_instance(None, context)
+        port_dicts = [port['port'] for port, port_id in ports]
+        subnets_by_network = {}
+        ips_by_port = []
+        for p in port_dicts:
+            network_id = p['network_id']
+            if network_id not in subnets_by_network:
+                subnets_by_network[network_id] = self._get_subnets(
+                    context, filters={'network_id': [network_id]})
+            ips_by_port.append(self._get_ips_to_allocate_for_port(
+                context, p, subnets_by_network[network_id]))
+
+        allocated = self._ipam_bulk_allocate_ips(context, ipam_driver,
+                                                 port_dicts, ips_by_port)
+        try:
+            ip_allocations = []
+            for p, (port, port_id), ips in zip(port_dicts, ports, allocated):
+                for ip in ips:
+                    ip_allocations.append(models_v2.IPAllocation(
+                        network_id=p['network_id'],
+                        port_id=port_id,
+                        ip_address=ip['ip_address'],
+                        subnet_id=ip['subnet_id']))
+            context.session.add_all(ip_allocations)
+            used_ips = collections.Counter(ip.subnet_id
+                                           for ip in ip_allocations)
+            for subnet_id, count in used_ips.items():
+                ip_usage_db.adjust_subnet_used_ips(context, subnet_id, count)
+            LOG.debug("Allocated %(count)d IPs for %(ports)d ports",
+                      {'count': len(ip_allocations), 'ports': len(ports)})
+            return allocated
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                LOG.debug("An exception occurred during port creation. "
+                          "Reverting IP allocation")
+                for p, ips in zip(port_dicts, allocated):
+                    if ips:
+                        self._ipam_deallocate_ips(context, ipam_driver, p,
+                                                  ips, revert_on_fail=False)
+
     def _allocate_ips_for_port(self, context, port):
         """Allocate IP addresses for the port. IPAM version.
 
@@ -179,10 +281,20 @@ class IpamPluggableBackend(ipam_backend_mixin.IpamBackendMixin):
         a subnet_id then allocate an IP address accordingly.
         """
         p = port['port']
-        ips = []
-        v6_stateless = []
         net_id_filter = {'network_id': [p['network_id']]}
         subnets = self._get_subnets(context, filters=net_id_filter)
+        ips = self._get_ips_to_allocate_for_port(context, p, subnets)
+        ipam_driver = driver.Pool.get_instance(None, context)
+        return self._ipam_allocate_ips(context, ipam_driver, p, ips)
+
+    def _get_ips_to_allocate_for_port(self, context, p, subnets):
+        """Return the IPs to allocate for a port, as for _ipam_allocate_ips.
+
+        :param p: the port attributes.
+        :param subnets: the subnets of the network of the port.
+        """
+        ips = []
+        v6_stateless = []
         is_router_port = (
             p['device_owner'] in constants.ROUTER_INTERFACE_OWNERS_SNAT)
 
@@ -224,8 +336,7 @@ class IpamPluggableBackend(ipam_backend_mixin.IpamBackendMixin):
                         'subnet_cidr': subnet['cidr'],
                         'eui64_address': True,
                         'mac': p['mac_address']})
-        ipam_driver = driver.Pool.get_instance(None, context)
-        return self._ipam_allocate_ips(context, ipam_driver, p, ips)
+        return ips
 
     def _test_fixed_ips_for_port(self, context, network_id, fixed_ips,
                                  device_owner):
@@ -394,6 +505,8 @@ class IpamPluggableBackend(ipam_backend_mixin.IpamBackendMixin):
                     # the corresponding port has been deleted.
                     with context.session.begin_nested():
                         context.session.add(allocated)
+                        ip_usage_db.adjust_subnet_used_ips(
+                            context, subnet['id'], 1)
                 except db_exc.DBReferenceError:
                     LOG.debug("Port %s was deleted while updating it with an "
                               "IPv6 auto-address. Ignoring.", port['id'])
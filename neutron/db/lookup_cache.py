@@ -0,0 +1,103 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Cache of the lookups made by a request in a database transaction.
+
+The plugins look up the same networks and subnets many times while
+handling a single request, each time with a query. The results of such
+lookups are cached for the transaction they are made in, and tagged with
+(table name, column name, value) tuples designating the rows they were
+read from. A result is dropped when a row it is tagged with is inserted,
+deleted or has the tagged column changed in the session, whether the
+change is still pending or already flushed.
+"""
+
+import collections
+
+import sqlalchemy as sa
+from sqlalchemy import event
+
+
+def _instance_tags(instance, deleted=False, changed_only=False):
+    """Yield the tags of the rows an instance change may affect."""
+    state = sa.inspect(instance)
+    mapper = state.mapper
+    table = mapper.local_table
+    if deleted:
+        for column, value in zip(mapper.primary_key, state.identity or ()):
+            yield table.name, column.name, value
+    for prop in mapper.column_attrs:
+        column = prop.columns[0]
+        if column.table is not table or not column.foreign_keys:
+            continue
+        history = state.attrs[prop.key].history
+        if changed_only and not history.has_changes():
+            continue
+        for value in history.sum():
+            yield table.name, column.name, value
+
+
+class LookupCache(object):
+    """Results of the lookups made in the transaction of a session.
+
+    Lookups made outside of a transaction are not cached, and all results
+    are dropped when the transaction, or one of its subtransactions, ends,
+    as well as after bulk updates and deletions.
+    """
+
+    def __init__(self, session):
+        self._session = session
+        self._entries = {}
+        self._keys_by_tag = collections.defaultdict(set)
+        event.listen(session, 'after_flush', self._after_flush)
+        for name in ('after_commit', 'after_soft_rollback',
+                     'after_bulk_update', 'after_bulk_delete'):
+            event.listen(session, name, self.clear)
+
+    def lookup(self, key, tags, func):
+        """Return the result of func(), cached under key with tags."""
+        session = self._session
+        if session.transaction is None:
+            return func()
+        self._invalidate(session.new, session.deleted, session.dirty)
+        try:
+            return self._entries[key]
+        except KeyError:
+            pass
+        result = func()
+        self._entries[key] = result
+        for tag in tags:
+            self._keys_by_tag[tag].add(key)
+        return result
+
+    def clear(self, *args):
+        self._entries.clear()
+        self._keys_by_tag.clear()
+
+    def _after_flush(self, session, flush_context):
+        # The new, deleted and dirty instances are still those flushed
+        self._invalidate(session.new, session.deleted, session.dirty)
+
+    def _invalidate(self, new, deleted, dirty):
+        if not self._entries:
+            return
+        tags = set()
+        for instance in new:
+            tags.update(_instance_tags(instance))
+        for instance in deleted:
+            tags.update(_instance_tags(instance, deleted=True))
+        for instance in dirty:
+            tags.update(_instance_tags(instance, changed_only=True))
+        for tag in tags:
+            for key in self._keys_by_tag.pop(tag, ()):
+                self._entries.pop(key, None)
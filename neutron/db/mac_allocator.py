@@ -0,0 +1,182 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Generation of port MAC addresses avoiding known collisions.
+
+Random MAC addresses collide more and more often as a network fills the
+address space left by base_mac, and each collision costs a failed insert.
+Instead, each server process walks the address space of a network from a
+random starting point, and skips the addresses found in a bloom filter of
+the MAC addresses in use on the network.
+
+The filter is loaded from the database the first time a network is used,
+and updated with the addresses generated or found in use since. Addresses
+of ports created by other processes are missing from it until they are
+found in use, or until the filter is reloaded when full. Once generated
+addresses are found in use, the walk restarts from another random point,
+as the addresses following them were likely generated by another process
+walking the same part of the address space. Addresses of deleted ports
+remain in the filter; they are only skipped.
+"""
+
+import collections
+import hashlib
+import math
+import random
+import struct
+
+from oslo_concurrency import lockutils
+from oslo_config import cfg
+from six import moves
+
+from neutron.db import models_v2
+
+# Number of networks whose MAC addresses are tracked by this process
+MAX_NETWORKS = 1024
+# Minimal number of MAC addresses a filter is sized for
+MIN_CAPACITY = 1024
+# Rate of false positives of the filters, when full
+ERROR_RATE = 0.001
+
+# State of the networks tracked by this process, least recently used first
+_networks = collections.OrderedDict()
+
+
+class BloomFilter(object):
+    """A set of strings which may report false positives, in little memory.
+
+    :param capacity: number of strings which may be added before the rate
+        of false positives exceeds error_rate.
+    """
+
+    def __init__(self, capacity, error_rate=ERROR_RATE):
+        self.capacity = capacity
+        self.count = 0
+        self.size = max(int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self.hash_count = max(
+            int(round(float(self.size) / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    def _offsets(self, key):
+        # Double hashing out of a single digest
+        first, second = struct.unpack(
+            '>QQ', hashlib.sha1(key.encode('utf-8')).digest()[:16])
+        return ((first + i * second) % self.size
+                for i in moves.range(self.hash_count))
+
+    def add(self, key):
+        for offset in self._offsets(key):
+            self.bits[offset >> 3] |= 1 << (offset & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[offset >> 3] & (1 << (offset & 7))
+                   for offset in self._offsets(key))
+
+
+class NetworkMacs(object):
+    """MAC addresses known to be in use on a network, and the next one."""
+
+    def __init__(self, base_mac, macs_in_use):
+        octets = base_mac.split(':')
+        # Octets kept from base_mac, formatted as in utils.get_random_mac
+        fixed = 4 if octets[3] != '00' else 3
+        self.base_mac = base_mac
+        self.prefix = ':'.join('%02x' % int(octet, 16)
+                               for octet in octets[:fixed])
+        self.free_octets = 6 - fixed
+        self.space = 1 << (8 * self.free_octets)
+        self.restart()
+        self.in_use = BloomFilter(max(len(macs_in_use) * 2, MIN_CAPACITY))
+        for mac in macs_in_use:
+            self.in_use.add(mac)
+
+    def restart(self):
+        """Continue the walk from a random point of the address space."""
+        self.next_mac = random.randrange(self.space)
+
+    def _format(self, value):
+        suffix = ('%0*x' % (2 * self.free_octets, value))
+        return ':'.join([self.prefix] + [suffix[i:i + 2] for i in
+                                         moves.range(0, len(suffix), 2)])
+
+    def generate(self):
+        """Return the next MAC address not in the filter, or None."""
+        # Past the addresses in the filter and a margin for false positives,
+        # the address space is deemed exhausted
+        attempts = min(self.space, 2 * self.in_use.count + MIN_CAPACITY)
+        for i in moves.range(attempts):
+            mac = self._format(self.next_mac)
+            self.next_mac = (self.next_mac + 1) % self.space
+            if mac not in self.in_use:
+                self.in_use.add(mac)
+                return mac
+
+
+def _lock_name(network_id):
+    return 'mac-allocator-%s' % network_id
+
+
+def _load(context, network_id):
+    return NetworkMacs(
+        cfg.CONF.base_mac,
+        [mac for mac, in context.session.query(
+            models_v2.Port.mac_address).filter_by(network_id=network_id)])
+
+
+def _get_network_macs(context, network_id):
+    network_macs = _networks.pop(network_id, None)
+    if (not network_macs or network_macs.in_use.full or
+            network_macs.base_mac != cfg.CONF.base_mac):
+        network_macs = _load(context, network_id)
+    _networks[network_id] = network_macs
+    while len(_networks) > MAX_NETWORKS:
+        _networks.popitem(last=False)
+    return network_macs
+
+
+def generate_macs(context, network_id, count=1):
+    """Return MAC addresses not known to be in use on a network.
+
+    Fewer addresses are returned when the address space of the network is
+    exhausted.
+    """
+    with lockutils.lock(_lock_name(network_id)):
+        network_macs = _get_network_macs(context, network_id)
+        macs = []
+        while len(macs) < count:
+            mac = network_macs.generate()
+            if mac is None:
+                break
+            macs.append(mac)
+        return macs
+
+
+def mark_in_use(network_id, macs, generated=False):
+    """Record MAC addresses found in use on a network.
+
+    :param generated: whether the addresses were generated by
+        generate_macs, in which case the walk of the network restarts from
+        a random point.
+    """
+    with lockutils.lock(_lock_name(network_id)):
+        network_macs = _networks.get(network_id)
+        if network_macs:
+            for mac in macs:
+                network_macs.in_use.add(mac)
+            if generated and macs:
+                network_macs.restart()
@@ -0,0 +1,46 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""Add subnet IP usage samples
+
+Revision ID: 1d3f5a7c9e2b
+Revises: 3c5a1e2b9f04
+Create Date: 2016-01-19 14:02:11.815214
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1d3f5a7c9e2b'
+down_revision = '3c5a1e2b9f04'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+resolutions = sa.Enum('raw', 'hourly', 'daily',
+                      name='ipusage_sample_resolutions')
+
+
+def upgrade():
+    op.create_table(
+        'subnetipusagesamples',
+        sa.Column('subnet_id', sa.String(length=36), nullable=False),
+        sa.Column('resolution', resolutions, nullable=False),
+        sa.Column('timestamp', sa.DateTime(), nullable=False),
+        sa.Column('used_ips', sa.BigInteger(), nullable=False),
+        sa.Column('total_ips', sa.String(length=40), nullable=False),
+        sa.ForeignKeyConstraint(['subnet_id'], ['subnets.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('subnet_id', 'resolution', 'timestamp')
+    )
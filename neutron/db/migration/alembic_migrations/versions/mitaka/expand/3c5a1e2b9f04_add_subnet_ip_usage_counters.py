@@ -0,0 +1,41 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""Add subnet IP usage counters
+
+Revision ID: 3c5a1e2b9f04
+Revises: c3a73f615e4
+Create Date: 2016-01-12 10:21:35.402312
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c5a1e2b9f04'
+down_revision = 'c3a73f615e4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'subnetipusages',
+        sa.Column('subnet_id', sa.String(length=36), nullable=False),
+        sa.Column('used_ips', sa.BigInteger(), server_default='0',
+                  nullable=False),
+        sa.Column('total_ips', sa.String(length=40), nullable=False),
+        sa.ForeignKeyConstraint(['subnet_id'], ['subnets.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('subnet_id')
+    )
@@ -0,0 +1,74 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""Add subnet pool quota usages
+
+Revision ID: 3c9e1f5b7a24
+Revises: 7b2d4f6a8c31
+Create Date: 2016-02-01 10:36:12.504913
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c9e1f5b7a24'
+down_revision = '7b2d4f6a8c31'
+
+import collections
+
+from alembic import op
+import netaddr
+import sqlalchemy as sa
+
+
+# A simple model of the subnets table with only the fields needed for
+# the migration.
+subnets = sa.Table('subnets', sa.MetaData(),
+                   sa.Column('tenant_id', sa.String(length=255)),
+                   sa.Column('cidr', sa.String(length=64), nullable=False),
+                   sa.Column('subnetpool_id', sa.String(length=36)))
+
+# Subnets of this placeholder pool are not counted, it has no row
+IPV6_PD_POOL_ID = 'prefix_delegation'
+
+
+def upgrade():
+    quota_usages = op.create_table(
+        'subnetpoolquotausages',
+        sa.Column('subnetpool_id', sa.String(length=36), nullable=False),
+        sa.Column('tenant_id', sa.String(length=255), nullable=False),
+        sa.Column('prefixlen', sa.Integer(), autoincrement=False,
+                  nullable=False),
+        sa.Column('subnet_count', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['subnetpool_id'], ['subnetpools.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('subnetpool_id', 'tenant_id', 'prefixlen')
+    )
+    op.bulk_insert(quota_usages, get_values())
+
+
+def get_values():
+    session = sa.orm.Session(bind=op.get_bind())
+    counts = collections.Counter()
+    query = session.query(subnets).filter(
+        subnets.c.subnetpool_id.isnot(None),
+        subnets.c.subnetpool_id != IPV6_PD_POOL_ID)
+    for tenant_id, cidr, subnetpool_id in query:
+        counts[(subnetpool_id, tenant_id,
+                netaddr.IPNetwork(cidr).prefixlen)] += 1
+    # this commit appears to be necessary to allow further operations
+    session.commit()
+    return [{'subnetpool_id': subnetpool_id, 'tenant_id': tenant_id,
+             'prefixlen': prefixlen, 'subnet_count': count}
+            for (subnetpool_id, tenant_id, prefixlen), count
+            in counts.items()]
@@ -0,0 +1,46 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""Add IPAM allocation bitmap chunks
+
+Revision ID: 5e8c2a4b7d19
+Revises: 1d3f5a7c9e2b
+Create Date: 2016-01-26 09:47:53.120349
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e8c2a4b7d19'
+down_revision = '1d3f5a7c9e2b'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'ipambitmapchunks',
+        sa.Column('allocation_pool_id', sa.String(length=36),
+                  nullable=False),
+        sa.Column('chunk_index', sa.Integer(), autoincrement=False,
+                  nullable=False),
+        sa.Column('free_count', sa.Integer(), nullable=False),
+        sa.Column('revision', sa.Integer(), server_default='0',
+                  nullable=False),
+        sa.Column('bitmap', sa.LargeBinary(), nullable=False),
+        sa.ForeignKeyConstraint(['allocation_pool_id'],
+                                ['ipamallocationpools.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('allocation_pool_id', 'chunk_index')
+    )
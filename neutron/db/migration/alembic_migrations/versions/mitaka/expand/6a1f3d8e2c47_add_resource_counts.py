@@ -0,0 +1,72 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""Add resource counts
+
+Revision ID: 6a1f3d8e2c47
+Revises: 3c9e1f5b7a24
+Create Date: 2016-02-08 15:12:40.218364
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a1f3d8e2c47'
+down_revision = '3c9e1f5b7a24'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# Simple models of the tables counted, with only the fields needed for the
+# migration, and the attributes their resources are counted by.
+counted_tables = [
+    (sa.Table('networks', sa.MetaData(),
+              sa.Column('tenant_id', sa.String(length=255))),
+     ['tenant_id']),
+    (sa.Table('subnets', sa.MetaData(),
+              sa.Column('tenant_id', sa.String(length=255)),
+              sa.Column('network_id', sa.String(length=36))),
+     ['tenant_id', 'network_id']),
+    (sa.Table('ports', sa.MetaData(),
+              sa.Column('tenant_id', sa.String(length=255))),
+     ['tenant_id']),
+]
+
+
+def upgrade():
+    resource_counts = op.create_table(
+        'resourcecounts',
+        sa.Column('resource', sa.String(length=255), nullable=False),
+        sa.Column('scope', sa.String(length=36), nullable=False),
+        sa.Column('scope_id', sa.String(length=255), nullable=False),
+        sa.Column('in_use', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('resource', 'scope', 'scope_id')
+    )
+    op.bulk_insert(resource_counts, get_values())
+
+
+def get_values():
+    session = sa.orm.Session(bind=op.get_bind())
+    values = []
+    for table, scopes in counted_tables:
+        for scope in scopes:
+            column = table.c[scope]
+            query = session.query(column, sa.func.count()).filter(
+                column.isnot(None)).group_by(column)
+            values.extend({'resource': table.name, 'scope': scope,
+                           'scope_id': scope_id, 'in_use': in_use}
+                          for scope_id, in_use in query)
+    # this commit appears to be necessary to allow further operations
+    session.commit()
+    return values
@@ -0,0 +1,49 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""Add subnet pool free prefixes
+
+Revision ID: 7b2d4f6a8c31
+Revises: 5e8c2a4b7d19
+Create Date: 2016-01-28 14:21:05.631847
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7b2d4f6a8c31'
+down_revision = '5e8c2a4b7d19'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'subnetpoolfreeprefixes',
+        sa.Column('subnetpool_id', sa.String(length=36), nullable=False),
+        sa.Column('cidr', sa.String(length=64), nullable=False),
+        sa.Column('prefixlen', sa.Integer(), nullable=False),
+        sa.Column('first_ip', sa.String(length=32), nullable=False),
+        sa.Column('last_ip', sa.String(length=32), nullable=False),
+        sa.ForeignKeyConstraint(['subnetpool_id'], ['subnetpools.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('subnetpool_id', 'cidr')
+    )
+    op.create_index('ix_subnetpoolfreeprefixes_subnetpool_id_prefixlen',
+                    'subnetpoolfreeprefixes', ['subnetpool_id', 'prefixlen'])
+    op.create_index('ix_subnetpoolfreeprefixes_subnetpool_id_first_ip',
+                    'subnetpoolfreeprefixes', ['subnetpool_id', 'first_ip'])
+    op.add_column('subnetpools',
+                  sa.Column('free_prefixes_indexed', sa.Boolean(),
+                            server_default=sa.sql.false(), nullable=False))
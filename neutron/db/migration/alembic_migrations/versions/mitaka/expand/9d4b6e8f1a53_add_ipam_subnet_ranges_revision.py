@@ -0,0 +1,34 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""Add ranges revision to IPAM subnets
+
+Revision ID: 9d4b6e8f1a53
+Revises: 6a1f3d8e2c47
+Create Date: 2016-02-10 11:37:52.904126
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9d4b6e8f1a53'
+down_revision = '6a1f3d8e2c47'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('ipamsubnets',
+                  sa.Column('ranges_revision', sa.Integer(),
+                            server_default='0', nullable=False))
@@ -30,6 +30,8 @@ from neutron.db import external_net_db  # noqa
 from neutron.db import extradhcpopt_db  # noqa
 from neutron.db import extraroute_db  # noqa
 from neutron.db import flavors_db  # noqa
+from neutron.db import ip_usage_db  # noqa
+from neutron.db import ip_usage_history_db  # noqa
 from neutron.db import l3_agentschedulers_db  # noqa
 from neutron.db import l3_attrs_db  # noqa
 from neutron.db import l3_db  # noqa
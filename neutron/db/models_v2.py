@@ -229,6 +229,73 @@ class SubnetPoolPrefix(model_base.BASEV2):
                               primary_key=True)
 
 
+class SubnetPoolFreePrefix(model_base.BASEV2):
+    """Represents a block of unallocated space of a neutron subnet pool.
+
+    Free blocks are disjoint CIDRs. Their first and last addresses are kept
+    as fixed width hexadecimal strings, so that the blocks are ordered by
+    address and the block containing a given CIDR can be looked up with an
+    index.
+    """
+
+    __tablename__ = 'subnetpoolfreeprefixes'
+
+    subnetpool_id = sa.Column(sa.String(36),
+                              sa.ForeignKey('subnetpools.id',
+                                            ondelete='CASCADE'),
+                              nullable=False,
+                              primary_key=True)
+    cidr = sa.Column(sa.String(64), nullable=False, primary_key=True)
+    prefixlen = sa.Column(sa.Integer, nullable=False)
+    first_ip = sa.Column(sa.String(32), nullable=False)
+    last_ip = sa.Column(sa.String(32), nullable=False)
+    __table_args__ = (
+        sa.Index('ix_subnetpoolfreeprefixes_subnetpool_id_prefixlen',
+                 'subnetpool_id', 'prefixlen'),
+        sa.Index('ix_subnetpoolfreeprefixes_subnetpool_id_first_ip',
+                 'subnetpool_id', 'first_ip'),
+        model_base.BASEV2.__table_args__
+    )
+
+
+class SubnetPoolQuotaUsage(model_base.BASEV2):
+    """Represents the number of subnets of a tenant in a subnet pool.
+
+    Subnets are counted by prefix length, from which the quota units they
+    consume are derived.
+    """
+
+    __tablename__ = 'subnetpoolquotausages'
+
+    subnetpool_id = sa.Column(sa.String(36),
+                              sa.ForeignKey('subnetpools.id',
+                                            ondelete='CASCADE'),
+                              nullable=False,
+                              primary_key=True)
+    tenant_id = sa.Column(sa.String(attr.TENANT_ID_MAX_LEN),
+                          nullable=False, primary_key=True)
+    prefixlen = sa.Column(sa.Integer, nullable=False, primary_key=True,
+                          autoincrement=False)
+    subnet_count = sa.Column(sa.Integer, nullable=False)
+
+
+class ResourceCount(model_base.BASEV2):
+    """Represents the number of resources of a kind in a scope.
+
+    The scope is the tenant or the network the resources belong to, as
+    given by scope, the name of the attribute of the resources holding
+    scope_id.
+    """
+
+    __tablename__ = 'resourcecounts'
+
+    resource = sa.Column(sa.String(255), nullable=False, primary_key=True)
+    scope = sa.Column(sa.String(36), nullable=False, primary_key=True)
+    scope_id = sa.Column(sa.String(attr.TENANT_ID_MAX_LEN), nullable=False,
+                         primary_key=True)
+    in_use = sa.Column(sa.Integer, nullable=False)
+
+
 class SubnetPool(model_base.HasStandardAttributes, model_base.BASEV2,
                  HasId, HasTenant):
     """Represents a neutron subnet pool.
@@ -243,6 +310,9 @@ class SubnetPool(model_base.HasStandardAttributes, model_base.BASEV2,
     is_default = sa.Column(sa.Boolean, nullable=False)
     default_quota = sa.Column(sa.Integer, nullable=True)
     hash = sa.Column(sa.String(36), nullable=False, server_default='')
+    # Whether the free space of the pool is in subnetpoolfreeprefixes
+    free_prefixes_indexed = sa.Column(sa.Boolean, nullable=False,
+                                      server_default=sa.sql.false())
     address_scope_id = sa.Column(sa.String(36), nullable=True)
     prefixes = orm.relationship(SubnetPoolPrefix,
                                 backref='subnetpools',
@@ -0,0 +1,252 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Counting of networks, subnets and ports without scanning them.
+
+The resources of each tenant, and the subnets of each network, are
+counted in the resourcecounts table. Mapper events keep the counters in
+step with the resources, so that the counts most often asked for, as by
+quota checks, are read from a few rows. Unfiltered counts of admin
+requests may also be estimated from the table statistics of the database.
+Any other count is exact.
+
+Each counted insert or delete updates the counter rows of its scopes,
+which stay locked until the transaction ends, so the mapper events are
+only registered when the counters are in use. Ports are not counted by
+network: concurrent port creations on a network would all wait on its
+counter row, while the ports of a network are seldom counted.
+"""
+
+import collections
+
+from oslo_config import cfg
+from oslo_db import exception as db_exc
+from oslo_log import log as logging
+import six
+import sqlalchemy as sa
+from sqlalchemy import event
+
+from neutron._i18n import _LW
+from neutron.db import common_db_mixin
+from neutron.db import models_v2
+
+LOG = logging.getLogger(__name__)
+
+COUNT_MODES = (EXACT_MODE, COUNTERS_MODE, ESTIMATE_MODE) = (
+    'exact', 'counters', 'estimate')
+
+# Attributes of the resources of each model by which they are counted
+COUNTED_SCOPES = {
+    models_v2.Network: ('tenant_id',),
+    models_v2.Subnet: ('tenant_id', 'network_id'),
+    models_v2.Port: ('tenant_id',),
+}
+
+# Queries of the estimated number of rows of a table, by database dialect
+ESTIMATE_QUERIES = {
+    'mysql': sa.text("SELECT table_rows FROM information_schema.tables "
+                     "WHERE table_schema = DATABASE() "
+                     "AND table_name = :table"),
+    'postgresql': sa.text("SELECT reltuples FROM pg_class "
+                          "WHERE relname = :table AND relkind = 'r' "
+                          "AND pg_table_is_visible(oid)"),
+}
+
+_counting = False
+
+
+def _adjust_count(connection, resource, scope, scope_id, delta):
+    """Add delta to the counter of the resources of a scope."""
+    if scope_id is None:
+        return
+    counts = models_v2.ResourceCount.__table__
+    key = {'resource': resource, 'scope': scope, 'scope_id': scope_id}
+    update = counts.update().where(sa.and_(
+        *[counts.c[column] == value for column, value in key.items()]
+    )).values(in_use=counts.c.in_use + delta)
+    if connection.execute(update).rowcount or delta < 0:
+        return
+    key['in_use'] = delta
+    try:
+        with connection.begin_nested():
+            connection.execute(counts.insert(), key)
+    except db_exc.DBDuplicateEntry:
+        # The first resource of the scope was counted concurrently
+        connection.execute(update)
+
+
+def _count_created(mapper, connection, target):
+    for scope in COUNTED_SCOPES[mapper.class_]:
+        _adjust_count(connection, mapper.local_table.name, scope,
+                      getattr(target, scope), 1)
+
+
+def _count_updated(mapper, connection, target):
+    state = sa.inspect(target)
+    for scope in COUNTED_SCOPES[mapper.class_]:
+        history = state.attrs[scope].history
+        if history.deleted:
+            _adjust_count(connection, mapper.local_table.name, scope,
+                          history.deleted[0], -1)
+            _adjust_count(connection, mapper.local_table.name, scope,
+                          getattr(target, scope), 1)
+
+
+def _count_deleted(mapper, connection, target):
+    for scope in COUNTED_SCOPES[mapper.class_]:
+        _adjust_count(connection, mapper.local_table.name, scope,
+                      getattr(target, scope), -1)
+
+
+def _delete_network_counts(mapper, connection, network):
+    counts = models_v2.ResourceCount.__table__
+    connection.execute(counts.delete().where(sa.and_(
+        counts.c.scope == 'network_id', counts.c.scope_id == network.id)))
+
+
+def start_counting():
+    """Keep the resource counters in step with the resources from now on.
+
+    Resources created or deleted before are not counted; the counters are
+    repaired by sync_resource_counts.
+    """
+    global _counting
+    if _counting:
+        return
+    for model in COUNTED_SCOPES:
+        event.listen(model, 'after_insert', _count_created)
+        event.listen(model, 'after_update', _count_updated)
+        event.listen(model, 'after_delete', _count_deleted)
+    event.listen(models_v2.Network, 'after_delete', _delete_network_counts)
+    _counting = True
+
+
+def count_bulk_deleted(context, model, query):
+    """Uncount the resources of model about to be deleted by query.
+
+    Deletions by Query.delete() bypass the mapper events counting the
+    resources, so they are uncounted beforehand.
+    """
+    if not _counting:
+        return
+    scopes = COUNTED_SCOPES[model]
+    connection = context.session.connection()
+    deleted = query.with_entities(
+        sa.func.count(), *[getattr(model, scope) for scope in scopes]
+    ).group_by(*[getattr(model, scope) for scope in scopes])
+    for row in deleted:
+        for scope, scope_id in zip(scopes, row[1:]):
+            _adjust_count(connection, model.__tablename__, scope, scope_id,
+                          -row[0])
+
+
+def _read_counters(context, model, filters):
+    if not filters or len(filters) != 1:
+        return
+    (scope, scope_ids), = filters.items()
+    if scope not in COUNTED_SCOPES.get(model, ()) or not scope_ids:
+        return
+    scope_ids = set(scope_ids)
+    if (common_db_mixin.model_query_scope(context, model) and
+            (scope != 'tenant_id' or scope_ids != set([context.tenant_id]))):
+        # Only resources of its own tenant are all visible to the request
+        return
+    counts = models_v2.ResourceCount
+    in_use = context.session.query(sa.func.sum(counts.in_use)).filter(
+        counts.resource == model.__tablename__, counts.scope == scope,
+        counts.scope_id.in_(scope_ids)).scalar()
+    return int(in_use or 0)
+
+
+def get_count(context, model, filters=None):
+    """Return the number of resources of model matching filters, or None.
+
+    The count is read from the counters when filters select the resources
+    of tenants or networks, or estimated, depending on the
+    resource_count_mode option. None is returned when it is neither, and
+    the resources are to be counted exactly.
+    """
+    mode = cfg.CONF.resource_count_mode
+    if mode == EXACT_MODE:
+        return
+    count = _read_counters(context, model, filters)
+    if (count is None and mode == ESTIMATE_MODE and not filters and
+            model in COUNTED_SCOPES and context.is_admin):
+        count = estimate_count(context, model)
+    return count
+
+
+def estimate_count(context, model):
+    """Return the number of rows of the table of model, as estimated.
+
+    The estimate comes from the statistics the database keeps for its
+    query planner. None is returned when the database has none, or no
+    statistics of a table which is not empty.
+    """
+    session = context.session
+    query = ESTIMATE_QUERIES.get(session.bind.dialect.name)
+    if query is None:
+        return
+    estimate = session.execute(query,
+                               {'table': model.__tablename__}).scalar()
+    # Tables never analyzed are reported empty, or with -1 rows
+    if estimate is not None and estimate > 0:
+        return int(estimate)
+
+
+def _count_resources(context):
+    actual = collections.Counter()
+    for model, scopes in six.iteritems(COUNTED_SCOPES):
+        for scope in scopes:
+            column = getattr(model, scope)
+            query = context.session.query(column, sa.func.count()).filter(
+                column.isnot(None)).group_by(column)
+            for scope_id, in_use in query:
+                actual[(model.__tablename__, scope, scope_id)] = in_use
+    return actual
+
+
+def sync_resource_counts(context):
+    """Repair the resource counters which drifted.
+
+    Returns the number of counters repaired.
+    """
+    counts = models_v2.ResourceCount
+    repaired = 0
+    with context.session.begin(subtransactions=True):
+        # Lock the counters before counting, so that resources counted
+        # while the sync runs are not lost
+        stored = dict(((count.resource, count.scope, count.scope_id), count)
+                      for count in context.session.query(
+                          counts).with_lockmode('update'))
+        actual = _count_resources(context)
+        for key in set(stored) | set(actual):
+            count = stored.get(key)
+            in_use = actual.get(key, 0)
+            if count is not None and count.in_use == in_use:
+                continue
+            resource, scope, scope_id = key
+            LOG.warning(_LW("Repairing count of %(resource)s of %(scope)s "
+                            "%(scope_id)s: counted %(counted)s, found "
+                            "%(found)s"),
+                        {'resource': resource, 'scope': scope,
+                         'scope_id': scope_id,
+                         'counted': count.in_use if count else None,
+                         'found': in_use})
+            if count is None:
+                context.session.add(counts(resource=resource, scope=scope,
+                                           scope_id=scope_id, in_use=in_use))
+            else:
+                count.in_use = in_use
+            repaired += 1
+    return repaired
@@ -13,13 +13,26 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import base64
+import binascii
+import collections
+
+from oslo_serialization import jsonutils
 from six import moves
 import sqlalchemy
+from sqlalchemy import orm
+from sqlalchemy.orm import attributes
+from sqlalchemy.orm import interfaces
 from sqlalchemy.orm import properties
+from sqlalchemy.sql import expression
+from sqlalchemy.sql import operators
 
 from neutron._i18n import _
 from neutron.common import exceptions as n_exc
 
+# Number of parent instances whose collections are loaded by a single query
+LOAD_BATCH_SIZE = 500
+
 
 def paginate_query(query, model, limit, sorts, marker_obj=None):
     """Returns a query with sorting / pagination criteria added.
@@ -40,6 +53,8 @@ def paginate_query(query, model, limit, sorts, marker_obj=None):
     Typically, the id of the last row is used as the client-facing pagination
     marker, then the actual marker object must be fetched from the db and
     passed in to us as marker.
+    Alternatively, the client-facing marker is a KeysetMarker encoding the
+    values of the sort keys of the last row, which need not be fetched.
 
     :param query: the query object to which we should add paging/sorting
     :param model: the ORM model class
@@ -79,7 +94,12 @@ def paginate_query(query, model, limit, sorts, marker_obj=None):
 
     # Add pagination
     if marker_obj:
-        marker_values = [getattr(marker_obj, sort[0]) for sort in sorts]
+        try:
+            marker_values = [getattr(marker_obj, sort[0]) for sort in sorts]
+        except AttributeError:
+            # A keyset marker of a listing sorted on other keys
+            msg = _("The marker does not match the sort keys")
+            raise n_exc.BadRequest(resource=model.__tablename__, msg=msg)
 
         # Build up an array of sort criteria as in the docstring
         criteria_list = []
@@ -96,9 +116,155 @@ def paginate_query(query, model, limit, sorts, marker_obj=None):
             criteria_list.append(criteria)
 
         f = sqlalchemy.sql.or_(*criteria_list)
+        if len(sorts) > 1 and marker_values[0] is not None:
+            # Bound the first sort key too, so that the database can scan
+            # an index of it from the marker on, however deep the page
+            first_attr = getattr(model, sorts[0][0])
+            if sorts[0][1]:
+                f = sqlalchemy.sql.and_(first_attr >= marker_values[0], f)
+            else:
+                f = sqlalchemy.sql.and_(first_attr <= marker_values[0], f)
         query = query.filter(f)
 
     if limit:
         query = query.limit(limit)
 
     return query
+
+
+def paginate_instances_query(query, model, limit, sorts, marker_obj=None):
+    """Returns a query of model with sorting / pagination criteria added.
+
+    Unlike with paginate_query, the limit applies to instances of model
+    rather than to rows of the query: joined eager loads, and joins used to
+    filter on related models, return several rows per instance. The sort
+    keys and primary key of the instances of the page are selected by a
+    subquery, to which the query is joined on the primary key.
+
+    The parameters are those of paginate_query.
+    """
+    query = paginate_query(query, model, limit, sorts, marker_obj=marker_obj)
+    if not (limit and sorts):
+        return query
+    primary_keys = model.__table__.primary_key.columns.keys()
+    keys = [sort[0] for sort in sorts]
+    keys.extend(key for key in primary_keys if key not in keys)
+    page = query.with_entities(
+        *[getattr(model, key) for key in keys]).distinct().subquery()
+    return query.limit(None).join(page, sqlalchemy.and_(
+        *[getattr(model, key) == page.c[key] for key in primary_keys]))
+
+
+class KeysetMarker(object):
+    """Sort key values of the last item of a page, decoded from a marker.
+
+    paginate_query reads them as attributes, as it does of a marker object
+    fetched from the database.
+    """
+
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+
+def encode_marker(item, sorts):
+    """Return an opaque marker for the listing to resume after item.
+
+    The marker holds the values of the sort keys of item, so that the next
+    page can be selected without fetching item first.
+
+    :param item: dict of a resource, with its sort keys.
+    :param sorts: array of attributes and direction by which the listing
+        is sorted.
+    """
+    values = dict((sort[0], item[sort[0]]) for sort in sorts)
+    marker = base64.urlsafe_b64encode(jsonutils.dumps(values).encode('utf-8'))
+    return marker.decode('ascii').rstrip('=')
+
+
+def decode_marker(marker):
+    """Return the KeysetMarker of a marker from encode_marker.
+
+    None is returned for other markers, such as the id of an item.
+    """
+    try:
+        values = jsonutils.loads(base64.urlsafe_b64decode(
+            str(marker) + '=' * (-len(marker) % 4)))
+    except (TypeError, ValueError, binascii.Error):
+        return None
+    if not isinstance(values, dict):
+        return None
+    return KeysetMarker(values)
+
+
+def batchable_collections(model):
+    """Return the eagerly joined collections of model loadable in batches.
+
+    These are the one-to-many relationships on an equality between a column
+    of model and a column of the related model, whose collections for many
+    instances can be loaded with a single IN query.
+    """
+    return [rel for rel in sqlalchemy.inspect(model).relationships
+            if rel.lazy == 'joined' and rel.uselist and
+            rel.direction is interfaces.ONETOMANY and
+            rel.secondary is None and
+            isinstance(rel.primaryjoin, expression.BinaryExpression) and
+            rel.primaryjoin.operator is operators.eq]
+
+
+def lazy_load_collections(query, model):
+    """Leave the collections loadable in batches out of the joins of query.
+
+    The instances returned by query are expected to go through
+    batch_load_collections before their collections are accessed.
+    """
+    rels = batchable_collections(model)
+    if not rels:
+        return query
+    return query.options(*[orm.lazyload(getattr(model, rel.key))
+                           for rel in rels])
+
+
+def batch_load_collections(session, model, instances, _loading=()):
+    """Load the batchable collections of instances with IN queries.
+
+    Each collection is loaded for all instances at once, so that the
+    number of queries and rows does not depend on the number of instances
+    nor on the size of the other collections. The collections of the
+    loaded instances are in turn loaded the same way.
+
+    :param session: database session of the instances.
+    :param model: the ORM model class of the instances.
+    :param instances: list of instances returned by a query built with
+        lazy_load_collections.
+    """
+    mapper = sqlalchemy.inspect(model)
+    _loading += (model,)
+    for rel in batchable_collections(model):
+        local_column, remote_column = rel.local_remote_pairs[0]
+        local_key = mapper.get_property_by_column(local_column).key
+        remote_key = rel.mapper.get_property_by_column(remote_column).key
+        # Leave alone collections loaded already, which may be modified
+        pending = [instance for instance in instances
+                   if rel.key not in sqlalchemy.inspect(instance).dict]
+        keys = list(set(getattr(instance, local_key)
+                        for instance in pending) - set([None]))
+        child_model = rel.mapper.class_
+        nested = child_model not in _loading
+        children = collections.defaultdict(list)
+        loaded = []
+        for start in moves.range(0, len(keys), LOAD_BATCH_SIZE):
+            query = session.query(child_model).filter(
+                remote_column.in_(keys[start:start + LOAD_BATCH_SIZE]))
+            if nested:
+                query = lazy_load_collections(query, child_model)
+            if rel.order_by:
+                query = query.order_by(*rel.order_by)
+            for child in query:
+                children[getattr(child, remote_key)].append(child)
+                loaded.append(child)
+        for instance in pending:
+            attributes.set_committed_value(
+                instance, rel.key,
+                children.get(getattr(instance, local_key), []))
+        if nested and loaded:
+            batch_load_collections(session, child_model, loaded, _loading)
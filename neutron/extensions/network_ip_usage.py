@@ -39,6 +39,8 @@ RESOURCE_ATTRIBUTE_MAP = {
                       'is_visible': True},
         'used_ips': {'allow_post': False, 'allow_put': False,
                      'is_visible': True},
+        'utilization': {'allow_post': False, 'allow_put': False,
+                        'is_visible': True},
         'subnet_ip_allocations': {'allow_post': False, 'allow_put': False,
                                   'is_visible': True},
         'ip_version': {'allow_post': False, 'allow_put': False,
@@ -54,6 +56,24 @@ RESOURCE_ATTRIBUTE_MAP = {
                          'is_visible': True},
 }
 
+HISTORY_COLLECTION = 'histories'
+HISTORY_RESOURCE = 'history'
+
+SUB_RESOURCE_ATTRIBUTE_MAP = {
+    HISTORY_COLLECTION: {
+        'parent': {'collection_name': COLLECTION_NAME,
+                   'member_name': RESOURCE_NAME},
+        'parameters': {
+            'id': {'allow_post': False, 'allow_put': False,
+                   'is_visible': True},
+            'samples': {'allow_post': False, 'allow_put': False,
+                        'is_visible': True},
+            'exhaustion_date': {'allow_post': False, 'allow_put': False,
+                                'is_visible': True},
+        }
+    }
+}
+
 
 class Network_ip_usage(extensions.ExtensionDescriptor):
     """Extension class supporting network ip usage information."""
@@ -84,10 +104,24 @@ class Network_ip_usage(extensions.ExtensionDescriptor):
             RESOURCE_PLURAL,
             RESOURCE_NAME,
             plugin.IpUsagePlugin.get_instance(),
-            resource_attributes)
-        return [extensions.ResourceExtension(COLLECTION_NAME,
-                                             controller,
-                                             attr_map=resource_attributes)]
+            resource_attributes,
+            allow_pagination=True,
+            allow_sorting=True)
+        resources = [extensions.ResourceExtension(
+            COLLECTION_NAME, controller, attr_map=resource_attributes)]
+
+        attributes.PLURALS[HISTORY_COLLECTION] = HISTORY_RESOURCE
+        history = SUB_RESOURCE_ATTRIBUTE_MAP[HISTORY_COLLECTION]
+        controller = base.create_resource(
+            HISTORY_COLLECTION,
+            HISTORY_RESOURCE,
+            plugin.IpUsagePlugin.get_instance(),
+            history['parameters'],
+            parent=history['parent'])
+        resources.append(extensions.ResourceExtension(
+            HISTORY_COLLECTION, controller, history['parent'],
+            attr_map=history['parameters']))
+        return resources
 
     def get_extended_resources(self, version):
         if version == "2.0":
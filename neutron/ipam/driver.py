@@ -14,6 +14,7 @@ import abc
 
 from oslo_config import cfg
 from oslo_log import log
+from oslo_utils import excutils
 import six
 
 from neutron.ipam import requests as ipam_req
@@ -132,6 +133,34 @@ class Subnet(object):
             AddressOutsideSubnet
         """
 
+    def bulk_allocate(self, address_requests):
+        """Allocates several IP addresses at once
+
+        Either all the addresses are allocated, or none of them is. This
+        implementation allocates the addresses one at a time; drivers able
+        to allocate them in a single operation should override it.
+
+        :param address_requests: Specifies what to allocate.
+        :type address_requests: A list of instances of subclasses of
+            AddressRequest
+        :returns: A list of the allocated addresses, in request order
+        :raises: AddressNotAvailable, AddressOutsideAllocationPool,
+            AddressOutsideSubnet
+        """
+        allocated = []
+        try:
+            for address_request in address_requests:
+                allocated.append(self.allocate(address_request))
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                for address in allocated:
+                    try:
+                        self.deallocate(address)
+                    except Exception:
+                        LOG.debug("Reverting IP allocation failed for %s",
+                                  address)
+        return allocated
+
     @abc.abstractmethod
     def deallocate(self, address):
         """Returns a previously allocated address to the pool
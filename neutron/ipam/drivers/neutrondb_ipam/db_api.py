@@ -68,7 +68,7 @@ class IpamSubnetManager(object):
         return session.query(db_models.IpamSubnet).filter_by(
             neutron_subnet_id=neutron_subnet_id).delete()
 
-    def create_pool(self, session, pool_start, pool_end):
+    def create_pool(self, session, pool_start, pool_end, with_range=True):
         """Create an allocation pool and availability ranges for the subnet.
 
         This method does not perform any validation on parameters; it simply
@@ -76,6 +76,8 @@ class IpamSubnetManager(object):
 
         :param pool_start: string expressing the start of the pool
         :param pool_end: string expressing the end of the pool
+        :param with_range: whether to create the availability range of the
+            pool.
         :return: the newly created pool object.
         """
         ip_pool = db_models.IpamAllocationPool(
@@ -83,11 +85,12 @@ class IpamSubnetManager(object):
             first_ip=pool_start,
             last_ip=pool_end)
         session.add(ip_pool)
-        ip_range = db_models.IpamAvailabilityRange(
-            allocation_pool=ip_pool,
-            first_ip=pool_start,
-            last_ip=pool_end)
-        session.add(ip_range)
+        if with_range:
+            ip_range = db_models.IpamAvailabilityRange(
+                allocation_pool=ip_pool,
+                first_ip=pool_start,
+                last_ip=pool_end)
+            session.add(ip_range)
         return ip_pool
 
     def delete_allocation_pools(self, session):
@@ -202,6 +205,98 @@ class IpamSubnetManager(object):
         session.add(new_ip_range)
         return new_ip_range
 
+    def create_ranges(self, session, ranges):
+        """Create availability ranges with a single bulk insert.
+
+        :param session: database session
+        :param ranges: list of dicts with allocation_pool_id, first_ip and
+            last_ip keys
+        """
+        if ranges:
+            session.execute(db_models.IpamAvailabilityRange.__table__.insert(),
+                            ranges)
+
+    def create_bitmap_chunk(self, session, ip_pool, chunk_index, bitmap,
+                            free_count):
+        """Create an allocation bitmap chunk for a given pool.
+
+        :param session: database session
+        :param ip_pool: IpamAllocationPool db object
+        :param chunk_index: position of the chunk in the pool
+        :param bitmap: bytes with a bit set for each allocated address
+        :param free_count: number of bits not set in the bitmap
+        """
+        chunk = db_models.IpamBitmapChunk(
+            allocation_pool=ip_pool,
+            chunk_index=chunk_index,
+            bitmap=bitmap,
+            free_count=free_count,
+            revision=0)
+        session.add(chunk)
+        return chunk
+
+    def list_free_bitmap_chunks(self, session):
+        """Return the chunks of the subnet with free addresses.
+
+        :param session: database session
+        :return: list of (allocation pool id, pool first ip, chunk index)
+        """
+        return session.query(
+            db_models.IpamBitmapChunk.allocation_pool_id,
+            db_models.IpamAllocationPool.first_ip,
+            db_models.IpamBitmapChunk.chunk_index).join(
+            db_models.IpamAllocationPool).filter(
+            db_models.IpamAllocationPool.ipam_subnet_id ==
+            self._ipam_subnet_id,
+            db_models.IpamBitmapChunk.free_count > 0).all()
+
+    def get_bitmap_chunk(self, session, allocation_pool_id, chunk_index):
+        """Return a chunk of the allocation bitmap of a pool.
+
+        :param session: database session
+        :param allocation_pool_id: allocation pool identifier
+        :param chunk_index: position of the chunk in the pool
+        """
+        # Chunks are updated in place, so always refresh them from the
+        # database rather than from the session
+        query = session.query(db_models.IpamBitmapChunk).populate_existing()
+        return query.filter_by(allocation_pool_id=allocation_pool_id,
+                               chunk_index=chunk_index).first()
+
+    def update_bitmap_chunk(self, session, chunk, bitmap, free_count):
+        """Store a new bitmap for chunk, unless chunk was updated meanwhile.
+
+        :param session: database session
+        :param chunk: IpamBitmapChunk db object, as read before the update
+        :param bitmap: the new bitmap
+        :param free_count: number of bits not set in the new bitmap
+        :return: count of updated rows
+        """
+        return session.query(db_models.IpamBitmapChunk).filter_by(
+            allocation_pool_id=chunk.allocation_pool_id,
+            chunk_index=chunk.chunk_index,
+            revision=chunk.revision).update(
+                {'bitmap': bitmap,
+                 'free_count': free_count,
+                 'revision': chunk.revision + 1},
+                synchronize_session=False)
+
+    def get_ranges_revision(self, session):
+        """Return the revision of the availability ranges of the subnet."""
+        return session.query(db_models.IpamSubnet.ranges_revision).filter_by(
+            id=self._ipam_subnet_id).scalar()
+
+    def bump_ranges_revision(self, session):
+        """Mark the availability ranges of the subnet as rebuilt.
+
+        :param session: database session
+        :return: count of updated rows
+        """
+        return session.query(db_models.IpamSubnet).filter_by(
+            id=self._ipam_subnet_id).update(
+                {'ranges_revision': db_models.IpamSubnet.ranges_revision + 1},
+                synchronize_session=False)
+
     def check_unique_allocation(self, session, ip_address):
         """Validate that the IP address on the subnet is not in use."""
         iprequest = session.query(db_models.IpamAllocation).filter_by(
@@ -224,6 +319,15 @@ class IpamSubnetManager(object):
             ipam_subnet_id=self._ipam_subnet_id,
             status=status)
 
+    def list_allocation_addresses(self, session, status='ALLOCATED'):
+        """Return a query of the addresses currently allocated on the subnet.
+
+        :param session: database session
+        :param status: IP allocation status
+        """
+        return session.query(db_models.IpamAllocation.ip_address).filter_by(
+            ipam_subnet_id=self._ipam_subnet_id, status=status)
+
     def create_allocation(self, session, ip_address,
                           status='ALLOCATED'):
         """Create an IP allocation entry.
@@ -238,6 +342,22 @@ class IpamSubnetManager(object):
             ipam_subnet_id=self._ipam_subnet_id)
         session.add(ip_request)
 
+    def create_allocations(self, session, ip_addresses,
+                           status='ALLOCATED'):
+        """Create IP allocation entries with a single bulk insert.
+
+        :param session: database session
+        :param ip_addresses: the IP addresses to allocate
+        :param status: IP allocation status
+        """
+        if ip_addresses:
+            session.execute(
+                db_models.IpamAllocation.__table__.insert(),
+                [{'ip_address': ip_address,
+                  'status': status,
+                  'ipam_subnet_id': self._ipam_subnet_id}
+                 for ip_address in ip_addresses])
+
     def delete_allocation(self, session, ip_address):
         """Remove an IP allocation for this subnet.
 
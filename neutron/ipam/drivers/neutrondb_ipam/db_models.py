@@ -92,6 +92,10 @@ class IpamSubnet(model_base.BASEV2, models_v2.HasId):
     """
     neutron_subnet_id = sa.Column(sa.String(36),
                                   nullable=True)
+    # Incremented when the availability ranges are rebuilt or recreated,
+    # which gives the addresses leased by server processes back
+    ranges_revision = sa.Column(sa.Integer, nullable=False,
+                                server_default='0', default=0)
     allocation_pools = sa_orm.relationship(IpamAllocationPool,
                                            backref='subnet',
                                            lazy="joined",
@@ -109,3 +113,25 @@ class IpamAllocation(model_base.BASEV2):
                                              ondelete="CASCADE"),
                                primary_key=True,
                                nullable=False)
+
+
+class IpamBitmapChunk(model_base.BASEV2):
+    """Allocation bitmap of a block of addresses of an allocation pool.
+
+    Bit n of chunk i stands for the address at offset
+    i * BITMAP_CHUNK_BITS + n in the pool; a set bit is an allocated
+    address. The revision is bumped on every update, so that concurrent
+    updates of a chunk can be detected.
+    """
+
+    allocation_pool_id = sa.Column(sa.String(36),
+                                   sa.ForeignKey('ipamallocationpools.id',
+                                                 ondelete="CASCADE"),
+                                   nullable=False,
+                                   primary_key=True)
+    chunk_index = sa.Column(sa.Integer, nullable=False, primary_key=True,
+                            autoincrement=False)
+    free_count = sa.Column(sa.Integer, nullable=False)
+    revision = sa.Column(sa.Integer, nullable=False, server_default='0')
+    bitmap = sa.Column(sa.LargeBinary, nullable=False)
+    allocation_pool = sa_orm.relationship(IpamAllocationPool)
@@ -13,10 +13,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import bisect
+import random
+
 import netaddr
+from oslo_config import cfg
 from oslo_db import exception as db_exc
 from oslo_log import log
 from oslo_utils import uuidutils
+from six import moves
 
 from neutron._i18n import _LE
 from neutron.common import exceptions as n_exc
@@ -24,6 +29,7 @@ from neutron.common import ipv6_utils
 from neutron.db import api as db_api
 from neutron.ipam import driver as ipam_base
 from neutron.ipam.drivers.neutrondb_ipam import db_api as ipam_db_api
+from neutron.ipam.drivers.neutrondb_ipam import leases
 from neutron.ipam import exceptions as ipam_exc
 from neutron.ipam import requests as ipam_req
 from neutron.ipam import subnet_alloc
@@ -33,6 +39,11 @@ from neutron import manager
 
 LOG = log.getLogger(__name__)
 
+# Number of addresses tracked by each allocation bitmap chunk
+BITMAP_CHUNK_BITS = 1024
+# Pools larger than this, such as IPv6 /64 pools, use availability ranges
+MAX_BITMAP_POOL_SIZE = 2 ** 20
+
 
 class NeutronDbSubnet(ipam_base.Subnet):
     """Manage IP addresses for Neutron DB IPAM driver.
@@ -44,6 +55,10 @@ class NeutronDbSubnet(ipam_base.Subnet):
     IPAM operations.
     """
 
+    # Whether automatic allocations may be served from leased blocks of
+    # addresses, see ipam_lease_size
+    supports_leases = True
+
     @classmethod
     def create_allocation_pools(cls, subnet_manager, session, pools, cidr):
         for pool in pools:
@@ -265,13 +280,12 @@ class NeutronDbSubnet(ipam_base.Subnet):
         # probably unnecessary as this routine is called when the availability
         # ranges for a subnet are exhausted and no further address can be
         # allocated.
-        # TODO(salv-orlando): devise, if possible, a more efficient solution
-        # for building the IPSet to ensure decent performances even with very
-        # large subnets.
-        allocations = netaddr.IPSet(
-            [netaddr.IPAddress(allocation['ip_address']) for
-             allocation in self.subnet_manager.list_allocations(
-                 session)])
+        # Allocations are fetched in batches and kept as a sorted list of
+        # integers, which each pool is then walked against in a single pass.
+        allocations = sorted(
+            ipam_utils.ip_to_int(ip_address) for ip_address, in
+            self.subnet_manager.list_allocation_addresses(session).yield_per(
+                ipam_utils.REBUILD_BATCH_SIZE))
 
         # MEH MEH
         # There should be no need to set a write intent lock on the allocation
@@ -284,20 +298,24 @@ class NeutronDbSubnet(ipam_base.Subnet):
         LOG.debug("Rebuilding availability ranges for subnet %s",
                   self.subnet_manager.neutron_id)
 
+        ip_version = netaddr.IPNetwork(self._cidr).version
+        available_ranges = []
         for pool in self.subnet_manager.list_pools(session):
-            # Create a set of all addresses in the pool
-            poolset = netaddr.IPSet(netaddr.IPRange(pool['first_ip'],
-                                                    pool['last_ip']))
-            # Use set difference to find free addresses in the pool
-            available = poolset - allocations
-            # Write the ranges to the db
-            for ip_range in available.iter_ipranges():
-                av_range = self.subnet_manager.create_range(
-                    session,
-                    pool['id'],
-                    netaddr.IPAddress(ip_range.first).format(),
-                    netaddr.IPAddress(ip_range.last).format())
-                session.add(av_range)
+            # Walk the pool once to find the free ranges
+            for first, last in ipam_utils.iter_free_ranges(
+                    ipam_utils.ip_to_int(pool['first_ip']),
+                    ipam_utils.ip_to_int(pool['last_ip']),
+                    allocations):
+                available_ranges.append({
+                    'allocation_pool_id': pool['id'],
+                    'first_ip': netaddr.IPAddress(first, ip_version).format(),
+                    'last_ip': netaddr.IPAddress(last, ip_version).format()})
+        # Write the ranges to the db at once
+        self.subnet_manager.create_ranges(session, available_ranges)
+        # Addresses leased by this process are available again, and so are
+        # those of other processes, which drop their leases on the revision
+        self.subnet_manager.bump_ranges_revision(session)
+        leases.drop_leases(self.subnet_manager._ipam_subnet_id)
 
     def _generate_ip(self, session):
         try:
@@ -324,6 +342,29 @@ class NeutronDbSubnet(ipam_base.Subnet):
                    'last_ip': ip_range['last_ip']})
         return ip_address, ip_range['allocation_pool_id']
 
+    def _in_pools(self, ip_address):
+        ip = ipam_utils.ip_to_int(ip_address)
+        return any(pool.first <= ip <= pool.last for pool in self._pools)
+
+    def _get_leased_ip(self, session):
+        """Return an address from a lease of this process, if enabled.
+
+        Addresses from a lease were available when it was taken, but may
+        have been allocated since as specific addresses, which are skipped,
+        or put back in the availability ranges by another process, which
+        drops the lease.
+        """
+        if not (self.supports_leases and cfg.CONF.ipam_lease_size):
+            return
+        ip_version = netaddr.IPNetwork(self._cidr).version
+        while True:
+            ip_address = leases.get_leased_ip(
+                session, self.subnet_manager, ip_version, self._in_pools)
+            if (ip_address is None or
+                    self.subnet_manager.check_unique_allocation(session,
+                                                                ip_address)):
+                return ip_address
+
     def allocate(self, address_request):
         # NOTE(salv-orlando): Creating a new db session might be a rather
         # dangerous thing to do, if executed from within another database
@@ -334,6 +375,7 @@ class NeutronDbSubnet(ipam_base.Subnet):
         session = self._context.session
         all_pool_id = None
         auto_generated = False
+        leased = False
         with db_api.autonested_transaction(session):
             # NOTE(salv-orlando): It would probably better to have a simpler
             # model for address requests and just check whether there is a
@@ -344,16 +386,111 @@ class NeutronDbSubnet(ipam_base.Subnet):
                 ip_address = str(address_request.address)
                 self._verify_ip(session, ip_address)
             else:
-                ip_address, all_pool_id = self._generate_ip(session)
-                auto_generated = True
-            self._allocate_specific_ip(session, ip_address, all_pool_id,
-                                       auto_generated)
+                ip_address = self._get_leased_ip(session)
+                leased = ip_address is not None
+                if not leased:
+                    ip_address, all_pool_id = self._generate_ip(session)
+                    auto_generated = True
+            if not leased:
+                # Leased addresses are out of the availability ranges already
+                self._allocate_specific_ip(session, ip_address, all_pool_id,
+                                           auto_generated)
             # Create IP allocation request object
             # The only defined status at this stage is 'ALLOCATED'.
             # More states will be available in the future - e.g.: RECYCLABLE
             self.subnet_manager.create_allocation(session, ip_address)
             return ip_address
 
+    def _allocate_ips(self, session, count):
+        """Allocate count addresses from the availability ranges.
+
+        Addresses are taken from the start of each range in turn, so that
+        every range is updated or deleted once whatever the number of
+        addresses taken from it. The ranges are rebuilt once if they run
+        out. The allocations are created as addresses are taken.
+
+        :returns: the list of allocated addresses
+        """
+        ip_addresses = []
+        while len(ip_addresses) < count:
+            ip_address = self._get_leased_ip(session)
+            if ip_address is None:
+                break
+            ip_addresses.append(ip_address)
+        self.subnet_manager.create_allocations(session, ip_addresses)
+
+        ip_version = netaddr.IPNetwork(self._cidr).version
+        rebuilt = False
+        while len(ip_addresses) < count:
+            ip_ranges = list(self.subnet_manager.list_ranges_by_subnet_id(
+                session))
+            if not ip_ranges:
+                if rebuilt:
+                    LOG.debug("All IPs from subnet %(subnet_id)s allocated",
+                              {'subnet_id': self.subnet_manager.neutron_id})
+                    raise ipam_exc.IpAddressGenerationFailure(
+                        subnet_id=self.subnet_manager.neutron_id)
+                self._rebuild_availability_ranges(session)
+                rebuilt = True
+                continue
+            for ip_range in ip_ranges:
+                needed = count - len(ip_addresses)
+                if not needed:
+                    break
+                first = ipam_utils.ip_to_int(ip_range['first_ip'])
+                last = ipam_utils.ip_to_int(ip_range['last_ip'])
+                taken_last = min(last, first + needed - 1)
+                if taken_last == last:
+                    rows = self.subnet_manager.delete_range(session, ip_range)
+                else:
+                    rows = self.subnet_manager.update_range(
+                        session, ip_range,
+                        first_ip=netaddr.IPAddress(taken_last + 1,
+                                                   ip_version))
+                if not rows:
+                    raise db_exc.RetryRequest(ipam_exc.IPAllocationFailed)
+                taken = [netaddr.IPAddress(first + offset, ip_version).format()
+                         for offset in moves.range(taken_last - first + 1)]
+                LOG.debug("Allocated IPs %(first_ip)s to %(last_ip)s from "
+                          "range [%(first_ip)s; %(range_last_ip)s]",
+                          {'first_ip': taken[0], 'last_ip': taken[-1],
+                           'range_last_ip': ip_range['last_ip']})
+                # Allocations must exist before ranges are ever rebuilt
+                self.subnet_manager.create_allocations(session, taken)
+                ip_addresses.extend(taken)
+        return ip_addresses
+
+    def bulk_allocate(self, address_requests):
+        session = self._context.session
+        ip_addresses = [None] * len(address_requests)
+        any_indexes = []
+        with db_api.autonested_transaction(session):
+            # Specific addresses go first, in case they are next in line for
+            # automatic allocation
+            specific = set()
+            for index, address_request in enumerate(address_requests):
+                if not isinstance(address_request,
+                                  ipam_req.SpecificAddressRequest):
+                    any_indexes.append(index)
+                    continue
+                ip_address = str(address_request.address)
+                if ip_address in specific:
+                    raise ipam_exc.IpAddressAlreadyAllocated(
+                        subnet_id=self.subnet_manager.neutron_id,
+                        ip=ip_address)
+                self._verify_ip(session, ip_address)
+                self._allocate_specific_ip(session, ip_address)
+                specific.add(ip_address)
+                ip_addresses[index] = ip_address
+            self.subnet_manager.create_allocations(
+                session, [ip_address for ip_address in ip_addresses
+                          if ip_address])
+            for index, ip_address in zip(
+                    any_indexes, self._allocate_ips(session,
+                                                    len(any_indexes))):
+                ip_addresses[index] = ip_address
+        return ip_addresses
+
     def deallocate(self, address):
         # This is almost a no-op because the Neutron DB IPAM driver does not
         # delete IPAllocation objects, neither rebuilds availability ranges
@@ -376,7 +513,9 @@ class NeutronDbSubnet(ipam_base.Subnet):
         session = db_api.get_session()
         self.subnet_manager.delete_allocation_pools(session)
         self.create_allocation_pools(self.subnet_manager, session, pools, cidr)
+        self.subnet_manager.bump_ranges_revision(session)
         self._pools = pools
+        leases.drop_leases(self.subnet_manager._ipam_subnet_id)
 
     def get_details(self):
         """Return subnet data as a SpecificSubnetRequest"""
@@ -385,6 +524,254 @@ class NeutronDbSubnet(ipam_base.Subnet):
             self._cidr, self._gateway_ip, self._pools)
 
 
+def _is_bit_set(bitmap, offset):
+    return bitmap[offset >> 3] & (1 << (offset & 7))
+
+
+def _set_bit(bitmap, offset):
+    bitmap[offset >> 3] |= 1 << (offset & 7)
+
+
+def _clear_bit(bitmap, offset):
+    bitmap[offset >> 3] &= ~(1 << (offset & 7))
+
+
+def _first_clear_bit(bitmap):
+    """Return the offset of the first clear bit of bitmap, or None."""
+    # Skip fully allocated bytes without looping over them in python
+    index = len(bitmap) - len(bytes(bitmap).lstrip(b'\xff'))
+    if index == len(bitmap):
+        return None
+    offset = index << 3
+    while _is_bit_set(bitmap, offset):
+        offset += 1
+    return offset
+
+
+class NeutronDbBitmapSubnet(NeutronDbSubnet):
+    """Manage IP addresses with allocation bitmaps.
+
+    Each allocation pool is split into chunks of BITMAP_CHUNK_BITS addresses,
+    whose allocation state is kept as a bitmap in a single row. Allocating or
+    releasing an address flips one bit of one row, instead of splitting and
+    rewriting availability ranges, and automatic allocations pick a random
+    chunk with free addresses so that concurrent requests seldom update the
+    same row.
+
+    Subnets with pools larger than MAX_BITMAP_POOL_SIZE addresses, such as
+    IPv6 /64 subnets, are managed with availability ranges.
+    """
+
+    # Allocating from a bitmap chunk is cheap already
+    supports_leases = False
+
+    @staticmethod
+    def _use_bitmaps(pools):
+        return all(pool.size <= MAX_BITMAP_POOL_SIZE for pool in pools or [])
+
+    @classmethod
+    def create_allocation_pools(cls, subnet_manager, session, pools, cidr,
+                                allocated=None):
+        if not cls._use_bitmaps(pools):
+            return super(NeutronDbBitmapSubnet, cls).create_allocation_pools(
+                subnet_manager, session, pools, cidr)
+        # Sorted integer values of the addresses already allocated
+        allocated = sorted(allocated or [])
+        for pool in pools:
+            ip_pool = subnet_manager.create_pool(
+                session,
+                netaddr.IPAddress(pool.first, cidr.version).format(),
+                netaddr.IPAddress(pool.last, cidr.version).format(),
+                with_range=False)
+            cls._create_bitmap_chunks(subnet_manager, session, ip_pool,
+                                      pool, allocated)
+
+    @staticmethod
+    def _create_bitmap_chunks(subnet_manager, session, ip_pool, pool,
+                              allocated):
+        for index, start in enumerate(moves.range(
+                pool.first, pool.last + 1, BITMAP_CHUNK_BITS)):
+            size = min(BITMAP_CHUNK_BITS, pool.last - start + 1)
+            bitmap = bytearray(BITMAP_CHUNK_BITS // 8)
+            # Bits past the end of the pool are never free
+            for offset in moves.range(size, BITMAP_CHUNK_BITS):
+                _set_bit(bitmap, offset)
+            first = bisect.bisect_left(allocated, start)
+            last = bisect.bisect_left(allocated, start + size)
+            for ip_address in allocated[first:last]:
+                _set_bit(bitmap, ip_address - start)
+            subnet_manager.create_bitmap_chunk(
+                session, ip_pool, index, bytes(bitmap),
+                size - (last - first))
+
+    def _rebuild_bitmaps(self, session):
+        """Build the bitmaps of pools which have none.
+
+        This is the case of subnets created by the availability ranges
+        driver. Returns whether any bitmap was built.
+        """
+        allocated = None
+        for ip_pool in self.subnet_manager.list_pools(session):
+            if self.subnet_manager.get_bitmap_chunk(session, ip_pool['id'],
+                                                    0):
+                continue
+            if allocated is None:
+                allocated = sorted(
+                    int(netaddr.IPAddress(allocation['ip_address']))
+                    for allocation in self.subnet_manager.list_allocations(
+                        session))
+            LOG.debug("Building allocation bitmaps for pool %s",
+                      ip_pool['id'])
+            self._create_bitmap_chunks(
+                self.subnet_manager, session, ip_pool,
+                netaddr.IPRange(ip_pool['first_ip'], ip_pool['last_ip']),
+                allocated)
+        return allocated is not None
+
+    def _get_chunk(self, session, ip_address):
+        """Return the bitmap chunk of an address and its offset in it.
+
+        Returns None when the address is not within an allocation pool.
+        """
+        ip_address = int(netaddr.IPAddress(ip_address))
+        for pool in self.subnet_manager.list_pools(session):
+            first_ip = int(netaddr.IPAddress(pool['first_ip']))
+            if first_ip <= ip_address <= int(
+                    netaddr.IPAddress(pool['last_ip'])):
+                index, offset = divmod(ip_address - first_ip,
+                                       BITMAP_CHUNK_BITS)
+                chunk = self.subnet_manager.get_bitmap_chunk(
+                    session, pool['id'], index)
+                return chunk, offset
+
+    def _update_chunk(self, session, chunk, bitmap, free_count):
+        if not self.subnet_manager.update_bitmap_chunk(
+                session, chunk, bytes(bitmap), free_count):
+            # The chunk was updated by a concurrent operation
+            raise db_exc.RetryRequest(ipam_exc.IPAllocationFailed)
+
+    def _allocate_specific_ip(self, session, ip_address,
+                              allocation_pool_id=None,
+                              auto_generated=False):
+        if not self._use_bitmaps(self._pools):
+            return super(NeutronDbBitmapSubnet, self)._allocate_specific_ip(
+                session, ip_address, allocation_pool_id, auto_generated)
+        location = self._get_chunk(session, ip_address)
+        if not location or not location[0]:
+            # Addresses out of the pools are not tracked, but generated
+            # addresses must come from the pools
+            if auto_generated:
+                raise db_exc.RetryRequest(ipam_exc.IPAllocationFailed)
+            return
+        chunk, offset = location
+        bitmap = bytearray(chunk.bitmap)
+        if _is_bit_set(bitmap, offset):
+            raise db_exc.RetryRequest(ipam_exc.IPAllocationFailed)
+        _set_bit(bitmap, offset)
+        self._update_chunk(session, chunk, bitmap, chunk.free_count - 1)
+        LOG.debug("Marked %(ip_address)s as allocated in bitmap chunk "
+                  "%(index)d of pool %(pool_id)s",
+                  {'ip_address': ip_address, 'index': chunk.chunk_index,
+                   'pool_id': chunk.allocation_pool_id})
+
+    def _generate_ip(self, session):
+        if not self._use_bitmaps(self._pools):
+            return super(NeutronDbBitmapSubnet, self)._generate_ip(session)
+        chunks = self.subnet_manager.list_free_bitmap_chunks(session)
+        if not chunks and self._rebuild_bitmaps(session):
+            chunks = self.subnet_manager.list_free_bitmap_chunks(session)
+        if not chunks:
+            LOG.debug("All IPs from subnet %(subnet_id)s allocated",
+                      {'subnet_id': self.subnet_manager.neutron_id})
+            raise ipam_exc.IpAddressGenerationFailure(
+                subnet_id=self.subnet_manager.neutron_id)
+        pool_id, pool_first_ip, index = random.choice(chunks)
+        chunk = self.subnet_manager.get_bitmap_chunk(session, pool_id, index)
+        offset = chunk and _first_clear_bit(bytearray(chunk.bitmap))
+        if offset is None:
+            # The chunk was filled by a concurrent operation
+            raise db_exc.RetryRequest(ipam_exc.IPAllocationFailed)
+        ip_address = netaddr.IPAddress(
+            int(netaddr.IPAddress(pool_first_ip)) +
+            index * BITMAP_CHUNK_BITS + offset,
+            netaddr.IPNetwork(self._cidr).version)
+        return ip_address.format(), pool_id
+
+    def _allocate_ips(self, session, count):
+        if not self._use_bitmaps(self._pools):
+            return super(NeutronDbBitmapSubnet, self)._allocate_ips(session,
+                                                                    count)
+        if not count:
+            return []
+        chunks = self.subnet_manager.list_free_bitmap_chunks(session)
+        if not chunks and self._rebuild_bitmaps(session):
+            chunks = self.subnet_manager.list_free_bitmap_chunks(session)
+        # Fill random chunks, each with a single update
+        random.shuffle(chunks)
+        ip_version = netaddr.IPNetwork(self._cidr).version
+        ip_addresses = []
+        for pool_id, pool_first_ip, index in chunks:
+            chunk = self.subnet_manager.get_bitmap_chunk(session, pool_id,
+                                                         index)
+            if not chunk:
+                continue
+            bitmap = bytearray(chunk.bitmap)
+            offsets = []
+            while len(ip_addresses) + len(offsets) < count:
+                offset = _first_clear_bit(bitmap)
+                if offset is None:
+                    break
+                _set_bit(bitmap, offset)
+                offsets.append(offset)
+            if not offsets:
+                continue
+            self._update_chunk(session, chunk, bitmap,
+                               chunk.free_count - len(offsets))
+            start = (int(netaddr.IPAddress(pool_first_ip)) +
+                     index * BITMAP_CHUNK_BITS)
+            ip_addresses.extend(
+                netaddr.IPAddress(start + offset, ip_version).format()
+                for offset in offsets)
+            if len(ip_addresses) == count:
+                break
+        if len(ip_addresses) < count:
+            LOG.debug("All IPs from subnet %(subnet_id)s allocated",
+                      {'subnet_id': self.subnet_manager.neutron_id})
+            raise ipam_exc.IpAddressGenerationFailure(
+                subnet_id=self.subnet_manager.neutron_id)
+        self.subnet_manager.create_allocations(session, ip_addresses)
+        return ip_addresses
+
+    def deallocate(self, address):
+        super(NeutronDbBitmapSubnet, self).deallocate(address)
+        if not self._use_bitmaps(self._pools):
+            return
+        session = self._context.session
+        with db_api.autonested_transaction(session):
+            location = self._get_chunk(session, address)
+            if not location or not location[0]:
+                return
+            chunk, offset = location
+            bitmap = bytearray(chunk.bitmap)
+            if _is_bit_set(bitmap, offset):
+                _clear_bit(bitmap, offset)
+                self._update_chunk(session, chunk, bitmap,
+                                   chunk.free_count + 1)
+
+    def update_allocation_pools(self, pools, cidr):
+        # Bitmaps of the new pools must account for current allocations,
+        # which must not change meanwhile
+        session = self._context.session
+        with db_api.autonested_transaction(session):
+            allocated = [int(netaddr.IPAddress(allocation['ip_address']))
+                         for allocation in
+                         self.subnet_manager.list_allocations(session)]
+            self.subnet_manager.delete_allocation_pools(session)
+            self.create_allocation_pools(self.subnet_manager, session, pools,
+                                         cidr, allocated=allocated)
+        self._pools = pools
+
+
 class NeutronDbPool(subnet_alloc.SubnetAllocator):
     """Subnet pools backed by Neutron Database.
 
@@ -392,13 +779,15 @@ class NeutronDbPool(subnet_alloc.SubnetAllocator):
     operations are either trivial or no-ops.
     """
 
+    subnet_class = NeutronDbSubnet
+
     def get_subnet(self, subnet_id):
         """Retrieve an IPAM subnet.
 
         :param subnet_id: Neutron subnet identifier
         :returns: a NeutronDbSubnet instance
         """
-        return NeutronDbSubnet.load(subnet_id, self._context)
+        return self.subnet_class.load(subnet_id, self._context)
 
     def allocate_subnet(self, subnet_request):
         """Create an IPAMSubnet object for the provided cidr.
@@ -417,8 +806,8 @@ class NeutronDbPool(subnet_alloc.SubnetAllocator):
         if not isinstance(subnet_request, ipam_req.SpecificSubnetRequest):
             raise ipam_exc.InvalidSubnetRequestType(
                 subnet_type=type(subnet_request))
-        return NeutronDbSubnet.create_from_subnet_request(subnet_request,
-                                                          self._context)
+        return self.subnet_class.create_from_subnet_request(subnet_request,
+                                                            self._context)
 
     def update_subnet(self, subnet_request):
         """Update subnet info the in the IPAM driver.
@@ -435,7 +824,8 @@ class NeutronDbPool(subnet_alloc.SubnetAllocator):
                       "new allocation pools, there is nothing to do",
                       subnet_request.subnet_id)
             return
-        subnet = NeutronDbSubnet.load(subnet_request.subnet_id, self._context)
+        subnet = self.subnet_class.load(subnet_request.subnet_id,
+                                        self._context)
         cidr = netaddr.IPNetwork(subnet._cidr)
         subnet.update_allocation_pools(subnet_request.allocation_pools, cidr)
         return subnet
@@ -453,3 +843,9 @@ class NeutronDbPool(subnet_alloc.SubnetAllocator):
                           "Neutron subnet %s does not exist"),
                       subnet_id)
             raise n_exc.SubnetNotFound(subnet_id=subnet_id)
+
+
+class NeutronDbBitmapPool(NeutronDbPool):
+    """Subnet pools backed by Neutron Database, with allocation bitmaps."""
+
+    subnet_class = NeutronDbBitmapSubnet
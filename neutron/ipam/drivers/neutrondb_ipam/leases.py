@@ -0,0 +1,392 @@
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Blocks of addresses leased by a server process for fast allocation.
+
+A lease is a block of addresses removed at once from the availability ranges
+of a subnet. The process holding it hands its addresses out without touching
+the availability ranges, which are otherwise updated, and contended, by each
+allocation.
+
+A lease is taken in the transaction of the allocation that needed it, and
+is only shared with the other requests of the process once that transaction
+is committed, as its addresses go back to the ranges on rollback. Addresses
+handed out from a lease taken earlier go back to that lease when the
+transaction, or savepoint, they were handed out in is rolled back.
+
+Unused addresses are given back to the ranges when the lease expires and
+when the process exits, in a transaction of their own started once the
+transaction which found the lease expired has ended. Those of a process
+which dies are given back by the next rebuild of the availability ranges.
+Rebuilding the ranges or updating the pools increments the ranges revision
+of the subnet, and the leases taken at an earlier revision are dropped, as
+their addresses are back in the ranges.
+"""
+
+import atexit
+import collections
+import time
+
+import netaddr
+from oslo_concurrency import lockutils
+from oslo_config import cfg
+from oslo_db import exception as db_exc
+from oslo_log import log
+from sqlalchemy import event
+
+from neutron._i18n import _LE
+from neutron.db import api as db_api
+from neutron.ipam import utils as ipam_utils
+
+LOG = log.getLogger(__name__)
+
+# Key of the lease changes of the transactions of a session in session.info
+LEASE_CHANGES = 'ipam_lease_changes'
+
+# Leases shared by this process, by IPAM subnet identifier
+_leases = collections.defaultdict(list)
+_atexit_registered = False
+
+
+class IpLease(object):
+    """A block of consecutive addresses leased on a subnet."""
+
+    def __init__(self, subnet_manager, first, last, ip_version, ttl,
+                 ranges_revision):
+        self.subnet_manager = subnet_manager
+        self.ip_version = ip_version
+        self.ranges_revision = ranges_revision
+        # Integer values of the next address to hand out and of the last
+        # address of the lease; addresses are handed out in order, after
+        # those given back by rolled back transactions.
+        self.next_ip = ipam_utils.ip_to_int(first)
+        self.last_ip = ipam_utils.ip_to_int(last)
+        self.free_ips = []
+        self.expires_at = time.time() + ttl
+        self.published = False
+        self.dropped = False
+
+    @property
+    def ipam_subnet_id(self):
+        return self.subnet_manager._ipam_subnet_id
+
+    @property
+    def expired(self):
+        return time.time() >= self.expires_at
+
+    @property
+    def size(self):
+        return len(self.free_ips) + max(self.last_ip - self.next_ip + 1, 0)
+
+    def pop(self):
+        if self.free_ips:
+            ip = self.free_ips.pop()
+        else:
+            ip = self.next_ip
+            self.next_ip += 1
+        return netaddr.IPAddress(ip, self.ip_version).format()
+
+    def give_back(self, ip_address):
+        if not self.dropped:
+            self.free_ips.append(ipam_utils.ip_to_int(ip_address))
+
+    def clear(self):
+        """Forget the unused addresses."""
+        self.free_ips = []
+        self.next_ip = self.last_ip + 1
+
+    def drop(self):
+        """Forget the unused addresses, which are back in the ranges."""
+        self.dropped = True
+        self.clear()
+
+
+class _LeaseChanges(object):
+    """Lease changes of a transaction, applied when it ends."""
+
+    def __init__(self):
+        # Leases taken in the transaction
+        self.leases = []
+        # (lease, address) pairs of the addresses handed out
+        self.handed_out = []
+        # Leases to release once the outermost transaction has ended
+        self.expired = []
+
+    def update(self, changes):
+        self.leases.extend(changes.leases)
+        self.handed_out.extend(changes.handed_out)
+        self.expired.extend(changes.expired)
+
+
+def _lock_name(ipam_subnet_id):
+    return 'ipam-lease-%s' % ipam_subnet_id
+
+
+def _boundary(transaction):
+    """Return the transaction or savepoint a transaction ends with."""
+    while not (transaction.nested or transaction.parent is None):
+        transaction = transaction.parent
+    return transaction
+
+
+def _get_changes(session, transaction=None):
+    changes_by_transaction = session.info.get(LEASE_CHANGES)
+    if changes_by_transaction is None:
+        changes_by_transaction = session.info[LEASE_CHANGES] = {}
+        event.listen(session, 'after_commit', _after_commit)
+        event.listen(session, 'after_rollback', _after_rollback)
+    transaction = _boundary(transaction or session.transaction)
+    changes = changes_by_transaction.get(transaction)
+    if changes is None:
+        changes = changes_by_transaction[transaction] = _LeaseChanges()
+    return changes
+
+
+def _pending_leases(session):
+    """Return the leases taken so far by the transaction of a session."""
+    changes_by_transaction = session.info.get(LEASE_CHANGES, {})
+    leases = []
+    transaction = session.transaction
+    while transaction is not None:
+        changes = changes_by_transaction.get(transaction)
+        if changes:
+            leases.extend(changes.leases)
+        transaction = transaction.parent
+    return leases
+
+
+def _pop_changes(session):
+    """Pop the lease changes of the ending transaction of a session.
+
+    The changes of the savepoints nested within it are included.
+    """
+    transaction = _boundary(session.transaction)
+    changes_by_transaction = session.info[LEASE_CHANGES]
+    changes = _LeaseChanges()
+    for nested in list(changes_by_transaction):
+        parent = nested
+        while parent is not None and parent is not transaction:
+            parent = parent.parent
+        if parent is transaction:
+            changes.update(changes_by_transaction.pop(nested))
+    if transaction.parent is None:
+        event.remove(session, 'after_commit', _after_commit)
+        event.remove(session, 'after_rollback', _after_rollback)
+        del session.info[LEASE_CHANGES]
+    return transaction, changes
+
+
+def _after_commit(session):
+    transaction, changes = _pop_changes(session)
+    if transaction.parent is not None:
+        # A released savepoint is committed with its enclosing transaction
+        _get_changes(session, transaction.parent).update(changes)
+        return
+    _publish_leases(changes.leases)
+    _release_expired(changes.expired)
+
+
+def _after_rollback(session):
+    transaction, changes = _pop_changes(session)
+    # The leases taken are back in the ranges, and so are the addresses
+    # handed out from them
+    taken = set(changes.leases)
+    for lease, ip_address in changes.handed_out:
+        if lease not in taken:
+            with lockutils.lock(_lock_name(lease.ipam_subnet_id)):
+                lease.give_back(ip_address)
+                shared = _leases[lease.ipam_subnet_id]
+                if lease.published and lease not in shared:
+                    shared.append(lease)
+    if transaction.parent is not None:
+        _get_changes(session, transaction.parent).expired.extend(
+            changes.expired)
+        return
+    _release_expired(changes.expired)
+
+
+def _publish_leases(leases):
+    """Share the leases taken by a committed transaction."""
+    global _atexit_registered
+    for lease in leases:
+        with lockutils.lock(_lock_name(lease.ipam_subnet_id)):
+            lease.published = True
+            _leases[lease.ipam_subnet_id].append(lease)
+    if leases and not _atexit_registered:
+        atexit.register(release_leases)
+        _atexit_registered = True
+
+
+def _release_expired(leases):
+    for lease in leases:
+        with lockutils.lock(_lock_name(lease.ipam_subnet_id)):
+            _safe_release_lease(lease)
+
+
+def _take_block(session, subnet_manager, ip_version, ranges_revision):
+    """Remove a block of addresses from the first availability range.
+
+    Returns a lease over the block, or None when there is no range left or
+    when the range was changed by another process since it was read.
+    """
+    ip_range = subnet_manager.get_first_range(session)
+    if not ip_range:
+        return
+    first = ipam_utils.ip_to_int(ip_range['first_ip'])
+    last = min(first + cfg.CONF.ipam_lease_size - 1,
+               ipam_utils.ip_to_int(ip_range['last_ip']))
+    last_ip = netaddr.IPAddress(last, ip_version).format()
+    try:
+        if last_ip == ip_range['last_ip']:
+            updated = subnet_manager.delete_range(session, ip_range)
+        else:
+            updated = subnet_manager.update_range(
+                session, ip_range,
+                first_ip=netaddr.IPAddress(last + 1, ip_version))
+    except db_exc.RetryRequest:
+        updated = False
+    if not updated:
+        return
+    LOG.debug("Leased IPs %(first_ip)s to %(last_ip)s of subnet "
+              "%(subnet_id)s",
+              {'first_ip': ip_range['first_ip'], 'last_ip': last_ip,
+               'subnet_id': subnet_manager.neutron_id})
+    return IpLease(subnet_manager, ip_range['first_ip'], last_ip,
+                   ip_version, cfg.CONF.ipam_lease_ttl, ranges_revision)
+
+
+def _release_lease(lease):
+    """Give the unused addresses of a lease back to the availability ranges.
+
+    Only addresses still within an allocation pool are given back, leaving
+    out those allocated as specific addresses since the lease was taken, or
+    put back in the ranges by a rebuild. The ranges are updated in a
+    transaction of their own.
+    """
+    count = lease.size
+    if not count:
+        return
+    blocks = [(ip, ip) for ip in lease.free_ips]
+    if lease.next_ip <= lease.last_ip:
+        blocks.append((lease.next_ip, lease.last_ip))
+    subnet_manager = lease.subnet_manager
+    session = db_api.get_session()
+    with session.begin():
+        allocated = set(
+            ipam_utils.ip_to_int(ip_address) for ip_address, in
+            subnet_manager.list_allocation_addresses(session))
+        ip_ranges = [(ipam_utils.ip_to_int(ip_range['first_ip']),
+                      ipam_utils.ip_to_int(ip_range['last_ip']))
+                     for ip_range in
+                     subnet_manager.list_ranges_by_subnet_id(session)]
+        pools = list(subnet_manager.list_pools(session))
+        ranges = []
+        for first, last in blocks:
+            unavailable = set(ip for ip in allocated if first <= ip <= last)
+            for range_first, range_last in ip_ranges:
+                ip = max(first, range_first)
+                while ip <= min(last, range_last):
+                    unavailable.add(ip)
+                    ip += 1
+            unavailable = sorted(unavailable)
+            for pool in pools:
+                for free_first, free_last in ipam_utils.iter_free_ranges(
+                        max(first, ipam_utils.ip_to_int(pool['first_ip'])),
+                        min(last, ipam_utils.ip_to_int(pool['last_ip'])),
+                        unavailable):
+                    ranges.append({
+                        'allocation_pool_id': pool['id'],
+                        'first_ip': netaddr.IPAddress(
+                            free_first, lease.ip_version).format(),
+                        'last_ip': netaddr.IPAddress(
+                            free_last, lease.ip_version).format()})
+        subnet_manager.create_ranges(session, ranges)
+    lease.clear()
+    LOG.debug("Released %(count)d leased IPs of subnet %(subnet_id)s",
+              {'count': count, 'subnet_id': subnet_manager.neutron_id})
+
+
+def _safe_release_lease(lease):
+    try:
+        _release_lease(lease)
+    except Exception:
+        # The addresses are given back by the next rebuild of the ranges
+        LOG.exception(_LE("Failed to release leased IPs of subnet %s"),
+                      lease.subnet_manager.neutron_id)
+
+
+def get_leased_ip(session, subnet_manager, ip_version, in_pools):
+    """Return an address from a lease of this process on a subnet.
+
+    Leases taken earlier in the current transaction are used first, then
+    those shared by the process. A new lease is taken when they are all
+    exhausted, and expired leases are released once the transaction has
+    ended. Returns None when no address could be leased; the caller is then
+    expected to allocate from the availability ranges.
+
+    :param session: database session of the allocation.
+    :param subnet_manager: IpamSubnetManager of the subnet.
+    :param ip_version: IP version of the subnet.
+    :param in_pools: callable telling whether an address is still within
+        the allocation pools of the subnet, which may have been updated
+        since the lease was taken.
+    """
+    ipam_subnet_id = subnet_manager._ipam_subnet_id
+    ranges_revision = subnet_manager.get_ranges_revision(session)
+    changes = _get_changes(session)
+    pending = [lease for lease in _pending_leases(session)
+               if lease.ipam_subnet_id == ipam_subnet_id]
+    with lockutils.lock(_lock_name(ipam_subnet_id)):
+        shared = _leases.get(ipam_subnet_id, [])
+        for lease in list(shared):
+            if lease.expired or not lease.size:
+                shared.remove(lease)
+                if lease.size:
+                    changes.expired.append(lease)
+        for lease in pending + shared:
+            if lease.size and lease.ranges_revision != ranges_revision:
+                LOG.debug("Dropping lease of subnet %(subnet_id)s, whose "
+                          "IPs are available again",
+                          {'subnet_id': subnet_manager.neutron_id})
+                lease.drop()
+            while lease.size:
+                ip_address = lease.pop()
+                if in_pools(ip_address):
+                    changes.handed_out.append((lease, ip_address))
+                    return ip_address
+        if not shared:
+            _leases.pop(ipam_subnet_id, None)
+    lease = _take_block(session, subnet_manager, ip_version, ranges_revision)
+    if lease:
+        changes.leases.append(lease)
+        return lease.pop()
+
+
+def drop_leases(ipam_subnet_id):
+    """Forget the leases of this process on a subnet, without releasing them.
+
+    This is meant for subnets whose availability ranges are recreated from
+    their allocation pools, which gives the leased addresses back already.
+    """
+    with lockutils.lock(_lock_name(ipam_subnet_id)):
+        for lease in _leases.pop(ipam_subnet_id, []):
+            lease.drop()
+
+
+def release_leases():
+    """Release every lease shared by this process, e.g. on shutdown."""
+    for ipam_subnet_id in list(_leases):
+        with lockutils.lock(_lock_name(ipam_subnet_id)):
+            for lease in _leases.pop(ipam_subnet_id, []):
+                _safe_release_lease(lease)
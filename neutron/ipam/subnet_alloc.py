@@ -13,14 +13,18 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 import math
 import operator
 
 import netaddr
 from oslo_db import exception as db_exc
+from oslo_log import log as logging
 from oslo_utils import uuidutils
+import sqlalchemy as sa
+from sqlalchemy import event
 
-from neutron._i18n import _
+from neutron._i18n import _, _LW
 from neutron.api.v2 import attributes
 from neutron.common import constants
 from neutron.common import exceptions as n_exc
@@ -29,6 +33,167 @@ from neutron.ipam import driver
 from neutron.ipam import requests as ipam_req
 from neutron.ipam import utils as ipam_utils
 
+LOG = logging.getLogger(__name__)
+
+
+def _ip_key(ip):
+    """Return a fixed width string sorting like the integer value of ip."""
+    return '%032x' % int(ip)
+
+
+def _free_prefix_row(subnetpool_id, prefix):
+    return {'subnetpool_id': subnetpool_id,
+            'cidr': str(prefix.cidr),
+            'prefixlen': prefix.prefixlen,
+            'first_ip': _ip_key(prefix.first),
+            'last_ip': _ip_key(prefix.last)}
+
+
+def _is_pool_subnet(subnetpool_id):
+    return subnetpool_id and subnetpool_id != constants.IPV6_PD_POOL_ID
+
+
+def _release_subnet_prefix(mapper, connection, subnet):
+    """Give the prefix of a deleted subnet back to its subnet pool.
+
+    The prefix is merged with its buddy, then the buddy of the merged block,
+    and so forth while they are free and within a prefix of the pool.
+    """
+    subnetpool_id = subnet.subnetpool_id
+    if not _is_pool_subnet(subnetpool_id):
+        return
+    # Serialize with allocations from the pool, see _lock_subnetpool
+    connection.execute(models_v2.SubnetPool.__table__.update().where(
+        models_v2.SubnetPool.id == subnetpool_id).values(
+            hash=uuidutils.generate_uuid()))
+    prefixes = [netaddr.IPNetwork(cidr) for cidr, in connection.execute(
+        sa.select([models_v2.SubnetPoolPrefix.cidr]).where(
+            models_v2.SubnetPoolPrefix.subnetpool_id == subnetpool_id))]
+    free_prefixes = models_v2.SubnetPoolFreePrefix.__table__
+    block = netaddr.IPNetwork(subnet.cidr)
+    while block.prefixlen:
+        supernet = block.supernet(block.prefixlen - 1)[0]
+        if not any(prefix.first <= supernet.first and
+                   supernet.last <= prefix.last for prefix in prefixes):
+            break
+        buddy = [half for half in supernet.subnet(block.prefixlen)
+                 if half != block][0]
+        merged = connection.execute(free_prefixes.delete().where(sa.and_(
+            free_prefixes.c.subnetpool_id == subnetpool_id,
+            free_prefixes.c.cidr == str(buddy)))).rowcount
+        if not merged:
+            break
+        block = supernet
+    connection.execute(free_prefixes.insert(),
+                       _free_prefix_row(subnetpool_id, block))
+
+
+def _count_pool_subnet(connection, subnetpool_id, tenant_id, cidr, delta):
+    """Add delta to the quota usage counter of a subnet pool subnet."""
+    if not _is_pool_subnet(subnetpool_id):
+        return
+    quota_usages = models_v2.SubnetPoolQuotaUsage.__table__
+    key = {'subnetpool_id': subnetpool_id,
+           'tenant_id': tenant_id,
+           'prefixlen': netaddr.IPNetwork(cidr).prefixlen}
+    updated = connection.execute(quota_usages.update().where(sa.and_(
+        *[quota_usages.c[column] == value for column, value in key.items()]
+    )).values(subnet_count=quota_usages.c.subnet_count + delta)).rowcount
+    if not updated and delta > 0:
+        # NOTE: the first subnet of a tenant in a pool is allocated while
+        # holding the pool lock, so the row cannot be inserted concurrently
+        key['subnet_count'] = delta
+        connection.execute(quota_usages.insert(), key)
+
+
+def _count_created_subnet(mapper, connection, subnet):
+    _count_pool_subnet(connection, subnet.subnetpool_id, subnet.tenant_id,
+                       subnet.cidr, 1)
+
+
+def _count_updated_subnet(mapper, connection, subnet):
+    state = sa.inspect(subnet)
+    old_values = {}
+    for attr in ('subnetpool_id', 'tenant_id', 'cidr'):
+        history = state.attrs[attr].history
+        if history.deleted:
+            old_values[attr] = history.deleted[0]
+    if old_values:
+        _count_pool_subnet(connection,
+                           old_values.get('subnetpool_id',
+                                          subnet.subnetpool_id),
+                           old_values.get('tenant_id', subnet.tenant_id),
+                           old_values.get('cidr', subnet.cidr), -1)
+        _count_created_subnet(mapper, connection, subnet)
+
+
+def _count_deleted_subnet(mapper, connection, subnet):
+    _count_pool_subnet(connection, subnet.subnetpool_id, subnet.tenant_id,
+                       subnet.cidr, -1)
+
+
+event.listen(models_v2.Subnet, 'after_delete', _release_subnet_prefix)
+event.listen(models_v2.Subnet, 'after_insert', _count_created_subnet)
+event.listen(models_v2.Subnet, 'after_update', _count_updated_subnet)
+event.listen(models_v2.Subnet, 'after_delete', _count_deleted_subnet)
+
+
+def verify_subnetpool_quota_usages(context):
+    """Repair the quota usage counters of subnet pools which drifted.
+
+    The counters of each pool are compared with its subnets while holding
+    the pool lock, so that no subnet is concurrently allocated from or
+    removed from the pool. Returns the number of counters repaired.
+    """
+    session = context.session
+    quota_usage = models_v2.SubnetPoolQuotaUsage
+    repaired = 0
+    for subnetpool_id, in session.query(models_v2.SubnetPool.id).all():
+        with session.begin(subtransactions=True):
+            # See SubnetAllocator._lock_subnetpool
+            session.query(models_v2.SubnetPool).filter_by(
+                id=subnetpool_id).update(
+                    {'hash': uuidutils.generate_uuid()},
+                    synchronize_session=False)
+            subnets = session.query(
+                models_v2.Subnet.tenant_id, models_v2.Subnet.cidr).filter_by(
+                    subnetpool_id=subnetpool_id)
+            expected = collections.Counter(
+                (tenant_id, netaddr.IPNetwork(cidr).prefixlen)
+                for tenant_id, cidr in subnets)
+            counted = dict(
+                ((tenant_id, prefixlen), subnet_count)
+                for tenant_id, prefixlen, subnet_count in session.query(
+                    quota_usage.tenant_id, quota_usage.prefixlen,
+                    quota_usage.subnet_count).filter_by(
+                        subnetpool_id=subnetpool_id))
+            for key in set(expected) | set(counted):
+                if expected.get(key, 0) == counted.get(key, 0):
+                    continue
+                tenant_id, prefixlen = key
+                LOG.warning(_LW("Repairing quota usage of tenant %(tenant)s "
+                                "in subnet pool %(pool)s for /%(prefixlen)s "
+                                "subnets: counted %(counted)s, found "
+                                "%(found)s"),
+                            {'tenant': tenant_id, 'pool': subnetpool_id,
+                             'prefixlen': prefixlen,
+                             'counted': counted.get(key),
+                             'found': expected.get(key, 0)})
+                query = session.query(quota_usage).filter_by(
+                    subnetpool_id=subnetpool_id, tenant_id=tenant_id,
+                    prefixlen=prefixlen)
+                if key not in counted:
+                    session.add(quota_usage(
+                        subnetpool_id=subnetpool_id, tenant_id=tenant_id,
+                        prefixlen=prefixlen, subnet_count=expected[key]))
+                elif key in expected:
+                    query.update({'subnet_count': expected[key]},
+                                 synchronize_session=False)
+                else:
+                    query.delete(synchronize_session=False)
+                repaired += 1
+    return repaired
+
 
 class SubnetAllocator(driver.Pool):
     """Class for handling allocation of subnet prefixes from a subnet pool.
@@ -83,6 +248,71 @@ class SubnetAllocator(driver.Pool):
                       key=operator.attrgetter('prefixlen'),
                       reverse=True)
 
+    def _free_prefix_query(self):
+        return self._context.session.query(
+            models_v2.SubnetPoolFreePrefix).filter_by(
+                subnetpool_id=self._subnetpool['id'])
+
+    def _rebuild_free_prefixes(self):
+        """Rebuild the free prefix index of the subnet pool.
+
+        The index is rebuilt from the subnets of the pool when the pool is
+        not indexed: it was created before the index existed, or since the
+        last update of its prefixes.
+        """
+        self._free_prefix_query().delete(synchronize_session=False)
+        rows = [_free_prefix_row(self._subnetpool['id'], prefix)
+                for prefix in self._get_available_prefix_list()]
+        if rows:
+            self._context.session.execute(
+                models_v2.SubnetPoolFreePrefix.__table__.insert(), rows)
+        self._context.session.query(models_v2.SubnetPool).filter_by(
+            id=self._subnetpool['id']).update(
+                {'free_prefixes_indexed': True}, synchronize_session=False)
+
+    def _find_free_prefix(self, lookup):
+        # Read while holding the pool lock, as the prefixes may have been
+        # updated since the pool was loaded
+        indexed = self._context.session.query(
+            models_v2.SubnetPool.free_prefixes_indexed).filter_by(
+                id=self._subnetpool['id']).scalar()
+        if not indexed:
+            self._rebuild_free_prefixes()
+        return lookup()
+
+    def _best_fit_free_prefix(self, prefixlen):
+        """Return the smallest free block a prefixlen subnet fits in."""
+        free_prefix = models_v2.SubnetPoolFreePrefix
+        return self._free_prefix_query().filter(
+            free_prefix.prefixlen <= prefixlen).order_by(
+                free_prefix.prefixlen.desc(), free_prefix.first_ip).first()
+
+    def _containing_free_prefix(self, cidr):
+        """Return the free block containing cidr, if any."""
+        free_prefix = models_v2.SubnetPoolFreePrefix
+        # Free blocks are disjoint: only the last one starting before cidr
+        # may contain it
+        block = self._free_prefix_query().filter(
+            free_prefix.first_ip <= _ip_key(cidr.first)).order_by(
+                free_prefix.first_ip.desc()).first()
+        if block and block.last_ip >= _ip_key(cidr.last):
+            return block
+
+    def _take_free_prefix(self, block, cidr):
+        """Remove cidr from a free block.
+
+        The rest of the block is kept free, as the buddies of cidr and of
+        its supernets within the block.
+        """
+        self._free_prefix_query().filter_by(cidr=block.cidr).delete(
+            synchronize_session=False)
+        remainder = netaddr.IPSet([block.cidr]) - netaddr.IPSet([cidr])
+        rows = [_free_prefix_row(self._subnetpool['id'], prefix)
+                for prefix in remainder.iter_cidrs()]
+        if rows:
+            self._context.session.execute(
+                models_v2.SubnetPoolFreePrefix.__table__.insert(), rows)
+
     def _num_quota_units_in_prefixlen(self, prefixlen, quota_unit):
         return math.pow(2, quota_unit - prefixlen)
 
@@ -90,14 +320,17 @@ class SubnetAllocator(driver.Pool):
         subnetpool_id = self._subnetpool['id']
         tenant_id = self._subnetpool['tenant_id']
         with self._context.session.begin(subtransactions=True):
-            qry = self._context.session.query(models_v2.Subnet)
-            allocations = qry.filter_by(subnetpool_id=subnetpool_id,
-                                        tenant_id=tenant_id)
+            # Subnets are counted by prefix length as they are created and
+            # deleted, see _count_pool_subnet
+            qry = self._context.session.query(
+                models_v2.SubnetPoolQuotaUsage.prefixlen,
+                models_v2.SubnetPoolQuotaUsage.subnet_count)
+            usages = qry.filter_by(subnetpool_id=subnetpool_id,
+                                   tenant_id=tenant_id)
             value = 0
-            for allocation in allocations:
-                prefixlen = netaddr.IPNetwork(allocation.cidr).prefixlen
-                value += self._num_quota_units_in_prefixlen(prefixlen,
-                                                            quota_unit)
+            for prefixlen, subnet_count in usages:
+                value += subnet_count * self._num_quota_units_in_prefixlen(
+                    prefixlen, quota_unit)
             return value
 
     def _check_subnetpool_tenant_quota(self, tenant_id, prefixlen):
@@ -118,24 +351,27 @@ class SubnetAllocator(driver.Pool):
             self._lock_subnetpool()
             self._check_subnetpool_tenant_quota(request.tenant_id,
                                                 request.prefixlen)
-            prefix_pool = self._get_available_prefix_list()
-            for prefix in prefix_pool:
-                if request.prefixlen >= prefix.prefixlen:
-                    subnet = next(prefix.subnet(request.prefixlen))
-                    gateway_ip = request.gateway_ip
-                    if not gateway_ip:
-                        gateway_ip = subnet.network + 1
-                    pools = ipam_utils.generate_pools(subnet.cidr,
-                                                      gateway_ip)
-
-                    return IpamSubnet(request.tenant_id,
-                                      request.subnet_id,
-                                      subnet.cidr,
-                                      gateway_ip=gateway_ip,
-                                      allocation_pools=pools)
-            msg = _("Insufficient prefix space to allocate subnet size /%s")
-            raise n_exc.SubnetAllocationError(reason=msg %
-                                              str(request.prefixlen))
+            block = self._find_free_prefix(
+                lambda: self._best_fit_free_prefix(request.prefixlen))
+            if block is None:
+                msg = _("Insufficient prefix space to allocate subnet size "
+                        "/%s")
+                raise n_exc.SubnetAllocationError(reason=msg %
+                                                  str(request.prefixlen))
+            subnet = next(netaddr.IPNetwork(block.cidr).subnet(
+                request.prefixlen))
+            self._take_free_prefix(block, subnet)
+            gateway_ip = request.gateway_ip
+            if not gateway_ip:
+                gateway_ip = subnet.network + 1
+            pools = ipam_utils.generate_pools(subnet.cidr,
+                                              gateway_ip)
+
+            return IpamSubnet(request.tenant_id,
+                              request.subnet_id,
+                              subnet.cidr,
+                              gateway_ip=gateway_ip,
+                              allocation_pools=pools)
 
     def _allocate_specific_subnet(self, request):
         with self._context.session.begin(subtransactions=True):
@@ -143,9 +379,10 @@ class SubnetAllocator(driver.Pool):
             self._check_subnetpool_tenant_quota(request.tenant_id,
                                                 request.prefixlen)
             cidr = request.subnet_cidr
-            available = self._get_available_prefix_list()
-            matched = netaddr.all_matching_cidrs(cidr, available)
-            if len(matched) is 1 and matched[0].prefixlen <= cidr.prefixlen:
+            block = self._find_free_prefix(
+                lambda: self._containing_free_prefix(cidr))
+            if block is not None:
+                self._take_free_prefix(block, cidr)
                 return IpamSubnet(request.tenant_id,
                                   request.subnet_id,
                                   cidr,
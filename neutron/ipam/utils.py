@@ -13,8 +13,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import binascii
+import bisect
+import socket
+
 import netaddr
 
+# Number of allocations fetched at once when rebuilding availability ranges
+REBUILD_BATCH_SIZE = 1000
+
 
 def check_subnet_ip(cidr, ip_address):
     """Validate that the IP address is on the subnet."""
@@ -59,3 +66,34 @@ def generate_pools(cidr, gateway_ip):
     if gateway_ip:
         ipset.remove(netaddr.IPAddress(gateway_ip, ip_version))
     return list(ipset.iter_ipranges())
+
+
+def ip_to_int(ip_address):
+    """Return the integer value of an IP address string.
+
+    This is much cheaper than building a netaddr.IPAddress, which matters
+    when converting every address allocated on a large subnet.
+    """
+    family = socket.AF_INET6 if ':' in ip_address else socket.AF_INET
+    return int(binascii.hexlify(socket.inet_pton(family, ip_address)), 16)
+
+
+def iter_free_ranges(first, last, allocated):
+    """Yield the (first, last) ranges of free addresses in a pool.
+
+    The pool is walked once, jumping from an allocated address to the next.
+
+    :param first: integer value of the first address of the pool.
+    :param last: integer value of the last address of the pool.
+    :param allocated: sorted list of the integer values of the allocated
+                      addresses. Addresses out of the pool are ignored.
+    """
+    next_free = first
+    index = bisect.bisect_left(allocated, first)
+    while index < len(allocated) and allocated[index] <= last:
+        if allocated[index] > next_free:
+            yield next_free, allocated[index] - 1
+        next_free = max(next_free, allocated[index] + 1)
+        index += 1
+    if next_free <= last:
+        yield next_free, last
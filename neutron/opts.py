@@ -31,6 +31,8 @@ import neutron.db.agents_db
 import neutron.db.agentschedulers_db
 import neutron.db.dvr_mac_db
 import neutron.db.extraroute_db
+import neutron.db.ip_usage_db
+import neutron.db.ip_usage_history_db
 import neutron.db.l3_agentschedulers_db
 import neutron.db.l3_dvr_db
 import neutron.db.l3_gwmode_db
@@ -114,7 +116,9 @@ def list_db_opts():
              neutron.db.dvr_mac_db.dvr_mac_address_opts,
              neutron.db.l3_dvr_db.router_distributed_opts,
              neutron.db.l3_agentschedulers_db.L3_AGENTS_SCHEDULER_OPTS,
-             neutron.db.l3_hamode_db.L3_HA_OPTS)
+             neutron.db.l3_hamode_db.L3_HA_OPTS,
+             neutron.db.ip_usage_db.IP_USAGE_OPTS,
+             neutron.db.ip_usage_history_db.IP_USAGE_HISTORY_OPTS)
          ),
         ('database',
          neutron.db.migration.cli.get_engine_config())
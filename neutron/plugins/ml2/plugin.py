@@ -23,6 +23,7 @@ from oslo_serialization import jsonutils
 from oslo_utils import excutils
 from oslo_utils import importutils
 from oslo_utils import uuidutils
+import six
 from sqlalchemy import exc as sql_exc
 from sqlalchemy.orm import exc as sa_exc
 
@@ -106,10 +107,11 @@ class Ml2Plugin(db_base_plugin_v2.NeutronDbPluginV2,
     """
 
     # This attribute specifies whether the plugin supports or not
-    # bulk/pagination/sorting operations. Name mangling is used in
-    # order to ensure it is qualified by class
+    # bulk/pagination/keyset pagination/sorting operations. Name mangling
+    # is used in order to ensure it is qualified by class
     __native_bulk_support = True
     __native_pagination_support = True
+    __native_keyset_pagination_support = True
     __native_sorting_support = True
 
     # List of supported extensions
@@ -580,21 +582,37 @@ class Ml2Plugin(db_base_plugin_v2.NeutronDbPluginV2,
         objects = []
         collection = "%ss" % resource
         items = request_items[collection]
+        obj_creator = getattr(self, '_create_%s_db' % resource)
+        # Resources with a batched creation method are created at once,
+        # unless the creation of a single one, which the batched method
+        # reimplements, was overridden by a subclass or on this instance
+        bulk_creator = getattr(self, '_create_%s_db' % collection, None)
+        if (getattr(obj_creator, '__func__', None) is not
+                six.get_unbound_function(
+                    getattr(Ml2Plugin, '_create_%s_db' % resource))):
+            bulk_creator = None
         try:
             with context.session.begin(subtransactions=True):
-                obj_creator = getattr(self, '_create_%s_db' % resource)
-                for item in items:
-                    attrs = item[resource]
-                    result, mech_context = obj_creator(context, item)
-                    objects.append({'mech_context': mech_context,
-                                    'result': result,
-                                    'attributes': attrs})
+                if bulk_creator:
+                    objects = bulk_creator(context, items)
+                else:
+                    for item in items:
+                        attrs = item[resource]
+                        result, mech_context = obj_creator(context, item)
+                        objects.append({'mech_context': mech_context,
+                                        'result': result,
+                                        'attributes': attrs})
 
         except Exception:
             with excutils.save_and_reraise_exception():
-                LOG.exception(_LE("An exception occurred while creating "
-                                  "the %(resource)s:%(item)s"),
-                              {'resource': resource, 'item': item})
+                if bulk_creator:
+                    LOG.exception(_LE("An exception occurred while creating "
+                                      "the %(collection)s:%(items)s"),
+                                  {'collection': collection, 'items': items})
+                else:
+                    LOG.exception(_LE("An exception occurred while creating "
+                                      "the %(resource)s:%(item)s"),
+                                  {'resource': resource, 'item': item})
 
         try:
             postcommit_op = getattr(self.mechanism_manager,
@@ -717,6 +735,11 @@ class Ml2Plugin(db_base_plugin_v2.NeutronDbPluginV2,
 
     def get_networks(self, context, filters=None, fields=None,
                      sorts=None, limit=None, marker=None, page_reverse=False):
+        if (self._can_project_fields(models_v2.Network, fields) and
+                not set(filters or {}) & set(provider.ATTRIBUTES)):
+            # Provider attributes are neither asked for nor filtered on
+            return super(Ml2Plugin, self).get_networks(
+                context, filters, fields, sorts, limit, marker, page_reverse)
         session = context.session
         with session.begin(subtransactions=True):
             nets = super(Ml2Plugin,
@@ -1022,30 +1045,67 @@ class Ml2Plugin(db_base_plugin_v2.NeutronDbPluginV2,
 
         session = context.session
         with session.begin(subtransactions=True):
-            dhcp_opts = attrs.get(edo_ext.EXTRADHCPOPTS, [])
             result = super(Ml2Plugin, self).create_port(context, port)
-            self.extension_manager.process_create_port(context, attrs, result)
-            self._portsec_ext_port_create_processing(context, result, port)
-
-            # sgids must be got after portsec checked with security group
-            sgids = self._get_security_groups_on_port(context, port)
-            self._process_port_create_security_group(context, result, sgids)
             network = self.get_network(context, result['network_id'])
-            binding = db.add_port_binding(session, result['id'])
-            mech_context = driver_context.PortContext(self, context, result,
-                                                      network, binding, None)
-            self._process_port_binding(mech_context, attrs)
-
-            result[addr_pair.ADDRESS_PAIRS] = (
-                self._process_create_allowed_address_pairs(
-                    context, result,
-                    attrs.get(addr_pair.ADDRESS_PAIRS)))
-            self._process_port_create_extra_dhcp_opts(context, result,
-                                                      dhcp_opts)
-            self.mechanism_manager.create_port_precommit(mech_context)
+            mech_context = self._process_created_port_db(context, port,
+                                                         result, network)
 
         return result, mech_context
 
+    def _create_ports_db(self, context, ports):
+        """Create several ports in a single transaction.
+
+        The port records are created in a batch by the base plugin, each
+        network is fetched once, then every port goes through the extension
+        processing and mechanism driver precommit of _create_port_db.
+
+        :returns: list of dicts with the result, mech_context and
+            attributes of each port.
+        """
+        for port in ports:
+            attrs = port[attributes.PORT]
+            if not attrs.get('status'):
+                attrs['status'] = const.PORT_STATUS_DOWN
+
+        objects = []
+        with context.session.begin(subtransactions=True):
+            results = super(Ml2Plugin, self)._create_ports_db(context, ports)
+            networks = {}
+            for port, result in zip(ports, results):
+                network_id = result['network_id']
+                if network_id not in networks:
+                    networks[network_id] = self.get_network(context,
+                                                            network_id)
+                mech_context = self._process_created_port_db(
+                    context, port, result, networks[network_id])
+                objects.append({'mech_context': mech_context,
+                                'result': result,
+                                'attributes': port[attributes.PORT]})
+        return objects
+
+    def _process_created_port_db(self, context, port, result, network):
+        attrs = port[attributes.PORT]
+        dhcp_opts = attrs.get(edo_ext.EXTRADHCPOPTS, [])
+        self.extension_manager.process_create_port(context, attrs, result)
+        self._portsec_ext_port_create_processing(context, result, port)
+
+        # sgids must be got after portsec checked with security group
+        sgids = self._get_security_groups_on_port(context, port)
+        self._process_port_create_security_group(context, result, sgids)
+        binding = db.add_port_binding(context.session, result['id'])
+        mech_context = driver_context.PortContext(self, context, result,
+                                                  network, binding, None)
+        self._process_port_binding(mech_context, attrs)
+
+        result[addr_pair.ADDRESS_PAIRS] = (
+            self._process_create_allowed_address_pairs(
+                context, result,
+                attrs.get(addr_pair.ADDRESS_PAIRS)))
+        self._process_port_create_extra_dhcp_opts(context, result,
+                                                  dhcp_opts)
+        self.mechanism_manager.create_port_precommit(mech_context)
+        return mech_context
+
     def create_port(self, context, port):
         result, mech_context = self._create_port_db(context, port)
         # notify any plugin that is interested in port create events
@@ -1574,4 +1634,5 @@ class Ml2Plugin(db_base_plugin_v2.NeutronDbPluginV2,
         return device
 
     def get_workers(self):
-        return self.mechanism_manager.get_workers()
+        return (list(super(Ml2Plugin, self).get_workers()) +
+                self.mechanism_manager.get_workers())
@@ -13,17 +13,25 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+from oslo_config import cfg
+
 import neutron.db.db_base_plugin_v2 as db_base_plugin_v2
 import neutron.db.ip_usage_db as usage_db
+import neutron.db.ip_usage_history_db as usage_history_db
+import neutron.worker as neutron_worker
 
 
 class IpUsagePlugin(usage_db.IpUsageMixin,
+                    usage_history_db.IpUsageHistoryMixin,
                     db_base_plugin_v2.NeutronDbPluginV2):
     """This plugin exposes IP usage data for networks and subnets."""
     _instance = None
 
     supported_extension_aliases = ["network-ip-usage"]
 
+    __native_pagination_support = True
+    __native_sorting_support = True
+
     @classmethod
     def get_instance(cls):
         if cls._instance is None:
@@ -36,12 +44,52 @@ class IpUsagePlugin(usage_db.IpUsageMixin,
     def get_plugin_type(self):
         return "network-ip-usage"
 
-    def get_network_ip_usages(self, context, filters=None, fields=None):
+    def get_workers(self):
+        interval = cfg.CONF.ip_usage_snapshot_interval
+        if not interval:
+            return ()
+        # Snapshots are taken by a dedicated worker rather than by every
+        # API worker
+        return [neutron_worker.PeriodicWorker(
+            usage_history_db.record_subnet_ip_usages, interval)]
+
+    def get_network_ip_usages(self, context, filters=None, fields=None,
+                              sorts=None, limit=None, marker=None,
+                              page_reverse=False):
         """Returns ip usage data for a collection of networks."""
-        return self.get_network_ip_allocations(context, filters)
+        marker_obj = self._get_marker_obj(context, 'network', limit, marker)
+        result = self.get_network_ip_allocations(context, filters,
+                                                 fields=fields, sorts=sorts,
+                                                 limit=limit,
+                                                 marker_obj=marker_obj,
+                                                 page_reverse=page_reverse)
+        return [self._fields(usage, fields) for usage in result]
 
     def get_network_ip_usage(self, context, id, fields=None):
         """Return ip usage data for a specific network id."""
         filters = {'network_id': id}
-        result = self.get_network_ip_allocations(context, filters)
-        return result[0] if result else []
+        result = self.get_network_ip_allocations(context, filters,
+                                                 fields=fields)
+        return self._fields(result[0], fields) if result else []
+
+    def get_network_ip_usage_histories(self, context, network_ip_usage_id,
+                                       filters=None, fields=None):
+        """Return the usage history of the subnets of a network."""
+        # Raise NetworkNotFound for unknown networks
+        self._get_network(context, network_ip_usage_id)
+        result = self.get_ip_usage_histories(context, network_ip_usage_id,
+                                             filters=filters)
+        return [self._fields(history, fields) for history in result]
+
+    def get_network_ip_usage_history(self, context, id, network_ip_usage_id,
+                                     fields=None):
+        """Return the usage history of a subnet of a network."""
+        self._get_network(context, network_ip_usage_id)
+        result = self.get_ip_usage_histories(context, network_ip_usage_id,
+                                             subnet_id=id)
+        if not result:
+            # Either the subnet does not exist or it has no history yet
+            self._get_subnet(context, id)
+            return self._fields({'id': id, 'samples': [],
+                                 'exhaustion_date': None}, fields)
+        return self._fields(result[0], fields)
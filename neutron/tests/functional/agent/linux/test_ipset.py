@@ -52,6 +52,7 @@ class IpsetBase(functional_base.BaseSudoTestCase):
             namespace=dst_ns.namespace)
 
         ipset._create_set(set_name, IPSET_ETHERTYPE)
+        ipset._apply_pending()
         return ipset
 
     def _remove_iptables_ipset_rules(self):
@@ -71,29 +72,39 @@ class IpsetBase(functional_base.BaseSudoTestCase):
 
 class IpsetManagerTestCase(IpsetBase):
 
+    def _add_member(self, member_ip):
+        self.ipset._add_member_to_set(self.ipset_name, member_ip)
+        self.ipset._apply_pending()
+
+    def _del_member(self, member_ip):
+        self.ipset._del_member_from_set(self.ipset_name, member_ip)
+        self.ipset._apply_pending()
+
+    def _refresh(self, member_ips):
+        self.ipset._refresh_set(self.ipset_name, member_ips,
+                                IPSET_ETHERTYPE)
+        self.ipset._apply_pending()
+
     def test_add_member_allows_ping(self):
         self.source.assert_no_ping(self.destination.ip)
-        self.ipset._add_member_to_set(self.ipset_name, self.source.ip)
+        self._add_member(self.source.ip)
         self.source.assert_ping(self.destination.ip)
 
     def test_del_member_denies_ping(self):
-        self.ipset._add_member_to_set(self.ipset_name, self.source.ip)
+        self._add_member(self.source.ip)
         self.source.assert_ping(self.destination.ip)
 
-        self.ipset._del_member_from_set(self.ipset_name, self.source.ip)
+        self._del_member(self.source.ip)
         self.source.assert_no_ping(self.destination.ip)
 
     def test_refresh_ipset_allows_ping(self):
-        self.ipset._refresh_set(
-            self.ipset_name, [UNRELATED_IP], IPSET_ETHERTYPE)
+        self._refresh([UNRELATED_IP])
         self.source.assert_no_ping(self.destination.ip)
 
-        self.ipset._refresh_set(
-            self.ipset_name, [UNRELATED_IP, self.source.ip], IPSET_ETHERTYPE)
+        self._refresh([UNRELATED_IP, self.source.ip])
         self.source.assert_ping(self.destination.ip)
 
-        self.ipset._refresh_set(
-            self.ipset_name, [self.source.ip, UNRELATED_IP], IPSET_ETHERTYPE)
+        self._refresh([self.source.ip, UNRELATED_IP])
         self.source.assert_ping(self.destination.ip)
 
     def test_destroy_ipset_set(self):
@@ -28,9 +28,10 @@ class BaseIpsetManagerTest(base.BaseTestCase):
     def setUp(self):
         super(BaseIpsetManagerTest, self).setUp()
         self.ipset = ipset_manager.IpsetManager()
-        self.execute = mock.patch.object(self.ipset, "execute").start()
+        self.execute = mock.patch.object(self.ipset, "execute",
+                                         return_value='').start()
         self.expected_calls = []
-        self.expect_create()
+        self.expect_list()
         self.force_sorted_get_set_ips()
 
     def force_sorted_get_set_ips(self):
@@ -58,51 +59,51 @@ class BaseIpsetManagerTest(base.BaseTestCase):
 
     def verify_mock_calls(self):
         self.execute.assert_has_calls(self.expected_calls, any_order=False)
+        self.assertEqual(len(self.expected_calls), self.execute.call_count)
 
-    def expect_set(self, addresses):
-        temp_input = ['create %s hash:net family inet' % TEST_SET_NAME_NEW]
-        temp_input.extend('add %s %s' % (TEST_SET_NAME_NEW, ip)
-                          for ip in self.ipset._sanitize_addresses(addresses))
-        input = '\n'.join(temp_input)
-        self.expected_calls.extend([
+    def expect_restore(self, process_input):
+        self.expected_calls.append(
             mock.call(['ipset', 'restore', '-exist'],
-                      process_input=input,
-                      run_as_root=True,
-                      check_exit_code=True),
-            mock.call(['ipset', 'swap', TEST_SET_NAME_NEW, TEST_SET_NAME],
-                      process_input=None,
-                      run_as_root=True,
-                      check_exit_code=True),
-            mock.call(['ipset', 'destroy', TEST_SET_NAME_NEW],
-                      process_input=None,
+                      process_input='\n'.join(process_input),
                       run_as_root=True,
-                      check_exit_code=False)])
+                      check_exit_code=True))
+
+    def expect_set(self, addresses, created=False):
+        temp_input = []
+        if created:
+            temp_input.append('create %s hash:net family inet' %
+                              TEST_SET_NAME)
+        temp_input.append('create %s hash:net family inet' %
+                          TEST_SET_NAME_NEW)
+        temp_input.extend('add %s %s' % (TEST_SET_NAME_NEW, ip)
+                          for ip in self.ipset._sanitize_addresses(addresses))
+        temp_input.append('swap %s %s' % (TEST_SET_NAME_NEW, TEST_SET_NAME))
+        temp_input.append('destroy %s' % TEST_SET_NAME_NEW)
+        self.expect_restore(temp_input)
 
     def expect_add(self, addresses):
-        self.expected_calls.extend(
-            mock.call(['ipset', 'add', '-exist', TEST_SET_NAME, ip],
-                      process_input=None,
-                      run_as_root=True,
-                      check_exit_code=True)
-            for ip in self.ipset._sanitize_addresses(addresses))
+        self.expect_restore(
+            ['add %s %s' % (TEST_SET_NAME, ip)
+             for ip in self.ipset._sanitize_addresses(addresses)])
 
     def expect_del(self, addresses):
+        self.expect_restore(
+            ['del %s %s' % (TEST_SET_NAME, ip)
+             for ip in self.ipset._sanitize_addresses(addresses)])
 
-        self.expected_calls.extend(
-            mock.call(['ipset', 'del', TEST_SET_NAME, ip],
-                      process_input=None,
-                      run_as_root=True,
-                      check_exit_code=False)
-            for ip in self.ipset._sanitize_addresses(addresses))
-
-    def expect_create(self):
+    def expect_list(self):
         self.expected_calls.append(
-            mock.call(['ipset', 'create', '-exist', TEST_SET_NAME,
-                       'hash:net', 'family', 'inet'],
+            mock.call(['ipset', 'list', '-name'],
                       process_input=None,
                       run_as_root=True,
                       check_exit_code=True))
 
+    def expect_create(self, addresses):
+        temp_input = ['create %s hash:net family inet' % TEST_SET_NAME]
+        temp_input.extend('add %s %s' % (TEST_SET_NAME, ip)
+                          for ip in self.ipset._sanitize_addresses(addresses))
+        self.expect_restore(temp_input)
+
     def expect_destroy(self):
         self.expected_calls.append(
             mock.call(['ipset', 'destroy', TEST_SET_NAME],
@@ -111,11 +112,11 @@ class BaseIpsetManagerTest(base.BaseTestCase):
                       check_exit_code=False))
 
     def add_first_ip(self):
-        self.expect_set([FAKE_IPS[0]])
+        self.expect_create([FAKE_IPS[0]])
         self.ipset.set_members(TEST_SET_ID, ETHERTYPE, [FAKE_IPS[0]])
 
     def add_all_ips(self):
-        self.expect_set(FAKE_IPS)
+        self.expect_create(FAKE_IPS)
         self.ipset.set_members(TEST_SET_ID, ETHERTYPE, FAKE_IPS)
 
 
@@ -142,6 +143,13 @@ class IpsetManagerTestCase(BaseIpsetManagerTest):
         self.ipset.set_members(TEST_SET_ID, ETHERTYPE, FAKE_IPS[0:3])
         self.verify_mock_calls()
 
+    def test_set_members_deleting_from_set_missing_on_system(self):
+        self.add_all_ips()
+        # The set was destroyed behind the back of the manager
+        self.ipset._system_set_names.discard(TEST_SET_NAME)
+        self.ipset.set_members(TEST_SET_ID, ETHERTYPE, FAKE_IPS[0:3])
+        self.verify_mock_calls()
+
     def test_set_members_adding_more_than_5(self):
         self.add_first_ip()
         self.expect_set(FAKE_IPS)
@@ -149,12 +157,12 @@ class IpsetManagerTestCase(BaseIpsetManagerTest):
         self.verify_mock_calls()
 
     def test_set_members_adding_all_zero_ipv4(self):
-        self.expect_set(['0.0.0.0/0'])
+        self.expect_create(['0.0.0.0/0'])
         self.ipset.set_members(TEST_SET_ID, ETHERTYPE, ['0.0.0.0/0'])
         self.verify_mock_calls()
 
     def test_set_members_adding_all_zero_ipv6(self):
-        self.expect_set(['::/0'])
+        self.expect_create(['::/0'])
         self.ipset.set_members(TEST_SET_ID, ETHERTYPE, ['::/0'])
         self.verify_mock_calls()
 
@@ -163,3 +171,34 @@ class IpsetManagerTestCase(BaseIpsetManagerTest):
         self.expect_destroy()
         self.ipset.destroy(TEST_SET_ID, ETHERTYPE)
         self.verify_mock_calls()
+
+    def test_set_members_of_set_existing_on_system(self):
+        self.execute.return_value = '%s\n' % TEST_SET_NAME
+        self.expect_set(FAKE_IPS[0:2], created=True)
+        self.ipset.set_members(TEST_SET_ID, ETHERTYPE, FAKE_IPS[0:2])
+        self.verify_mock_calls()
+
+    def test_set_members_deferred(self):
+        self.ipset.defer_apply_on()
+        self.ipset.set_members(TEST_SET_ID, ETHERTYPE, [FAKE_IPS[0]])
+        self.ipset.set_members(TEST_SET_ID, ETHERTYPE, FAKE_IPS[0:2])
+        self.ipset.set_members('other_sgid', ETHERTYPE, [FAKE_IPS[2]])
+        other_set_name = self.ipset.get_name('other_sgid', ETHERTYPE)
+        ips = self.ipset._sanitize_addresses(FAKE_IPS)
+        self.expect_restore([
+            'create %s hash:net family inet' % TEST_SET_NAME,
+            'add %s %s' % (TEST_SET_NAME, ips[0]),
+            'add %s %s' % (TEST_SET_NAME, ips[1]),
+            'create %s hash:net family inet' % other_set_name,
+            'add %s %s' % (other_set_name, ips[2])])
+        self.ipset.defer_apply_off()
+        self.verify_mock_calls()
+
+    def test_set_members_restore_failure(self):
+        self.add_first_ip()
+        self.execute.side_effect = RuntimeError
+        self.assertRaises(RuntimeError, self.ipset.set_members,
+                          TEST_SET_ID, ETHERTYPE, FAKE_IPS[0:2])
+        self.assertFalse(self.ipset.set_name_exists(TEST_SET_NAME))
+        # The sets on the system are listed again
+        self.assertIsNone(self.ipset._system_set_names)
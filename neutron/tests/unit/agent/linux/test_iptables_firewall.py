@@ -1851,6 +1851,14 @@ class IptablesFirewallEnhancedIpsetTestCase(BaseIptablesFirewallTestCase):
         calls = [mock.call.set_members(FAKE_SGID, constants.IPv4, [])]
         self.firewall.ipset.assert_has_calls(calls)
 
+    def test_filter_defer_apply_off_with_ipset_failure(self):
+        self.firewall.ipset.defer_apply_off.side_effect = RuntimeError
+        self.firewall.filter_defer_apply_on()
+        self.assertRaises(RuntimeError, self.firewall.filter_defer_apply_off)
+        self.iptables_inst.defer_apply_off.assert_called_once_with()
+        self.assertIsNone(self.firewall._pre_defer_filtered_ports)
+        self.assertIsNone(self.firewall._pre_defer_unfiltered_ports)
+
 
 class OVSHybridIptablesFirewallTestCase(BaseIptablesFirewallTestCase):
 
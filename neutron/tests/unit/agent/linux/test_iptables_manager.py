@@ -13,12 +13,15 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import contextlib
 import os
 import sys
+import timeit
 
 import mock
 from oslo_config import cfg
 import testtools
+from testtools import content
 
 from neutron._i18n import _
 from neutron.agent.linux import iptables_comments as ic
@@ -1058,3 +1061,234 @@ class IptablesManagerStateLessTestCase(base.BaseTestCase):
 
     def test_mangle_not_found(self):
         self.assertNotIn('mangle', self.iptables.ipv4)
+
+
+class IptablesManagerCoalescingTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(IptablesManagerCoalescingTestCase, self).setUp()
+        self.iptables = iptables_manager.IptablesManager(state_less=True)
+        self.apply_synchronized = mock.patch.object(
+            self.iptables, '_apply_synchronized',
+            return_value=['changes']).start()
+        self.lock = mock.patch.object(iptables_manager.lockutils,
+                                      'lock').start()
+
+    def _request_apply_while_waiting(self):
+        applies = []
+
+        @contextlib.contextmanager
+        def lock(*args, **kwargs):
+            if not applies:
+                # Another apply is requested, and gets the lock first
+                applies.append(None)
+                try:
+                    applies[0] = self.iptables._apply()
+                except RuntimeError:
+                    pass
+            yield
+
+        self.lock.side_effect = lock
+        applies.append(self.iptables._apply())
+        return applies
+
+    def test_applies_requested_while_waiting_coalesced(self):
+        self.assertEqual([['changes'], []],
+                         self._request_apply_while_waiting())
+        self.assertEqual(1, self.apply_synchronized.call_count)
+        self.assertEqual(['changes'], self.iptables._apply())
+        self.assertEqual(2, self.apply_synchronized.call_count)
+
+    def test_apply_failure_not_coalesced(self):
+        self.apply_synchronized.side_effect = [RuntimeError, ['changes']]
+        self.assertEqual([None, ['changes']],
+                         self._request_apply_while_waiting())
+        self.assertEqual(2, self.apply_synchronized.call_count)
+
+
+class IptablesManagerResyncTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(IptablesManagerResyncTestCase, self).setUp()
+        cfg.CONF.set_override('comment_iptables_rules', False, 'AGENT')
+        cfg.CONF.set_override('iptables_resync_interval', 60, 'AGENT')
+        self.iptables = iptables_manager.IptablesManager(state_less=True)
+        self.execute = mock.patch.object(self.iptables, "execute",
+                                         return_value='').start()
+        self.time = mock.patch.object(iptables_manager.time, 'time',
+                                      return_value=1000).start()
+
+    def _get_calls(self, cmd):
+        return [call for call in self.execute.call_args_list
+                if call[0][0][0] == cmd]
+
+    def test_apply_against_applied_tables(self):
+        self.iptables.apply()
+        self.iptables.ipv4['filter'].add_rule('FORWARD', '-j DROP')
+        self.assertEqual(
+            ['# Generated by iptables_manager', '*filter',
+             '-I %s-FORWARD 1 -j DROP' % iptables_manager.binary_name,
+             'COMMIT', '# Completed by iptables_manager'],
+            self.iptables.apply())
+        self.assertEqual([], self.iptables.apply())
+        self.assertEqual(1, len(self._get_calls('iptables-save')))
+        self.assertEqual(2, len(self._get_calls('iptables-restore')))
+
+    def test_apply_resyncs_after_interval(self):
+        self.iptables.apply()
+        self.time.return_value = 1060
+        self.iptables.apply()
+        self.assertEqual(2, len(self._get_calls('iptables-save')))
+        # Reading the tables again restores all of them
+        self.assertEqual(2, len(self._get_calls('iptables-restore')))
+
+    def test_apply_resyncs_after_failure(self):
+        def execute(args, **kwargs):
+            if args[0] == 'iptables-restore':
+                raise RuntimeError()
+            return ''
+
+        self.iptables.apply()
+        self.iptables.ipv4['filter'].add_rule('FORWARD', '-j DROP')
+        self.execute.side_effect = execute
+        self.assertRaises(RuntimeError, self.iptables.apply)
+        self.execute.side_effect = None
+        self.iptables.apply()
+        self.assertEqual(2, len(self._get_calls('iptables-save')))
+
+    def test_apply_without_resync_interval(self):
+        cfg.CONF.set_override('iptables_resync_interval', 0, 'AGENT')
+        self.iptables.apply()
+        self.iptables.apply()
+        self.assertEqual(2, len(self._get_calls('iptables-save')))
+
+
+class IptablesChainDiffTestCase(base.BaseTestCase):
+
+    def _diff(self, old_rules, new_rules, can_flush=False):
+        return iptables_manager._generate_chain_diff_iptables_commands(
+            'chain', ['-A chain %s' % rule for rule in old_rules],
+            ['-A chain %s' % rule for rule in new_rules], can_flush)
+
+    def test_insert_and_delete(self):
+        self.assertEqual(
+            ['-D chain 1', '-I chain 2 -j c', '-I chain 4 -j e'],
+            self._diff(['-j a', '-j b', '-j d'],
+                       ['-j b', '-j c', '-j d', '-j e']))
+
+    def test_replace(self):
+        self.assertEqual(
+            ['-R chain 2 -j x', '-R chain 3 -j y', '-D chain 4'],
+            self._diff(['-j a', '-j b', '-j c', '-j d', '-j e'],
+                       ['-j a', '-j x', '-j y', '-j e']))
+
+    def test_moved_rule(self):
+        self.assertEqual(
+            ['-D chain 1', '-I chain 4 -j a'],
+            self._diff(['-j a', '-j b', '-j c', '-j d'],
+                       ['-j b', '-j c', '-j d', '-j a']))
+
+    def test_duplicate_rules(self):
+        self.assertEqual(
+            ['-D chain 3'],
+            self._diff(['-j a', '-j b', '-j a', '-j b'],
+                       ['-j a', '-j b', '-j b']))
+
+    def test_single_character_chain_name(self):
+        self.assertEqual(
+            ['-R c 1 -j x'],
+            iptables_manager._generate_chain_diff_iptables_commands(
+                'c', ['-A c -j a'], ['-A c -j x']))
+
+    def test_flush_most_changed_chain(self):
+        self.assertEqual(['-F chain', '-A chain -j x', '-A chain -j a'],
+                         self._diff(['-j a', '-j b', '-j c', '-j d'],
+                                    ['-j x', '-j a'], can_flush=True))
+        self.assertEqual(['-F chain'],
+                         self._diff(['-j a', '-j b'], [], can_flush=True))
+
+    def test_no_flush_of_chain_not_owned(self):
+        self.assertEqual(
+            ['-R chain 1 -j x', '-D chain 3', '-D chain 3'],
+            self._diff(['-j a', '-j b', '-j c', '-j d'], ['-j x', '-j b']))
+
+    def test_is_owned_chain(self):
+        iptables = iptables_manager.IptablesManager(state_less=True)
+        table = iptables.ipv4['filter']
+        self.assertTrue(iptables._is_owned_chain(
+            table, '%s-INPUT' % iptables.wrap_name))
+        self.assertTrue(iptables._is_owned_chain(table, 'neutron-filter-top'))
+        self.assertFalse(iptables._is_owned_chain(table, 'INPUT'))
+        self.assertFalse(iptables._is_owned_chain(table, 'FORWARD'))
+
+
+class _CountingLine(str):
+    """A line of iptables-save output counting the lookups made on it."""
+
+    operations = 0
+
+    def __hash__(self):
+        _CountingLine.operations += 1
+        return str.__hash__(self)
+
+    def __eq__(self, other):
+        _CountingLine.operations += 1
+        return str.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __contains__(self, substring):
+        _CountingLine.operations += 1
+        return str.__contains__(self, substring)
+
+    def strip(self, *args):
+        return _CountingLine(str.strip(self, *args))
+
+
+class IptablesManagerScalingTestCase(base.BaseTestCase):
+    """Measures the merge of the rules of a table against their number."""
+
+    def setUp(self):
+        super(IptablesManagerScalingTestCase, self).setUp()
+        cfg.CONF.set_override('comment_iptables_rules', False, 'AGENT')
+
+    def _modify_rules(self, rule_count):
+        """Return the lookups and the time of the merge of rule_count rules.
+
+        The lookups are the hashes, comparisons and substring tests of the
+        saved lines, which the membership tests of the merge are made of.
+        """
+        iptables = iptables_manager.IptablesManager(state_less=True)
+        table = iptables.ipv4['filter']
+        table.add_chain('sg-chain')
+        for i in range(rule_count):
+            table.add_rule('sg-chain', '-s 10.%d.%d.0/24 -j ACCEPT' %
+                           (i // 256, i % 256))
+            # Rules of other binaries, which the merge preserves
+            table.add_rule('FORWARD', '-d 10.%d.%d.0/24 -j DROP' %
+                           (i // 256, i % 256), wrap=False)
+        saved = [_CountingLine(line) for line in
+                 ['*filter'] +
+                 iptables._modify_rules(['*filter', 'COMMIT'], table,
+                                        'filter') +
+                 ['COMMIT']]
+        _CountingLine.operations = 0
+        iptables._modify_rules(saved, table, 'filter')
+        lookups = _CountingLine.operations
+        seconds = min(timeit.repeat(
+            lambda: iptables._modify_rules(saved, table, 'filter'),
+            repeat=3, number=1))
+        return lookups, seconds
+
+    def test_modify_rules_linear_in_rule_count(self):
+        results = dict((rule_count, self._modify_rules(rule_count))
+                       for rule_count in (1000, 8000))
+        # The timings depend on the host, they are only reported
+        self.addDetail('modify_rules_seconds', content.text_content(
+            ', '.join('%d rules: %.4f' % (rule_count, seconds)
+                      for rule_count, (lookups, seconds) in
+                      sorted(results.items()))))
+        # Eight times the rules take about eight times as many lookups,
+        # and not the sixty four times of a quadratic merge
+        self.assertLess(results[8000][0], results[1000][0] * 16)
@@ -34,6 +34,7 @@ from neutron.api.v2 import base as v2_base
 from neutron.api.v2 import router
 from neutron.common import exceptions as n_exc
 from neutron import context
+from neutron.db import sqlalchemyutils
 from neutron import manager
 from neutron import policy
 from neutron import quota
@@ -656,6 +657,40 @@ class JSONV2TestCase(APIv2TestBase, testlib_api.WebTestCase):
         expect_params['page_reverse'] = ['True']
         self.assertEqual(urlparse.parse_qs(url.query), expect_params)
 
+    def test_list_pagination_keyset(self):
+        id1 = str(_uuid())
+        id2 = str(_uuid())
+        return_value = [{'id': id1, 'name': 'net1', 'tenant_id': '',
+                         'shared': False},
+                        {'id': id2, 'name': 'net2', 'tenant_id': '',
+                         'shared': False}]
+        instance = self.plugin.return_value
+        instance._NeutronPluginBaseV2__native_keyset_pagination_support = (
+            True)
+        instance.get_networks.return_value = return_value
+        params = {'limit': ['2'],
+                  'fields': ['name'],
+                  'sort_key': ['name'],
+                  'sort_dir': ['asc']}
+        res = self.api.get(_get_path('networks'),
+                           params=params).json
+
+        # The sort keys are fetched for the markers, but not returned
+        self.assertEqual([{'name': 'net1'}, {'name': 'net2'}],
+                         res['networks'])
+        kwargs = instance.get_networks.call_args[1]
+        self.assertIn('id', kwargs['fields'])
+        links = dict((link['rel'], urlparse.urlparse(link['href']))
+                     for link in res['networks_links'])
+        sorts = [('name', True), ('id', True)]
+        params['marker'] = [sqlalchemyutils.encode_marker(
+            return_value[1], sorts)]
+        self.assertEqual(params, urlparse.parse_qs(links['next'].query))
+        params['marker'] = [sqlalchemyutils.encode_marker(
+            return_value[0], sorts)]
+        params['page_reverse'] = ['True']
+        self.assertEqual(params, urlparse.parse_qs(links['previous'].query))
+
     def test_list_pagination_with_empty_page(self):
         return_value = []
         instance = self.plugin.return_value
@@ -47,6 +47,7 @@ from neutron.db import ipam_non_pluggable_backend as non_ipam
 from neutron.db import l3_db
 from neutron.db import models_v2
 from neutron.db import securitygroups_db as sgdb
+from neutron.db import sqlalchemyutils
 from neutron import manager
 from neutron.tests import base
 from neutron.tests import tools
@@ -986,6 +987,54 @@ class TestPortsV2(NeutronDbPluginV2TestCase):
             for p in self.deserialize(self.fmt, res)['ports']:
                 self._delete('ports', p['id'])
 
+    def test_create_ports_bulk_native_with_subnet(self):
+        if self._skip_native_bulk:
+            self.skipTest("Plugin does not support native bulk port create")
+        with self.subnet() as subnet:
+            res = self._create_port_bulk(self.fmt, 3,
+                                         subnet['subnet']['network_id'],
+                                         'test', True)
+            self.assertEqual(webob.exc.HTTPCreated.code, res.status_int)
+            ports = self.deserialize(self.fmt, res)['ports']
+            self.assertEqual(['test_0', 'test_1', 'test_2'],
+                             [p['name'] for p in ports])
+            self.assertEqual(3, len(set(p['mac_address'] for p in ports)))
+            ips = set(p['fixed_ips'][0]['ip_address'] for p in ports)
+            self.assertEqual(3, len(ips))
+            for p in ports:
+                self.assertEqual(subnet['subnet']['id'],
+                                 p['fixed_ips'][0]['subnet_id'])
+
+    def test_create_ports_bulk_native_with_ipv6_slaac_subnet(self):
+        if self._skip_native_bulk:
+            self.skipTest("Plugin does not support native bulk port create")
+        with self.subnet(gateway_ip='fe80::1',
+                         cidr='2607:f0d0:1002:51::/64',
+                         ip_version=6,
+                         ipv6_address_mode=constants.IPV6_SLAAC) as subnet:
+            res = self._create_port_bulk(self.fmt, 2,
+                                         subnet['subnet']['network_id'],
+                                         'test', True)
+            self.assertEqual(webob.exc.HTTPCreated.code, res.status_int)
+            subnet_cidr = subnet['subnet']['cidr']
+            for p in self.deserialize(self.fmt, res)['ports']:
+                eui_addr = str(ipv6_utils.get_ipv6_addr_by_EUI64(
+                    subnet_cidr, p['mac_address']))
+                self.assertEqual(eui_addr, p['fixed_ips'][0]['ip_address'])
+
+    def test_create_ports_bulk_native_duplicate_mac(self):
+        if self._skip_native_bulk:
+            self.skipTest("Plugin does not support native bulk port create")
+        with self.network() as net:
+            overrides = {0: {'mac_address': '00:11:22:33:44:55'},
+                         1: {'mac_address': '00:11:22:33:44:55'}}
+            res = self._create_port_bulk(self.fmt, 2, net['network']['id'],
+                                         'test', True, override=overrides)
+            self.assertEqual(webob.exc.HTTPConflict.code, res.status_int)
+            req = self.new_list_request('ports')
+            ports = self.deserialize(self.fmt, req.get_response(self.api))
+            self.assertEqual([], ports['ports'])
+
     def test_create_ports_bulk_emulated(self):
         real_has_attr = hasattr
 
@@ -1089,6 +1138,20 @@ fixed_ips=ip_address%%3D%s&fixed_ips=ip_address%%3D%s&fixed_ips=subnet_id%%3D%s
             self._test_list_resources('port', [port1],
                                       query_params=query_params)
 
+    def test_list_ports_with_column_fields(self):
+        with self.port() as port1, self.port() as port2:
+            with mock.patch.object(self.plugin, '_make_port_dict') as mpd:
+                req = self.new_list_request(
+                    'ports', params='fields=id&fields=mac_address')
+                res = self.deserialize(self.fmt, req.get_response(self.api))
+            self.assertFalse(mpd.called)
+            self.assertEqual(
+                sorted([{'id': p['port']['id'],
+                         'mac_address': p['port']['mac_address']}
+                        for p in (port1, port2)],
+                       key=lambda p: p['id']),
+                sorted(res['ports'], key=lambda p: p['id']))
+
     def test_list_ports_public_network(self):
         with self.network(shared=True) as network:
             with self.subnet(network) as subnet:
@@ -1146,6 +1209,41 @@ fixed_ips=ip_address%%3D%s&fixed_ips=ip_address%%3D%s&fixed_ips=subnet_id%%3D%s
                                             (port1, port2, port3),
                                             ('mac_address', 'asc'), 2, 2)
 
+    def test_list_ports_filtered_by_fixed_ip_with_pagination_native(self):
+        if self._skip_native_pagination:
+            self.skipTest("Skip test for not implemented pagination feature")
+        with self.subnet(cidr='10.0.0.0/24') as subnet:
+            subnet_id = subnet['subnet']['id']
+            fixed_ips = [{'subnet_id': subnet_id}, {'subnet_id': subnet_id}]
+            with self.port(subnet=subnet, fixed_ips=fixed_ips,
+                           mac_address='00:00:00:00:00:01') as port1,\
+                    self.port(subnet=subnet, fixed_ips=fixed_ips,
+                              mac_address='00:00:00:00:00:02') as port2:
+                # The limit applies to ports, not to their fixed IPs
+                self._test_list_with_pagination(
+                    'port', (port1, port2), ('mac_address', 'asc'), 2, 2,
+                    query_params='fixed_ips=subnet_id%%3D%s' % subnet_id)
+
+    def test_list_ports_with_limit_and_sort_keys_without_id(self):
+        with self.port(mac_address='00:00:00:00:00:01') as port1,\
+                self.port(mac_address='00:00:00:00:00:02'):
+            ports = self.plugin.get_ports(
+                context.get_admin_context(), limit=1,
+                sorts=[('mac_address', True)])
+            self.assertEqual([port1['port']['id']],
+                             [port['id'] for port in ports])
+
+    def test_list_ports_with_marker_of_other_sort_keys(self):
+        if self._skip_native_pagination:
+            self.skipTest("Skip test for not implemented pagination feature")
+        with self.port() as port:
+            marker = sqlalchemyutils.encode_marker(
+                port['port'], [('name', True), ('id', True)])
+            self.assertRaises(
+                n_exc.BadRequest, self.plugin.get_ports,
+                context.get_admin_context(), limit=1, marker=marker,
+                sorts=[('mac_address', True), ('id', True)])
+
     def test_list_ports_with_pagination_emulated(self):
         helper_patcher = mock.patch(
             'neutron.api.v2.base.Controller._get_pagination_helper',
@@ -2699,6 +2797,16 @@ class TestNetworksV2(NeutronDbPluginV2TestCase):
                              net1['network']['name'])
             self.assertIsNone(res['networks'][0].get('id'))
 
+    def test_list_networks_with_column_fields(self):
+        with self.network(name='net1') as net1:
+            with mock.patch.object(self.plugin,
+                                   '_make_network_dict') as mnd:
+                res = self.plugin.get_networks(
+                    context.get_admin_context(), fields=['id', 'status'])
+            self.assertFalse(mnd.called)
+            self.assertEqual([{'id': net1['network']['id'],
+                               'status': net1['network']['status']}], res)
+
     def test_list_networks_with_parameters_invalid_values(self):
         with self.network(name='net1', admin_state_up=False),\
                 self.network(name='net2'):
@@ -5914,6 +6022,21 @@ class TestNetworks(testlib_api.SqlTestCase):
             constants.DEVICE_OWNER_FLOATINGIP)
 
 
+class BatchedLoadingMixin(object):
+
+    def setUp(self):
+        cfg.CONF.set_override('collection_load_strategy', 'batched')
+        super(BatchedLoadingMixin, self).setUp()
+
+
+class TestNetworksV2BatchedLoading(BatchedLoadingMixin, TestNetworksV2):
+    pass
+
+
+class TestPortsV2BatchedLoading(BatchedLoadingMixin, TestPortsV2):
+    pass
+
+
 class DbOperationBoundMixin(object):
     """Mixin to support tests that assert constraints on DB operations."""
 
@@ -59,7 +59,8 @@ class TestIpamNonPluggableBackend(base.BaseTestCase):
                                               expected):
         ip_qry = mock.Mock()
         ip_qry.with_lockmode.return_value = ip_qry
-        ip_qry.filter_by.return_value = allocations
+        ip_qry.filter_by.return_value.yield_per.return_value = [
+            (allocation['ip_address'],) for allocation in allocations]
 
         pool_qry = mock.Mock()
         pool_qry.options.return_value = pool_qry
@@ -67,21 +68,24 @@ class TestIpamNonPluggableBackend(base.BaseTestCase):
         pool_qry.filter_by.return_value = pools
 
         def return_queries_side_effect(*args, **kwargs):
-            if args[0] == models_v2.IPAllocation:
+            if args[0] is models_v2.IPAllocation.ip_address:
                 return ip_qry
-            if args[0] == models_v2.IPAllocationPool:
+            if args[0] is models_v2.IPAllocationPool:
                 return pool_qry
 
         context = mock.Mock()
         context.session.query.side_effect = return_queries_side_effect
-        subnets = [mock.MagicMock()]
+        ip_version = 6 if ':' in pools[0]['first_ip'] else 4
+        subnets = [{'id': 'subnet', 'ip_version': ip_version}]
 
         non_ipam.IpamNonPluggableBackend._rebuild_availability_ranges(
             context, subnets)
 
-        actual = [[args[0].allocation_pool_id,
-                   args[0].first_ip, args[0].last_ip]
-                  for _name, args, _kwargs in context.session.add.mock_calls]
+        # Ranges are written by a single insert
+        self.assertEqual(1, context.session.execute.call_count)
+        actual = [[ip_range['allocation_pool_id'],
+                   ip_range['first_ip'], ip_range['last_ip']]
+                  for ip_range in context.session.execute.call_args[0][1]]
         self.assertEqual(expected, actual)
 
     def test_rebuild_availability_ranges(self):
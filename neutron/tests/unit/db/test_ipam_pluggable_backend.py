@@ -274,6 +274,51 @@ class TestDbBasePluginIpam(test_db_base.NeutronDbPluginV2TestCase):
         # Deallocate should be called for the first ip only
         mocks['subnet'].deallocate.assert_called_once_with(auto_ip)
 
+    def test_bulk_allocate_ips_by_subnet(self):
+        mocks = self._prepare_ipam()
+        subnet_id = self._gen_subnet_id()
+        mocks['subnet'].bulk_allocate.return_value = ['10.0.0.2',
+                                                      '10.0.0.5']
+        ports = [{'id': 'port1'}, {'id': 'port2'}]
+        ips_by_port = [[[{'subnet_id': subnet_id}]],
+                       [{'subnet_id': subnet_id, 'ip_address': '10.0.0.5'}]]
+
+        allocated = mocks['ipam']._ipam_bulk_allocate_ips(
+            mock.ANY, mocks['driver'], ports, ips_by_port)
+
+        mocks['driver'].get_subnet.assert_called_once_with(subnet_id)
+        requests = mocks['subnet'].bulk_allocate.call_args[0][0]
+        self.assertEqual(2, len(requests))
+        self.assertIsInstance(requests[0], ipam_req.AnyAddressRequest)
+        self.assertEqual(netaddr.IPAddress('10.0.0.5'), requests[1].address)
+        self.assertFalse(mocks['subnet'].allocate.called)
+        self.assertEqual(
+            [[{'ip_address': '10.0.0.2', 'subnet_id': subnet_id}],
+             [{'ip_address': '10.0.0.5', 'subnet_id': subnet_id}]],
+            allocated)
+
+    def test_bulk_allocate_ips_with_exception(self):
+        mocks = self._prepare_ipam()
+        subnets = {'': self._gen_subnet_id(),
+                   '10.0.0.5': self._gen_subnet_id()}
+
+        def bulk_allocate_mock(requests):
+            if isinstance(requests[0], ipam_req.SpecificAddressRequest):
+                raise n_exc.InvalidInput(error_message='SomeError')
+            return ['10.0.0.2']
+
+        mocks['subnet'].bulk_allocate.side_effect = bulk_allocate_mock
+        ports = [{'id': 'port1'}, {'id': 'port2'}]
+        ips_by_port = [[{'subnet_id': subnets['']}],
+                       [{'subnet_id': subnets['10.0.0.5'],
+                         'ip_address': '10.0.0.5'}]]
+
+        self.assertRaises(n_exc.InvalidInput,
+                          mocks['ipam']._ipam_bulk_allocate_ips,
+                          mock.ANY, mocks['driver'], ports, ips_by_port)
+        # Only the address allocated to the first port is given back
+        mocks['subnet'].deallocate.assert_called_once_with('10.0.0.2')
+
     @mock.patch('neutron.ipam.driver.Pool')
     def test_create_subnet_over_ipam(self, pool_mock):
         mocks = self._prepare_mocks_with_pool_mock(pool_mock)
@@ -0,0 +1,98 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from neutron.common import exceptions as n_exc
+from neutron import context
+from neutron.db import db_base_plugin_common
+from neutron.db import models_v2
+from neutron.db import rbac_db_models
+from neutron.tests.unit import testlib_api
+
+
+class LookupCacheTestCase(testlib_api.SqlTestCase):
+
+    def setUp(self):
+        super(LookupCacheTestCase, self).setUp()
+        self.plugin = db_base_plugin_common.DbBasePluginCommon()
+        self.ctx = context.get_admin_context()
+        self.session = self.ctx.session
+        with self.session.begin(subtransactions=True):
+            self.session.add(models_v2.Network(id='net1',
+                                               tenant_id='tenant1'))
+
+    def _add_subnet(self, subnet_id):
+        self.session.add(models_v2.Subnet(
+            id=subnet_id, tenant_id='tenant1', network_id='net1',
+            ip_version=4, cidr='10.0.0.0/24'))
+
+    def test_network_looked_up_once_per_transaction(self):
+        with mock.patch.object(self.plugin, '_get_by_id',
+                               wraps=self.plugin._get_by_id) as get_by_id:
+            with self.session.begin(subtransactions=True):
+                network = self.plugin._get_network(self.ctx, 'net1')
+                self.assertIs(network,
+                              self.plugin._get_network(self.ctx, 'net1'))
+            self.assertEqual(1, get_by_id.call_count)
+            # The results are dropped at the end of the transaction
+            with self.session.begin(subtransactions=True):
+                self.plugin._get_network(self.ctx, 'net1')
+            self.assertEqual(2, get_by_id.call_count)
+
+    def test_lookups_out_of_transaction_not_cached(self):
+        with mock.patch.object(self.plugin, '_get_by_id',
+                               wraps=self.plugin._get_by_id) as get_by_id:
+            self.plugin._get_network(self.ctx, 'net1')
+            self.plugin._get_network(self.ctx, 'net1')
+            self.assertEqual(2, get_by_id.call_count)
+
+    def test_lookups_scoped_by_tenant(self):
+        tenant_ctx = context.Context('', 'tenant2')
+        tenant_ctx._session = self.session
+        with self.session.begin(subtransactions=True):
+            self.plugin._get_network(self.ctx, 'net1')
+            self.assertRaises(n_exc.NetworkNotFound,
+                              self.plugin._get_network, tenant_ctx, 'net1')
+
+    def test_deleted_network_not_found(self):
+        with self.session.begin(subtransactions=True):
+            network = self.plugin._get_network(self.ctx, 'net1')
+            self.session.delete(network)
+            self.assertRaises(n_exc.NetworkNotFound,
+                              self.plugin._get_network, self.ctx, 'net1')
+
+    def test_subnets_by_network_include_new_subnets(self):
+        with self.session.begin(subtransactions=True):
+            self._add_subnet('subnet1')
+            self.assertEqual(['subnet1'], [
+                subnet.id for subnet in
+                self.plugin._get_subnets_by_network(self.ctx, 'net1')])
+            self._add_subnet('subnet2')
+            self.assertEqual(set(['subnet1', 'subnet2']), set(
+                subnet.id for subnet in
+                self.plugin._get_subnets_by_network(self.ctx, 'net1')))
+
+    def test_network_shared_after_rbac_entry_added(self):
+        tenant_ctx = context.Context('', 'tenant2')
+        tenant_ctx._session = self.session
+        with self.session.begin(subtransactions=True):
+            network = self.plugin._get_network(self.ctx, 'net1')
+            self.assertFalse(self.plugin._is_network_shared(tenant_ctx,
+                                                            network))
+            self.session.add(rbac_db_models.NetworkRBAC(
+                object_id='net1', tenant_id='tenant1', target_tenant='*',
+                action='access_as_shared'))
+            self.session.flush()
+            self.session.expire(network, ['rbac_entries'])
+            self.assertTrue(self.plugin._is_network_shared(tenant_ctx,
+                                                           network))
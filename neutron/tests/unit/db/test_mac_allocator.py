@@ -0,0 +1,105 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+
+import mock
+from oslo_config import cfg
+
+from neutron import context
+from neutron.db import mac_allocator
+from neutron.db import models_v2
+from neutron.tests import base
+from neutron.tests.unit import testlib_api
+
+
+class BloomFilterTestCase(base.BaseTestCase):
+
+    def test_contains_added_keys(self):
+        in_use = mac_allocator.BloomFilter(100)
+        keys = ['fa:16:3e:00:00:%02x' % i for i in range(100)]
+        for key in keys:
+            in_use.add(key)
+        self.assertTrue(all(key in in_use for key in keys))
+        self.assertTrue(in_use.full)
+
+    def test_empty(self):
+        in_use = mac_allocator.BloomFilter(100)
+        self.assertNotIn('fa:16:3e:00:00:00', in_use)
+        self.assertFalse(in_use.full)
+
+
+class MacAllocatorTestCase(testlib_api.SqlTestCase):
+
+    def setUp(self):
+        super(MacAllocatorTestCase, self).setUp()
+        self.ctx = context.get_admin_context()
+        self.net_id = 'net-id'
+        with self.ctx.session.begin(subtransactions=True):
+            self.ctx.session.add(models_v2.Network(id=self.net_id))
+        mock.patch.object(mac_allocator, '_networks',
+                          collections.OrderedDict()).start()
+        # Walk the address space from its start
+        mock.patch.object(mac_allocator.random, 'randrange',
+                          return_value=0).start()
+
+    def _create_ports(self, macs):
+        with self.ctx.session.begin(subtransactions=True):
+            for mac in macs:
+                self.ctx.session.add(models_v2.Port(
+                    tenant_id='tenant', network_id=self.net_id,
+                    mac_address=mac, admin_state_up=True, status='ACTIVE',
+                    device_id='', device_owner=''))
+
+    def test_generate_macs_skips_macs_in_use(self):
+        self._create_ports(['fa:16:3e:00:00:00', 'fa:16:3e:00:00:01'])
+        self.assertEqual(
+            ['fa:16:3e:00:00:02', 'fa:16:3e:00:00:03'],
+            mac_allocator.generate_macs(self.ctx, self.net_id, 2))
+        self.assertEqual(
+            ['fa:16:3e:00:00:04'],
+            mac_allocator.generate_macs(self.ctx, self.net_id))
+
+    def test_generate_macs_skips_macs_marked_in_use(self):
+        mac_allocator.generate_macs(self.ctx, self.net_id)
+        mac_allocator.mark_in_use(self.net_id, ['fa:16:3e:00:00:01'])
+        self.assertEqual(
+            ['fa:16:3e:00:00:02'],
+            mac_allocator.generate_macs(self.ctx, self.net_id))
+
+    def test_generated_macs_in_use_restart_walk(self):
+        mac_allocator.generate_macs(self.ctx, self.net_id)
+        mac_allocator.random.randrange.return_value = 0x100
+        mac_allocator.mark_in_use(self.net_id, ['fa:16:3e:00:00:00'],
+                                  generated=True)
+        self.assertEqual(
+            ['fa:16:3e:00:01:00'],
+            mac_allocator.generate_macs(self.ctx, self.net_id))
+
+    def test_generate_macs_with_4th_octet(self):
+        cfg.CONF.set_override('base_mac', 'fa:16:3e:4f:00:00')
+        self.assertEqual(
+            ['fa:16:3e:4f:00:00'],
+            mac_allocator.generate_macs(self.ctx, self.net_id))
+
+    def test_generate_macs_with_upper_case_base_mac(self):
+        cfg.CONF.set_override('base_mac', 'FA:16:3E:00:00:00')
+        self.assertEqual(
+            ['fa:16:3e:00:00:00'],
+            mac_allocator.generate_macs(self.ctx, self.net_id))
+
+    def test_base_mac_change_reloads_network(self):
+        mac_allocator.generate_macs(self.ctx, self.net_id)
+        cfg.CONF.set_override('base_mac', 'fa:16:3f:00:00:00')
+        self.assertEqual(
+            ['fa:16:3f:00:00:00'],
+            mac_allocator.generate_macs(self.ctx, self.net_id))
@@ -0,0 +1,158 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from oslo_config import cfg
+
+from neutron.common import exceptions as n_exc
+from neutron import context
+from neutron.db import db_base_plugin_v2
+from neutron.db import models_v2
+from neutron.db import resource_count_db
+from neutron.tests import base
+from neutron.tests.unit import testlib_api
+
+
+class ResourceCountTestCase(testlib_api.SqlTestCase):
+
+    def setUp(self):
+        super(ResourceCountTestCase, self).setUp()
+        cfg.CONF.set_override('resource_count_mode', 'counters')
+        resource_count_db.start_counting()
+        self.ctx = context.get_admin_context()
+        self.session = self.ctx.session
+        with self.session.begin(subtransactions=True):
+            for net_id in ('net1', 'net2'):
+                self.session.add(models_v2.Network(id=net_id,
+                                                   tenant_id='tenant1'))
+
+    def _create_port(self, network_id, tenant_id='tenant1',
+                     device_owner=''):
+        port = models_v2.Port(tenant_id=tenant_id, network_id=network_id,
+                              mac_address='', admin_state_up=True,
+                              status='ACTIVE', device_id='',
+                              device_owner=device_owner)
+        with self.session.begin(subtransactions=True):
+            self.session.add(port)
+        return port
+
+    def _create_subnet(self, network_id):
+        with self.session.begin(subtransactions=True):
+            self.session.add(models_v2.Subnet(
+                tenant_id='tenant1', network_id=network_id, ip_version=4,
+                cidr='10.0.0.0/24'))
+
+    def _get_count(self, model, filters, ctx=None):
+        return resource_count_db.get_count(ctx or self.ctx, model, filters)
+
+    def test_count_created_and_deleted_resources(self):
+        port = self._create_port('net1')
+        self._create_port('net1', tenant_id='tenant2')
+        self._create_port('net2')
+        self._create_subnet('net1')
+        self.assertEqual(2, self._get_count(models_v2.Network,
+                                            {'tenant_id': ['tenant1']}))
+        self.assertEqual(1, self._get_count(models_v2.Subnet,
+                                            {'network_id': ['net1']}))
+        self.assertEqual(3, self._get_count(
+            models_v2.Port, {'tenant_id': ['tenant1', 'tenant2']}))
+        with self.session.begin(subtransactions=True):
+            self.session.delete(port)
+        self.assertEqual(1, self._get_count(models_v2.Port,
+                                            {'tenant_id': ['tenant1']}))
+        self.assertEqual(0, self._get_count(models_v2.Port,
+                                            {'tenant_id': ['tenant3']}))
+
+    def test_count_bulk_deleted_resources(self):
+        self._create_port('net1', device_owner='network:dhcp')
+        self._create_port('net1')
+        query = self.session.query(models_v2.Port).filter_by(
+            device_owner='network:dhcp')
+        with self.session.begin(subtransactions=True):
+            resource_count_db.count_bulk_deleted(self.ctx, models_v2.Port,
+                                                 query)
+            query.delete(synchronize_session=False)
+        self.assertEqual(1, self._get_count(models_v2.Port,
+                                            {'tenant_id': ['tenant1']}))
+
+    def test_counts_of_deleted_network_are_deleted(self):
+        self._create_subnet('net1')
+        with self.session.begin(subtransactions=True):
+            self.session.query(models_v2.Subnet).delete()
+            self.session.delete(self.session.query(
+                models_v2.Network).filter_by(id='net1').one())
+        self.assertFalse(self.session.query(
+            models_v2.ResourceCount).filter_by(scope_id='net1').count())
+
+    def test_get_count_not_counted(self):
+        self._create_port('net1')
+        self.assertIsNone(self._get_count(models_v2.Port, None))
+        # Ports are not counted by network
+        self.assertIsNone(self._get_count(models_v2.Port,
+                                          {'network_id': ['net1']}))
+        self.assertIsNone(self._get_count(
+            models_v2.Port, {'network_id': ['net1'],
+                             'tenant_id': ['tenant1']}))
+        self.assertIsNone(self._get_count(models_v2.Port,
+                                          {'device_owner': ['']}))
+        self.assertIsNone(self._get_count(models_v2.Network,
+                                          {'network_id': ['net1']}))
+
+    def test_get_count_tenant_request(self):
+        self._create_port('net1')
+        ctx = context.Context('', 'tenant1')
+        self.assertEqual(1, self._get_count(
+            models_v2.Port, {'tenant_id': ['tenant1']}, ctx))
+        # Resources of other tenants or of networks may not all be visible
+        self.assertIsNone(self._get_count(
+            models_v2.Port, {'tenant_id': ['tenant2']}, ctx))
+        self.assertIsNone(self._get_count(
+            models_v2.Port, {'network_id': ['net1']}, ctx))
+
+    def test_get_count_exact_mode(self):
+        cfg.CONF.set_override('resource_count_mode', 'exact')
+        self.assertIsNone(self._get_count(models_v2.Network,
+                                          {'tenant_id': ['tenant1']}))
+
+    def test_get_count_estimate_mode_without_statistics(self):
+        cfg.CONF.set_override('resource_count_mode', 'estimate')
+        # SQLite keeps no statistics, counts are exact
+        self.assertIsNone(self._get_count(models_v2.Network, None))
+        self.assertEqual(2, self._get_count(models_v2.Network,
+                                            {'tenant_id': ['tenant1']}))
+
+    def test_sync_resource_counts(self):
+        self._create_port('net1')
+        with self.session.begin(subtransactions=True):
+            self.session.query(models_v2.ResourceCount).filter_by(
+                resource='ports', scope='tenant_id').update({'in_use': 5})
+            self.session.query(models_v2.ResourceCount).filter_by(
+                resource='networks').delete()
+        self.assertEqual(2, resource_count_db.sync_resource_counts(self.ctx))
+        self.assertEqual(1, self._get_count(models_v2.Port,
+                                            {'tenant_id': ['tenant1']}))
+        self.assertEqual(2, self._get_count(models_v2.Network,
+                                            {'tenant_id': ['tenant1']}))
+        self.assertEqual(0, resource_count_db.sync_resource_counts(self.ctx))
+
+
+class ResourceCountConfigTestCase(base.BaseTestCase):
+
+    def test_counters_without_sync_rejected(self):
+        cfg.CONF.set_override('resource_count_mode', 'counters')
+        cfg.CONF.set_override('resource_count_sync_interval', 0)
+        self.assertRaises(n_exc.InvalidConfigurationOption,
+                          db_base_plugin_v2.NeutronDbPluginV2)
+
+    def test_exact_without_sync_accepted(self):
+        cfg.CONF.set_override('resource_count_sync_interval', 0)
+        plugin = db_base_plugin_v2.NeutronDbPluginV2()
+        self.assertEqual([], plugin.get_workers())
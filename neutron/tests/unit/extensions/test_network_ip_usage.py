@@ -13,12 +13,22 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import datetime
+
+import netaddr
+import webob.exc
+
 import neutron.api.extensions as api_ext
 import neutron.common.config as config
 import neutron.common.constants as constants
+import neutron.context as context
+import neutron.db.external_net_db as external_net_db
+import neutron.db.ip_usage_db as ip_usage_db
+import neutron.db.ip_usage_history_db as ip_usage_history_db
 import neutron.extensions
 import neutron.services.network_ip_usage.plugin as plugin
 import neutron.tests.unit.db.test_db_base_plugin_v2 as test_db_base_plugin_v2
+import neutron.worker as neutron_worker
 
 API_RESOURCE = 'network-ip-usages'
 USAGE_KEY = 'network_ip_usage'
@@ -260,3 +270,369 @@ class TestNetworkIPUsageAPI(test_db_base_plugin_v2.NeutronDbPluginV2TestCase):
                 response = self.deserialize(self.fmt,
                                             request.get_response(self.ext_api))
                 self.assertEqual(0, len(response[USAGES_KEY]))
+
+    def test_usages_port_deleted(self):
+        with self.network() as net:
+            with self.subnet(network=net) as subnet:
+                with self.port(subnet=subnet), self.port(subnet=subnet) as p:
+                    self._delete('ports', p['port']['id'])
+                    request = self.new_list_request(API_RESOURCE)
+                    response = self.deserialize(
+                        self.fmt, request.get_response(self.ext_api))
+                    self._validate_from_usages(response[USAGES_KEY], net, 1)
+
+    def test_usages_allocation_pools_updated(self):
+        with self.network() as net:
+            with self.subnet(network=net) as subnet:
+                data = {'subnet': {'allocation_pools': [
+                    {'start': '10.0.0.2', 'end': '10.0.0.101'}]}}
+                req = self.new_update_request('subnets', data,
+                                              subnet['subnet']['id'])
+                req.get_response(self.api)
+                request = self.new_list_request(API_RESOURCE)
+                response = self.deserialize(self.fmt,
+                                            request.get_response(self.ext_api))
+                self._validate_from_usages(response[USAGES_KEY], net, 0, 100)
+
+    def _test_usages_multi_pools(self):
+        pools = [{'start': '10.0.0.2', 'end': '10.0.0.51'},
+                 {'start': '10.0.0.101', 'end': '10.0.0.130'},
+                 {'start': '10.0.0.201', 'end': '10.0.0.220'}]
+        with self.network() as net:
+            with self.subnet(network=net, allocation_pools=pools) as subnet:
+                with self.port(subnet=subnet), self.port(subnet=subnet):
+                    usages = self._get_usages()
+                    self._validate_from_usages(usages, net, 2, 100)
+                    usage = self._find_usage(usages, net['network']['id'])
+                    self.assertEqual(
+                        [(2, 100)],
+                        [(s['used_ips'], s['total_ips'])
+                         for s in usage['subnet_ip_allocations']])
+
+    def test_usages_multi_pools(self):
+        self._test_usages_multi_pools()
+
+    def test_usages_multi_pools_live_engine(self):
+        self.config(ip_usage_engine=ip_usage_db.LIVE_ENGINE)
+        self._test_usages_multi_pools()
+
+    def test_usages_live_engine_filtered(self):
+        self.config(ip_usage_engine=ip_usage_db.LIVE_ENGINE)
+        with self.network(name='net1') as n1, self.network() as n2:
+            with self.subnet(network=n1) as subnet1, \
+                    self.subnet(cidr='40.0.0.0/24', network=n2) as subnet2:
+                with self.port(subnet=subnet1), self.port(subnet=subnet2):
+                    params = 'network_name=net1'
+                    request = self.new_list_request(API_RESOURCE,
+                                                    params=params)
+                    response = self.deserialize(
+                        self.fmt, request.get_response(self.ext_api))
+                    self.assertEqual(1, len(response[USAGES_KEY]))
+                    self._validate_from_usages(response[USAGES_KEY], n1, 1)
+
+    def test_usages_list_with_sort(self):
+        with self.network(name='net1') as n1,\
+                self.network(name='net2') as n2,\
+                self.network(name='net3') as n3:
+            items = [{USAGE_KEY: n['network']} for n in (n3, n2, n1)]
+            self._test_list_with_sort(USAGE_KEY, items, [('name', 'desc')],
+                                      resources=API_RESOURCE)
+
+    def test_usages_list_with_pagination(self):
+        with self.network(name='net1') as n1,\
+                self.network(name='net2') as n2,\
+                self.network(name='net3') as n3:
+            with self.subnet(network=n1), \
+                    self.subnet(cidr='40.0.0.0/24', network=n1), \
+                    self.subnet(cidr='50.0.0.0/24', network=n2):
+                items = [{USAGE_KEY: n['network']} for n in (n1, n2, n3)]
+                self._test_list_with_pagination(USAGE_KEY, items,
+                                                ('name', 'asc'), 2, 2,
+                                                resources=API_RESOURCE)
+
+    def test_usages_list_with_pagination_reverse(self):
+        with self.network(name='net1') as n1,\
+                self.network(name='net2') as n2,\
+                self.network(name='net3') as n3:
+            items = [{USAGE_KEY: n['network']} for n in (n1, n2, n3)]
+            self._test_list_with_pagination_reverse(USAGE_KEY, items,
+                                                    ('name', 'asc'), 2, 2,
+                                                    resources=API_RESOURCE)
+
+    def test_usages_list_with_fields(self):
+        with self.network() as net:
+            with self.subnet(network=net) as subnet:
+                with self.port(subnet=subnet):
+                    params = 'fields=id&fields=used_ips'
+                    request = self.new_list_request(API_RESOURCE,
+                                                    params=params)
+                    response = self.deserialize(
+                        self.fmt, request.get_response(self.ext_api))
+                    self.assertEqual(
+                        [{'id': net['network']['id'], 'used_ips': 1}],
+                        response[USAGES_KEY])
+
+    def _list_usage_ids(self, params):
+        request = self.new_list_request(API_RESOURCE, params=params)
+        response = self.deserialize(self.fmt,
+                                    request.get_response(self.ext_api))
+        return sorted(usage['id'] for usage in response[USAGES_KEY])
+
+    def test_usages_query_multiple_network_ids(self):
+        with self.network() as n1, self.network() as n2, self.network():
+            ids = sorted([n1['network']['id'], n2['network']['id']])
+            params = 'network_id=%s&network_id=%s' % tuple(ids)
+            self.assertEqual(ids, self._list_usage_ids(params))
+
+    def test_usages_query_tenant_and_subnet_ids(self):
+        with self.network(tenant_id='tenant1') as n1,\
+                self.network(tenant_id='tenant2') as n2:
+            with self.subnet(network=n1), \
+                    self.subnet(network=n2, cidr='40.0.0.0/24') as subnet2:
+                self.assertEqual([n1['network']['id']],
+                                 self._list_usage_ids('tenant_id=tenant1'))
+                params = 'subnet_id=%s' % subnet2['subnet']['id']
+                self.assertEqual([n2['network']['id']],
+                                 self._list_usage_ids(params))
+
+    def test_usages_query_shared(self):
+        with self.network(shared=True) as n1, self.network() as n2:
+            self.assertEqual([n1['network']['id']],
+                             self._list_usage_ids('shared=True'))
+            self.assertEqual([n2['network']['id']],
+                             self._list_usage_ids('shared=False'))
+
+    def test_usages_query_router_external(self):
+        with self.network() as n1, self.network() as n2:
+            ctx = context.get_admin_context()
+            with ctx.session.begin():
+                ctx.session.add(external_net_db.ExternalNetwork(
+                    network_id=n1['network']['id']))
+            self.assertEqual([n1['network']['id']],
+                             self._list_usage_ids('router:external=True'))
+            self.assertEqual([n2['network']['id']],
+                             self._list_usage_ids('router:external=False'))
+
+    def _make_usage_networks(self, n1, n2):
+        # n1 has 4 of its 5 IPs used, n2 1 of its 253 IPs
+        for net, cidr, gateway, ports in (
+                (n1, '10.0.0.0/29', '10.0.0.1', 4),
+                (n2, '10.0.1.0/24', '10.0.1.1', 1)):
+            self._make_subnet(self.fmt, net, gateway, cidr)
+            for _i in range(ports):
+                self._make_port(self.fmt, net['network']['id'])
+
+    def test_usages_query_thresholds(self):
+        with self.network() as n1, self.network() as n2, self.network():
+            self._make_usage_networks(n1, n2)
+            n1_id = n1['network']['id']
+            self.assertEqual([n1_id],
+                             self._list_usage_ids('min_utilization=50'))
+            self.assertEqual([n1_id], self._list_usage_ids('max_free_ips=1'))
+            self.assertEqual([], self._list_usage_ids(
+                'min_utilization=50&max_free_ips=0'))
+
+    def test_usages_query_invalid_threshold(self):
+        request = self.new_list_request(API_RESOURCE,
+                                        params='min_utilization=abc')
+        res = request.get_response(self.ext_api)
+        self.assertEqual(webob.exc.HTTPBadRequest.code, res.status_int)
+
+    def test_usages_utilization(self):
+        with self.network() as n1, self.network() as n2:
+            self._make_usage_networks(n1, n2)
+            usages = dict((usage['id'], usage)
+                          for usage in self._get_usages())
+            n1_usage = usages[n1['network']['id']]
+            self.assertEqual(80.0, n1_usage['utilization'])
+            self.assertEqual(
+                80.0, n1_usage['subnet_ip_allocations'][0]['utilization'])
+            self.assertEqual(0.4, usages[n2['network']['id']]['utilization'])
+
+    def test_usages_list_with_sort_by_utilization(self):
+        with self.network() as n1, self.network() as n2,\
+                self.network() as n3:
+            self._make_usage_networks(n1, n2)
+            items = [{USAGE_KEY: n['network']} for n in (n1, n2, n3)]
+            self._test_list_with_sort(USAGE_KEY, items,
+                                      [('utilization', 'desc')],
+                                      resources=API_RESOURCE)
+
+    def test_usages_list_with_pagination_by_utilization(self):
+        with self.network() as n1, self.network() as n2,\
+                self.network() as n3:
+            self._make_usage_networks(n1, n2)
+            items = [{USAGE_KEY: n['network']} for n in (n3, n2, n1)]
+            self._test_list_with_pagination(USAGE_KEY, items,
+                                            ('utilization', 'asc'), 2, 2,
+                                            resources=API_RESOURCE)
+            items.reverse()
+            self._test_list_with_pagination(USAGE_KEY, items,
+                                            ('used_ips', 'desc'), 2, 2,
+                                            resources=API_RESOURCE)
+
+    def test_usages_thresholds_live_engine(self):
+        self.config(ip_usage_engine=ip_usage_db.LIVE_ENGINE)
+        for params in ('min_utilization=50', 'sort_key=utilization'):
+            request = self.new_list_request(API_RESOURCE, params=params)
+            res = request.get_response(self.ext_api)
+            self.assertEqual(webob.exc.HTTPBadRequest.code, res.status_int)
+
+    def test_subnet_total_ips(self):
+        self.assertEqual(253, ip_usage_db.subnet_total_ips(
+            '10.0.0.0/24', [('10.0.0.2', '10.0.0.254')]))
+        self.assertEqual(2 ** 64, ip_usage_db.subnet_total_ips(
+            '2001:db8::/64', None))
+        self.assertEqual(20, ip_usage_db.subnet_total_ips(
+            '2001:db8::/64', [netaddr.IPRange('2001:db8::1', '2001:db8::a'),
+                              ('2001:db8::11', '2001:db8::1a')]))
+
+    def test_usages_total_ips_cap(self):
+        self.config(ip_usage_total_ips_cap=1000)
+        with self.network() as net:
+            with self.subnet(network=net, cidr='2001:db8::/64',
+                             ip_version=6), self.subnet(network=net):
+                usage = self._get_usages()[0]
+                self.assertEqual(1253, usage['total_ips'])
+
+    def test_usages_utilization_on_exact_total_ips(self):
+        self.config(ip_usage_total_ips_cap=10)
+        with self.network() as net:
+            # 1 of the 13 IPs of the subnet is used
+            self._make_subnet(self.fmt, net, '10.0.0.1', '10.0.0.0/28')
+            self._make_port(self.fmt, net['network']['id'])
+            usage = self._get_usages()[0]
+            self.assertEqual(10, usage['total_ips'])
+            self.assertEqual(7.69, usage['utilization'])
+            self.assertEqual(
+                7.69, usage['subnet_ip_allocations'][0]['utilization'])
+
+    def test_usages_sorted_on_exact_total_ips(self):
+        self.config(ip_usage_total_ips_cap=10)
+        with self.network() as n1, self.network() as n2:
+            # n1 reports more IPs than n2 once capped, but has fewer
+            for net, cidr, gateway in (
+                    (n1, '10.0.0.0/28', '10.0.0.1'),
+                    (n1, '10.0.0.16/28', '10.0.0.17'),
+                    (n2, '10.0.1.0/24', '10.0.1.1')):
+                self._make_subnet(self.fmt, net, gateway, cidr)
+            request = self.new_list_request(
+                API_RESOURCE, params='sort_key=total_ips&sort_dir=desc')
+            usages = self.deserialize(
+                self.fmt, request.get_response(self.ext_api))[USAGES_KEY]
+            self.assertEqual([n2['network']['id'], n1['network']['id']],
+                             [usage['id'] for usage in usages])
+            self.assertEqual([10, 20],
+                             [usage['total_ips'] for usage in usages])
+
+    def _get_histories(self, network_id, subnet_id=None, params=None):
+        request = self._req('GET', API_RESOURCE, id=network_id,
+                            subresource='histories', sub_id=subnet_id,
+                            params=params)
+        return self.deserialize(self.fmt, request.get_response(self.ext_api))
+
+    def test_usage_history(self):
+        ctx = context.get_admin_context()
+        start = datetime.datetime(2016, 1, 1)
+        with self.network() as net, self.network() as other:
+            net_id = net['network']['id']
+            with self.subnet(network=net) as subnet,\
+                    self.subnet(network=other):
+                subnet_id = subnet['subnet']['id']
+                for hours in range(3):
+                    self._make_port(self.fmt, net_id)
+                    ip_usage_history_db.snapshot_subnet_ip_usages(
+                        ctx, start + datetime.timedelta(hours=hours))
+
+                histories = self._get_histories(net_id)['histories']
+                self.assertEqual([subnet_id], [h['id'] for h in histories])
+                samples = histories[0]['samples']
+                self.assertEqual([1, 2, 3], [s['used_ips'] for s in samples])
+                self.assertEqual(253, samples[0]['total_ips'])
+                self.assertEqual(
+                    (start + datetime.timedelta(hours=252)).isoformat(),
+                    histories[0]['exhaustion_date'])
+
+                history = self._get_histories(net_id, subnet_id)['history']
+                self.assertEqual(histories[0], history)
+
+    def test_usage_history_downsampling(self):
+        ctx = context.get_admin_context()
+        self.config(ip_usage_snapshot_interval=600)
+        start = datetime.datetime(2016, 1, 1)
+        with self.network() as net:
+            with self.subnet(network=net):
+                for minutes in range(0, 120, 10):
+                    ip_usage_history_db.snapshot_subnet_ip_usages(
+                        ctx, start + datetime.timedelta(minutes=minutes))
+                # Twelve samples spanning two hours become two samples
+                ip_usage_history_db.downsample_subnet_ip_usages(
+                    ctx, start + datetime.timedelta(hours=50))
+                samples = ctx.session.query(
+                    ip_usage_history_db.SubnetIPUsageSample).all()
+                self.assertEqual(
+                    [(ip_usage_history_db.HOURLY, start),
+                     (ip_usage_history_db.HOURLY,
+                      start + datetime.timedelta(hours=1))],
+                    sorted((s.resolution, s.timestamp) for s in samples))
+
+                ip_usage_history_db.downsample_subnet_ip_usages(
+                    ctx, start + datetime.timedelta(days=400))
+                self.assertFalse(ctx.session.query(
+                    ip_usage_history_db.SubnetIPUsageSample).count())
+
+    def test_project_exhaustion(self):
+        start = datetime.datetime(2016, 1, 1)
+        day = datetime.timedelta(days=1)
+        self.assertIsNone(ip_usage_history_db.project_exhaustion(
+            [(start, 10, 100)]))
+        self.assertIsNone(ip_usage_history_db.project_exhaustion(
+            [(start, 10, 100), (start + day, 5, 100)]))
+        self.assertEqual(start + 9 * day,
+                         ip_usage_history_db.project_exhaustion(
+                             [(start, 10, 100), (start + day, 20, 100)]))
+
+    def test_snapshot_worker(self):
+        self.assertEqual((), self.plugin.get_workers())
+        self.config(ip_usage_snapshot_interval=300)
+        workers = self.plugin.get_workers()
+        self.assertEqual(1, len(workers))
+        self.assertIsInstance(workers[0], neutron_worker.PeriodicWorker)
+
+    def _get_usages(self):
+        request = self.new_list_request(API_RESOURCE)
+        return self.deserialize(
+            self.fmt, request.get_response(self.ext_api))[USAGES_KEY]
+
+    def _usage_query(self, ctx, subnet):
+        return ctx.session.query(ip_usage_db.SubnetIPUsage).filter_by(
+            subnet_id=subnet['subnet']['id'])
+
+    def test_sync_repairs_drifted_counters(self):
+        ctx = context.get_admin_context()
+        with self.network() as net:
+            with self.subnet(network=net) as subnet:
+                with self.port(subnet=subnet), self.port(subnet=subnet):
+                    self._usage_query(ctx, subnet).update(
+                        {'used_ips': 42, 'total_ips': '7'})
+                    self._validate_from_usages(self._get_usages(), net, 42, 7)
+
+                    self.assertEqual(
+                        1, ip_usage_db.sync_subnet_ip_usages(ctx))
+                    self._validate_from_usages(self._get_usages(), net, 2)
+                    self.assertEqual(
+                        0, ip_usage_db.sync_subnet_ip_usages(ctx))
+
+    def test_missing_counters_counted_and_synced(self):
+        ctx = context.get_admin_context()
+        with self.network() as net:
+            with self.subnet(network=net) as subnet:
+                with self.port(subnet=subnet):
+                    self._usage_query(ctx, subnet).delete()
+                    self._validate_from_usages(self._get_usages(), net, 1)
+
+                    self.assertEqual(
+                        1, ip_usage_db.sync_subnet_ip_usages(ctx))
+                    usage = self._usage_query(ctx, subnet).one()
+                    self.assertEqual(1, usage.used_ips)
+                    self.assertEqual('253', usage.total_ips)
@@ -22,7 +22,9 @@ from neutron.api.v2 import attributes
 from neutron.common import constants
 from neutron.common import exceptions as n_exc
 from neutron import context
+from neutron.ipam.drivers.neutrondb_ipam import db_models
 from neutron.ipam.drivers.neutrondb_ipam import driver
+from neutron.ipam.drivers.neutrondb_ipam import leases
 from neutron.ipam import exceptions as ipam_exc
 from neutron.ipam import requests as ipam_req
 from neutron import manager
@@ -415,6 +417,51 @@ class TestNeutronDbIpamSubnet(testlib_api.SqlTestCase,
                           ipam_subnet.allocate,
                           ipam_req.AnyAddressRequest)
 
+    def test_bulk_allocate_addresses(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet(
+            '10.0.0.0/24', ip_version=4)[0]
+        ip_addresses = ipam_subnet.bulk_allocate(
+            [ipam_req.AnyAddressRequest,
+             ipam_req.SpecificAddressRequest('10.0.0.3'),
+             ipam_req.AnyAddressRequest,
+             ipam_req.AnyAddressRequest])
+        self.assertEqual('10.0.0.3', ip_addresses[1])
+        self.assertEqual(['10.0.0.2', '10.0.0.3', '10.0.0.4', '10.0.0.5'],
+                         sorted(ip_addresses))
+        allocations = ipam_subnet.subnet_manager.list_allocations(
+            self.ctx.session)
+        self.assertEqual(sorted(ip_addresses),
+                         sorted(a['ip_address'] for a in allocations))
+
+    def test_bulk_allocate_after_deallocation(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet(
+            '192.168.0.0/29', ip_version=4)[0]
+        ip_addresses = ipam_subnet.bulk_allocate(
+            [ipam_req.AnyAddressRequest] * 5)
+        ipam_subnet.deallocate(ip_addresses[1])
+        ipam_subnet.deallocate(ip_addresses[3])
+        self.assertEqual(
+            sorted([ip_addresses[1], ip_addresses[3]]),
+            sorted(ipam_subnet.bulk_allocate(
+                [ipam_req.AnyAddressRequest] * 2)))
+
+    def test_bulk_allocate_exhausted_pools_fails(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet(
+            '192.168.0.0/29', ip_version=4)[0]
+        self.assertRaises(ipam_exc.IpAddressGenerationFailure,
+                          ipam_subnet.bulk_allocate,
+                          [ipam_req.AnyAddressRequest] * 6)
+        self.assertEqual(0, ipam_subnet.subnet_manager.list_allocations(
+            self.ctx.session).count())
+
+    def test_bulk_allocate_duplicate_specific_address_fails(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet(
+            '10.0.0.0/24', ip_version=4)[0]
+        self.assertRaises(ipam_exc.IpAddressAlreadyAllocated,
+                          ipam_subnet.bulk_allocate,
+                          [ipam_req.SpecificAddressRequest('10.0.0.3'),
+                           ipam_req.SpecificAddressRequest('10.0.0.3')])
+
     def _test_deallocate_address(self, cidr, ip_version):
         ipam_subnet = self._create_and_allocate_ipam_subnet(
             cidr, ip_version=ip_version)[0]
@@ -460,3 +507,246 @@ class TestNeutronDbIpamSubnet(testlib_api.SqlTestCase,
         self.assertRaises(db_exc.RetryRequest,
                           ipam_subnet._allocate_specific_ip,
                           self.ctx.session, ip)
+
+
+class TestNeutronDbIpamBitmapSubnet(TestNeutronDbIpamSubnet):
+    """Test case for the allocation bitmaps of Neutron's DB IPAM driver.
+
+    Tests about availability ranges are replaced with their bitmap
+    counterparts.
+    """
+
+    def setUp(self):
+        super(TestNeutronDbIpamBitmapSubnet, self).setUp()
+        self.ipam_pool = driver.NeutronDbBitmapPool(None, self.ctx)
+
+    def _get_free_counts(self, ipam_subnet):
+        return sorted(
+            chunk.free_count for chunk in self.ctx.session.query(
+                db_models.IpamBitmapChunk).join(
+                db_models.IpamAllocationPool).filter_by(
+                ipam_subnet_id=ipam_subnet.subnet_manager._ipam_subnet_id))
+
+    def test__allocate_specific_ip(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet('10.0.0.0/24')[0]
+        self.assertEqual([253], self._get_free_counts(ipam_subnet))
+        with self.ctx.session.begin():
+            ipam_subnet._allocate_specific_ip(self.ctx.session, '10.0.0.33')
+        self.assertEqual([252], self._get_free_counts(ipam_subnet))
+        self.assertRaises(db_exc.RetryRequest,
+                          ipam_subnet._allocate_specific_ip,
+                          self.ctx.session, '10.0.0.33')
+
+    def test__allocate_specific_ips_multiple_ranges(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet(
+            '10.0.0.0/24',
+            allocation_pools=[{'start': '10.0.0.10', 'end': '10.0.0.19'},
+                              {'start': '10.0.0.30', 'end': '10.0.0.39'}])[0]
+        with self.ctx.session.begin():
+            ipam_subnet._allocate_specific_ip(self.ctx.session, '10.0.0.33')
+        self.assertEqual([9, 10], self._get_free_counts(ipam_subnet))
+
+    def test__allocate_specific_ip_out_of_range(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet('10.0.0.0/24')[0]
+        with self.ctx.session.begin():
+            ipam_subnet._allocate_specific_ip(self.ctx.session,
+                                              '192.168.0.1')
+        self.assertEqual([253], self._get_free_counts(ipam_subnet))
+
+    def test__allocate_specific_ip_raises_exception(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet('10.0.0.0/24')[0]
+        ipam_subnet.subnet_manager.update_bitmap_chunk = mock.Mock(
+            return_value=0)
+        self.assertRaises(db_exc.RetryRequest,
+                          ipam_subnet._allocate_specific_ip,
+                          self.ctx.session, '10.0.0.15')
+
+    def test_allocate_spans_chunks(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet(
+            '10.0.0.0/21',
+            allocation_pools=[{'start': '10.0.0.2', 'end': '10.0.4.3'}])[0]
+        self.assertEqual([2, 1024], self._get_free_counts(ipam_subnet))
+        ipam_subnet.allocate(ipam_req.SpecificAddressRequest('10.0.4.3'))
+        with mock.patch.object(driver.random, 'choice',
+                               side_effect=lambda chunks: [
+                                   c for c in chunks if c[2] == 1][0]):
+            self.assertEqual('10.0.4.2',
+                             ipam_subnet.allocate(ipam_req.AnyAddressRequest))
+        self.assertEqual([0, 1024], self._get_free_counts(ipam_subnet))
+
+    def test_deallocate_frees_address(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet(
+            '192.168.0.0/30')[0]
+        ip_address = ipam_subnet.allocate(ipam_req.AnyAddressRequest)
+        self.assertEqual([0], self._get_free_counts(ipam_subnet))
+        ipam_subnet.deallocate(ip_address)
+        self.assertEqual([1], self._get_free_counts(ipam_subnet))
+        self.assertEqual(ip_address,
+                         ipam_subnet.allocate(ipam_req.AnyAddressRequest))
+
+    def test_update_allocation_pools_keeps_allocations(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet('10.0.0.0/24')[0]
+        ipam_subnet.allocate(ipam_req.SpecificAddressRequest('10.0.0.5'))
+        ipam_subnet.update_allocation_pools(
+            [netaddr.IPRange('10.0.0.2', '10.0.0.9')],
+            netaddr.IPNetwork('10.0.0.0/24'))
+        self.assertEqual([7], self._get_free_counts(ipam_subnet))
+
+    def test_large_v6_subnet_uses_ranges(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet(
+            'fde3:abcd:4321:1::/64', ip_version=6)[0]
+        self.assertEqual([], self._get_free_counts(ipam_subnet))
+        self.assertEqual('fde3:abcd:4321:1::2',
+                         ipam_subnet.allocate(ipam_req.AnyAddressRequest))
+
+    def test_bitmaps_built_for_range_subnets(self):
+        ipam_subnet = driver.NeutronDbPool(
+            None, self.ctx).allocate_subnet(
+                ipam_req.SpecificSubnetRequest(
+                    'tenant_id', 'meh', '192.168.0.0/29'))
+        ipam_subnet.allocate(ipam_req.SpecificAddressRequest('192.168.0.3'))
+        ipam_subnet = self.ipam_pool.subnet_class(
+            ipam_subnet.subnet_manager._ipam_subnet_id, self.ctx,
+            cidr='192.168.0.0/29', allocation_pools=ipam_subnet._pools,
+            subnet_id='meh')
+        # The bitmap accounts for the allocation made from the ranges
+        self.assertEqual('192.168.0.1',
+                         ipam_subnet.allocate(ipam_req.AnyAddressRequest))
+        self.assertEqual('192.168.0.2',
+                         ipam_subnet.allocate(ipam_req.AnyAddressRequest))
+        self.assertEqual('192.168.0.4',
+                         ipam_subnet.allocate(ipam_req.AnyAddressRequest))
+        self.assertEqual([2], self._get_free_counts(ipam_subnet))
+
+
+class TestNeutronDbIpamSubnetLeases(TestNeutronDbIpamSubnet):
+    """Test case for the address leases of Neutron's DB IPAM driver.
+
+    The tests of the parent class are run with leases enabled as well.
+    """
+
+    def setUp(self):
+        super(TestNeutronDbIpamSubnetLeases, self).setUp()
+        self.config(ipam_lease_size=4)
+        self.addCleanup(leases._leases.clear)
+
+    def _get_ranges(self, ipam_subnet):
+        return [(r['first_ip'], r['last_ip']) for r in
+                ipam_subnet.subnet_manager.list_ranges_by_subnet_id(
+                    self.ctx.session)]
+
+    def test_allocate_from_lease(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet('10.0.0.0/24')[0]
+        self.assertEqual('10.0.0.2',
+                         ipam_subnet.allocate(ipam_req.AnyAddressRequest))
+        # The whole lease was taken out of the ranges at once
+        self.assertEqual([('10.0.0.6', '10.0.0.254')],
+                         self._get_ranges(ipam_subnet))
+        self.assertEqual('10.0.0.3',
+                         ipam_subnet.allocate(ipam_req.AnyAddressRequest))
+        self.assertEqual([('10.0.0.6', '10.0.0.254')],
+                         self._get_ranges(ipam_subnet))
+
+    def test_allocate_from_lease_without_reading_ranges(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet('10.0.0.0/24')[0]
+        ipam_subnet.allocate(ipam_req.AnyAddressRequest)
+        subnet_manager = ipam_subnet.subnet_manager
+        with mock.patch.object(subnet_manager, 'list_ranges_by_subnet_id',
+                               side_effect=AssertionError),\
+                mock.patch.object(subnet_manager,
+                                  'list_ranges_by_allocation_pool',
+                                  side_effect=AssertionError):
+            self.assertEqual('10.0.0.3',
+                             ipam_subnet.allocate(ipam_req.AnyAddressRequest))
+
+    def test_allocate_takes_new_lease_when_exhausted(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet('10.0.0.0/24')[0]
+        for i in range(5):
+            ip_address = ipam_subnet.allocate(ipam_req.AnyAddressRequest)
+        self.assertEqual('10.0.0.6', ip_address)
+        self.assertEqual([('10.0.0.10', '10.0.0.254')],
+                         self._get_ranges(ipam_subnet))
+
+    def test_allocate_skips_allocated_leased_address(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet('10.0.0.0/24')[0]
+        ipam_subnet.allocate(ipam_req.AnyAddressRequest)
+        ipam_subnet.allocate(ipam_req.SpecificAddressRequest('10.0.0.3'))
+        self.assertEqual('10.0.0.4',
+                         ipam_subnet.allocate(ipam_req.AnyAddressRequest))
+
+    def test_allocate_skips_leased_address_out_of_pools(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet('10.0.0.0/24')[0]
+        ipam_subnet.allocate(ipam_req.AnyAddressRequest)
+        ipam_subnet._pools = [netaddr.IPRange('10.0.0.5', '10.0.0.254')]
+        self.assertEqual('10.0.0.5',
+                         ipam_subnet.allocate(ipam_req.AnyAddressRequest))
+
+    def test_lease_discarded_on_rollback(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet('10.0.0.0/24')[0]
+        try:
+            with self.ctx.session.begin():
+                ipam_subnet.allocate(ipam_req.AnyAddressRequest)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual({}, dict(leases._leases))
+        self.assertEqual([('10.0.0.2', '10.0.0.254')],
+                         self._get_ranges(ipam_subnet))
+        self.assertEqual('10.0.0.2',
+                         ipam_subnet.allocate(ipam_req.AnyAddressRequest))
+
+    def test_address_back_to_lease_on_rollback(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet('10.0.0.0/24')[0]
+        ipam_subnet.allocate(ipam_req.AnyAddressRequest)
+        try:
+            with self.ctx.session.begin():
+                self.assertEqual(
+                    '10.0.0.3',
+                    ipam_subnet.allocate(ipam_req.AnyAddressRequest))
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual('10.0.0.3',
+                         ipam_subnet.allocate(ipam_req.AnyAddressRequest))
+
+    def test_lease_dropped_when_back_in_ranges(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet('10.0.0.0/24')[0]
+        ipam_subnet.allocate(ipam_req.AnyAddressRequest)
+        # Another process rebuilt the ranges
+        subnet_manager = ipam_subnet.subnet_manager
+        session = self.ctx.session
+        with session.begin():
+            pool = subnet_manager.list_pools(session)[0]
+            subnet_manager.create_ranges(session, [{
+                'allocation_pool_id': pool['id'],
+                'first_ip': '10.0.0.3', 'last_ip': '10.0.0.5'}])
+            subnet_manager.bump_ranges_revision(session)
+        ip_address = netaddr.IPAddress(
+            ipam_subnet.allocate(ipam_req.AnyAddressRequest))
+        # The address was taken out of the ranges it was back in
+        for first_ip, last_ip in self._get_ranges(ipam_subnet):
+            self.assertNotIn(ip_address, netaddr.IPRange(first_ip, last_ip))
+
+    def test_expired_lease_released(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet('10.0.0.0/24')[0]
+        ipam_subnet.allocate(ipam_req.AnyAddressRequest)
+        ipam_subnet.allocate(ipam_req.SpecificAddressRequest('10.0.0.4'))
+        with mock.patch.object(leases.time, 'time',
+                               return_value=leases.time.time() + 3600):
+            self.assertEqual('10.0.0.6',
+                             ipam_subnet.allocate(ipam_req.AnyAddressRequest))
+        # .3 and .5 are given back, .4 is allocated
+        self.assertEqual(
+            [('10.0.0.3', '10.0.0.3'), ('10.0.0.5', '10.0.0.5'),
+             ('10.0.0.10', '10.0.0.254')],
+            sorted(self._get_ranges(ipam_subnet),
+                   key=lambda r: netaddr.IPAddress(r[0])))
+
+    def test_release_leases(self):
+        ipam_subnet = self._create_and_allocate_ipam_subnet('10.0.0.0/24')[0]
+        ipam_subnet.allocate(ipam_req.AnyAddressRequest)
+        leases.release_leases()
+        self.assertEqual(
+            [('10.0.0.3', '10.0.0.5'), ('10.0.0.6', '10.0.0.254')],
+            sorted(self._get_ranges(ipam_subnet),
+                   key=lambda r: netaddr.IPAddress(r[0])))
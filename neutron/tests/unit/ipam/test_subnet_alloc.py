@@ -23,6 +23,7 @@ from neutron.api.v2 import attributes
 from neutron.common import constants
 from neutron.common import exceptions as n_exc
 from neutron import context
+from neutron.db import models_v2
 from neutron.ipam import requests as ipam_req
 from neutron.ipam import subnet_alloc
 from neutron import manager
@@ -198,3 +199,133 @@ class TestSubnetAllocation(testlib_api.SqlTestCase):
                                          'fe80::/63')
         with mock.patch("sqlalchemy.orm.query.Query.update", return_value=0):
             self.assertRaises(db_exc.RetryRequest, sa.allocate_subnet, req)
+
+    def _get_free_prefixes(self, subnetpool_id):
+        return sorted(
+            free_prefix.cidr for free_prefix in
+            self.ctx.session.query(models_v2.SubnetPoolFreePrefix).filter_by(
+                subnetpool_id=subnetpool_id))
+
+    def _allocate_any(self, sp, prefixlen):
+        sa = subnet_alloc.SubnetAllocator(sp, self.ctx)
+        req = ipam_req.AnySubnetRequest(self._tenant_id,
+                                        uuidutils.generate_uuid(),
+                                        constants.IPv4, prefixlen)
+        with self.ctx.session.begin(subtransactions=True):
+            return str(sa.allocate_subnet(req).get_details().subnet_cidr)
+
+    def test_allocate_any_subnet_best_fit(self):
+        sp = self._create_subnet_pool(self.plugin, self.ctx, 'test-sp',
+                                      ['10.1.0.0/16', '192.168.1.0/24'],
+                                      21, 4)
+        sp = self.plugin._get_subnetpool(self.ctx, sp['id'])
+        self.assertEqual('192.168.1.0/24', self._allocate_any(sp, 24))
+        self.assertEqual(['10.1.0.0/16'], self._get_free_prefixes(sp['id']))
+
+    def test_allocate_any_subnet_splits_free_prefix(self):
+        sp = self._create_subnet_pool(self.plugin, self.ctx, 'test-sp',
+                                      ['10.1.0.0/16'], 16, 4)
+        sp = self.plugin._get_subnetpool(self.ctx, sp['id'])
+        self.assertEqual('10.1.0.0/18', self._allocate_any(sp, 18))
+        self.assertEqual(['10.1.128.0/17', '10.1.64.0/18'],
+                         self._get_free_prefixes(sp['id']))
+        self.assertEqual('10.1.64.0/18', self._allocate_any(sp, 18))
+        self.assertEqual(['10.1.128.0/17'],
+                         self._get_free_prefixes(sp['id']))
+
+    def test_allocate_specific_subnet_splits_free_prefix(self):
+        sp = self._create_subnet_pool(self.plugin, self.ctx, 'test-sp',
+                                      ['10.1.0.0/16'], 16, 4)
+        sp = self.plugin._get_subnetpool(self.ctx, sp['id'])
+        sa = subnet_alloc.SubnetAllocator(sp, self.ctx)
+        req = ipam_req.SpecificSubnetRequest(self._tenant_id,
+                                             uuidutils.generate_uuid(),
+                                             '10.1.192.0/18')
+        with self.ctx.session.begin(subtransactions=True):
+            sa.allocate_subnet(req)
+        self.assertEqual(['10.1.0.0/17', '10.1.128.0/18'],
+                         self._get_free_prefixes(sp['id']))
+
+    def test_free_prefixes_rebuilt_when_not_indexed(self):
+        sp = self._create_subnet_pool(self.plugin, self.ctx, 'test-sp',
+                                      ['10.1.0.0/16'], 16, 4)
+        sp = self.plugin._get_subnetpool(self.ctx, sp['id'])
+        self._allocate_any(sp, 17)
+        # As for a pool created before the index existed
+        self.ctx.session.query(models_v2.SubnetPoolFreePrefix).delete()
+        self.ctx.session.query(models_v2.SubnetPool).update(
+            {'free_prefixes_indexed': False})
+        # The allocations made above created no subnet
+        self.assertEqual('10.1.0.0/17', self._allocate_any(sp, 17))
+        self.assertEqual(['10.1.128.0/17'],
+                         self._get_free_prefixes(sp['id']))
+
+    def test_free_prefixes_not_rebuilt_on_miss(self):
+        sp = self._create_subnet_pool(self.plugin, self.ctx, 'test-sp',
+                                      ['10.1.0.0/16'], 16, 4)
+        sp = self.plugin._get_subnetpool(self.ctx, sp['id'])
+        self._allocate_any(sp, 16)
+        with mock.patch.object(subnet_alloc.SubnetAllocator,
+                               '_rebuild_free_prefixes') as rebuild:
+            self.assertRaises(n_exc.SubnetAllocationError,
+                              self._allocate_any, sp, 16)
+        self.assertFalse(rebuild.called)
+
+    def test_free_prefixes_rebuilt_after_prefixes_update(self):
+        sp = self._create_subnet_pool(self.plugin, self.ctx, 'test-sp',
+                                      ['10.1.0.0/16'], 16, 4)
+        self._allocate_any(self.plugin._get_subnetpool(self.ctx, sp['id']),
+                           16)
+        self.plugin.update_subnetpool(
+            self.ctx, sp['id'],
+            {'subnetpool': {'prefixes': ['10.1.0.0/16', '10.2.0.0/16']}})
+        sp = self.plugin._get_subnetpool(self.ctx, sp['id'])
+        self.assertFalse(sp.free_prefixes_indexed)
+        self.assertEqual('10.1.0.0/16', self._allocate_any(sp, 16))
+        self.assertEqual(['10.2.0.0/16'], self._get_free_prefixes(sp['id']))
+
+    def test_delete_subnet_merges_free_prefixes(self):
+        sp = self._create_subnet_pool(self.plugin, self.ctx, 'test-sp',
+                                      ['10.1.0.0/16'], 16, 4)
+        subnet = self._create_pool_subnet(sp['id'], '10.1.0.0/18')
+        self.assertEqual(['10.1.128.0/17', '10.1.64.0/18'],
+                         self._get_free_prefixes(sp['id']))
+        self.plugin.delete_subnet(self.ctx, subnet['id'])
+        self.assertEqual(['10.1.0.0/16'], self._get_free_prefixes(sp['id']))
+
+    def _get_quota_usages(self, subnetpool_id):
+        return sorted(
+            (usage.prefixlen, usage.subnet_count) for usage in
+            self.ctx.session.query(models_v2.SubnetPoolQuotaUsage).filter_by(
+                subnetpool_id=subnetpool_id, tenant_id=self._tenant_id))
+
+    def test_quota_usages_counted(self):
+        sp = self._create_subnet_pool(self.plugin, self.ctx, 'test-sp',
+                                      ['10.1.0.0/16'], 16, 4)
+        subnet = self._create_pool_subnet(sp['id'], '10.1.0.0/24')
+        self._create_pool_subnet(sp['id'], '10.1.1.0/24')
+        self._create_pool_subnet(sp['id'], '10.1.2.0/23')
+        self.assertEqual([(23, 1), (24, 2)], self._get_quota_usages(sp['id']))
+        sa = subnet_alloc.SubnetAllocator(sp, self.ctx)
+        self.assertEqual(1024, sa._allocations_used_by_tenant(32))
+        self.plugin.delete_subnet(self.ctx, subnet['id'])
+        self.assertEqual([(23, 1), (24, 1)], self._get_quota_usages(sp['id']))
+        self.assertEqual(768, sa._allocations_used_by_tenant(32))
+
+    def test_verify_subnetpool_quota_usages(self):
+        sp = self._create_subnet_pool(self.plugin, self.ctx, 'test-sp',
+                                      ['10.1.0.0/16'], 16, 4)
+        self._create_pool_subnet(sp['id'], '10.1.0.0/24')
+        self._create_pool_subnet(sp['id'], '10.1.2.0/23')
+        self.assertEqual(0, subnet_alloc.verify_subnetpool_quota_usages(
+            self.ctx))
+        with self.ctx.session.begin():
+            query = self.ctx.session.query(models_v2.SubnetPoolQuotaUsage)
+            query.filter_by(prefixlen=24).update({'subnet_count': 5})
+            query.filter_by(prefixlen=23).delete()
+            self.ctx.session.add(models_v2.SubnetPoolQuotaUsage(
+                subnetpool_id=sp['id'], tenant_id=self._tenant_id,
+                prefixlen=28, subnet_count=1))
+        self.assertEqual(3, subnet_alloc.verify_subnetpool_quota_usages(
+            self.ctx))
+        self.assertEqual([(23, 1), (24, 1)], self._get_quota_usages(sp['id']))
@@ -87,3 +87,20 @@ class TestIpamUtils(base.BaseTestCase):
         cidr = '::/64'
         expected = [netaddr.IPRange('::1', '::FFFF:FFFF:FFFF:FFFF')]
         self.assertEqual(expected, utils.generate_pools(cidr, None))
+
+    def test_ip_to_int(self):
+        self.assertEqual(int(netaddr.IPAddress('192.168.0.1')),
+                         utils.ip_to_int('192.168.0.1'))
+        self.assertEqual(int(netaddr.IPAddress('2001:db8::1')),
+                         utils.ip_to_int('2001:db8::1'))
+
+    def test_iter_free_ranges(self):
+        allocated = [1, 3, 4, 4, 9, 12]
+        self.assertEqual([(2, 2), (5, 8), (10, 10)],
+                         list(utils.iter_free_ranges(2, 10, allocated)))
+
+    def test_iter_free_ranges_no_allocation(self):
+        self.assertEqual([(2, 10)], list(utils.iter_free_ranges(2, 10, [])))
+
+    def test_iter_free_ranges_all_allocated(self):
+        self.assertEqual([], list(utils.iter_free_ranges(2, 3, [2, 3])))
@@ -488,6 +488,13 @@ class TestMl2DbOperationBounds(test_plugin.DbOperationBoundMixin,
         self._assert_object_list_queries_constant(self.make_port, 'ports')
 
 
+class TestMl2DbOperationBoundsBatchedLoading(TestMl2DbOperationBounds):
+
+    def setUp(self):
+        config.cfg.CONF.set_override('collection_load_strategy', 'batched')
+        super(TestMl2DbOperationBoundsBatchedLoading, self).setUp()
+
+
 class TestMl2PortsV2(test_plugin.TestPortsV2, Ml2PluginV2TestCase):
 
     def test_update_port_status_build(self):
@@ -1741,6 +1748,34 @@ class TestMl2PluginCreateUpdateDeletePort(base.BaseTestCase):
             self.notify.assert_called_once_with('port', 'after_create',
                 plugin, **kwargs)
 
+    def _create_ports_bulk(self, plugin_cls):
+        ports = [{'port': {'name': 'port1'}}, {'port': {'name': 'port2'}}]
+        with mock.patch.object(ml2_plugin.Ml2Plugin, '__init__') as init,\
+                mock.patch.object(ml2_plugin.Ml2Plugin,
+                                  '_create_ports_db') as create_ports_db:
+            init.return_value = None
+            create_ports_db.return_value = []
+            plugin = plugin_cls()
+            plugin.mechanism_manager = mock.Mock()
+            objects = plugin._create_bulk_ml2('port', self.context,
+                                              {'ports': ports})
+        return objects, create_ports_db
+
+    def test_create_ports_bulk_batched(self):
+        objects, create_ports_db = self._create_ports_bulk(
+            ml2_plugin.Ml2Plugin)
+        self.assertEqual(1, create_ports_db.call_count)
+
+    def test_create_ports_bulk_with_port_creation_overridden(self):
+        class Plugin(ml2_plugin.Ml2Plugin):
+            def _create_port_db(self, context, port):
+                return {'name': port['port']['name']}, mock.Mock()
+
+        objects, create_ports_db = self._create_ports_bulk(Plugin)
+        self.assertFalse(create_ports_db.called)
+        self.assertEqual(['port1', 'port2'],
+                         [obj['result']['name'] for obj in objects])
+
     def test_update_port_rpc_outside_transaction(self):
         port_id = 'fake_id'
         net_id = 'mynet'
@@ -0,0 +1,50 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from neutron import context
+from neutron.tests import base
+from neutron import worker as neutron_worker
+
+
+class PeriodicWorkerTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(PeriodicWorkerTestCase, self).setUp()
+        self.task = mock.Mock()
+        self.worker = neutron_worker.PeriodicWorker(self.task, 60)
+
+    @mock.patch('oslo_service.loopingcall.FixedIntervalLoopingCall')
+    def test_start_stop(self, loop_cls):
+        self.worker.start()
+        loop_cls.assert_called_once_with(self.worker._run_task)
+        loop_cls.return_value.start.assert_called_once_with(interval=60)
+        self.worker.stop()
+        self.worker.wait()
+        loop_cls.return_value.stop.assert_called_once_with()
+        loop_cls.return_value.wait.assert_called_once_with()
+
+    def test_task_called_with_admin_context(self):
+        self.worker._run_task()
+        ctx = self.task.call_args[0][0]
+        self.assertIsInstance(ctx, context.Context)
+        self.assertTrue(ctx.is_admin)
+
+    def test_task_failure_logged(self):
+        def task(context):
+            raise ValueError()
+
+        worker = neutron_worker.PeriodicWorker(task, 60)
+        with mock.patch.object(neutron_worker.LOG, 'exception') as log:
+            worker._run_task()
+        self.assertTrue(log.called)
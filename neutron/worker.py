@@ -10,11 +10,18 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from oslo_log import log as logging
+from oslo_service import loopingcall
 from oslo_service import service
+from oslo_utils import reflection
 
+from neutron._i18n import _LE
 from neutron.callbacks import events
 from neutron.callbacks import registry
 from neutron.callbacks import resources
+from neutron import context as n_context
+
+LOG = logging.getLogger(__name__)
 
 
 class NeutronWorker(service.ServiceBase):
@@ -38,3 +45,43 @@ class NeutronWorker(service.ServiceBase):
     """
     def start(self):
         registry.notify(resources.PROCESS, events.AFTER_CREATE, self.start)
+
+
+class PeriodicWorker(NeutronWorker):
+    """A worker calling a task with an admin context at a fixed interval.
+
+    Failures of the task are logged, and the task is called again at the
+    next interval.
+
+    :param task: callable taking a context.
+    :param interval: seconds between the start of two calls of task.
+    """
+
+    def __init__(self, task, interval):
+        self._task = task
+        self._interval = interval
+        self._loop = None
+
+    def start(self):
+        super(PeriodicWorker, self).start()
+        self._loop = loopingcall.FixedIntervalLoopingCall(self._run_task)
+        self._loop.start(interval=self._interval)
+
+    def _run_task(self):
+        try:
+            self._task(n_context.get_admin_context())
+        except Exception:
+            LOG.exception(_LE("Periodic task %s failed"),
+                          reflection.get_callable_name(self._task))
+
+    def wait(self):
+        if self._loop is not None:
+            self._loop.wait()
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.stop()
+
+    @staticmethod
+    def reset():
+        pass